@@ -0,0 +1,117 @@
+"""
+YouTube Music and Spotify clients, which are only set up when a web request first needs them.
+
+Setting up the clients asks the user for permission, reads (or starts setting up) the
+credential files, and imports the music service libraries, which are slow to import.  Work
+that only uses saved songs, such as sorting a downloaded playlist, never makes a request, so
+it never pays for any of that and runs without credentials.  YTM and SP stand in for the
+clients and set both up the first time either is used; run_API_request() and
+submit_API_request() also set them up first, on the calling thread, so the user is asked for
+permission before any request is handed to the scheduler's worker threads.
+"""
+
+import json, os, sys, threading
+from concurrent.futures import Future
+from typing import Callable
+
+from api_scheduler import SERVICE_YTM, RequestScheduler
+from prompts import prompt_user_for_bool
+
+YTM_AUTH_FILE = 'headers_auth.json'
+SPOTIFY_AUTH_FILE = 'spotify.json'
+
+def create_YTM_client():
+    """Returns a YouTube Music client, starting setup first if there's no header file."""
+    from ytmusicapi import YTMusic
+    if not os.path.exists(YTM_AUTH_FILE):
+        print("YouTube Music header file not found. Starting setup; follow the instructions at https://ytmusicapi.readthedocs.io/en/latest/setup.html")
+        YTMusic.setup(filepath=YTM_AUTH_FILE)
+    return YTMusic(YTM_AUTH_FILE)
+
+def create_spotify_client():
+    """Returns a Spotify client from the credentials in SPOTIFY_AUTH_FILE.  Exits if the file
+       is unreadable or missing credentials, after writing a template to fill in."""
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+
+    # Load Spotify creds from JSON file
+    spotify_creds_file = None
+    spotify_creds = {}
+    try:
+        # Try loading existing file
+        spotify_creds_file = open('./' + SPOTIFY_AUTH_FILE, "rt")
+        spotify_creds = json.load(spotify_creds_file)
+        spotify_creds_file.close()
+    except FileNotFoundError:
+        # File does not exist, write a new one
+        spotify_creds_file = open('./' + SPOTIFY_AUTH_FILE, "xt")
+        spotify_creds_file.write("{}")
+        spotify_creds_file.close()
+    except json.JSONDecodeError:
+        spotify_creds_file.close()
+        sys.exit("Spotify credential file\"" + SPOTIFY_AUTH_FILE + "\" could not be read, exiting. Consider moving/deleting it so a new file can be put in its place. \n")
+
+    # Validate fields in config file
+    spotify_cred_fields = ["client_id", "client_secret", "redirect_uri"]
+    spotify_creds_file_needs_update = False
+    for spotify_field in spotify_cred_fields:
+        if spotify_field not in spotify_creds:
+            spotify_creds[spotify_field] = ""
+            spotify_creds_file_needs_update = True
+    if spotify_creds_file_needs_update:
+        spotify_creds_file = open('./' + SPOTIFY_AUTH_FILE, "wt")
+        json.dump(spotify_creds, spotify_creds_file)
+        spotify_creds_file.close()
+        print("Please put Spotify API credentials into \"" + SPOTIFY_AUTH_FILE + "\". ")
+        print("Get/create credentials at https://developer.spotify.com/dashboard/applications and set the redirect URI to http://localhost")
+        print(" or if using another URL, use your browser's Developer Tools to capture the redirect URL. ")
+        sys.exit("Please relaunch after updating credentials. \n")
+
+    return spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=spotify_creds["client_id"],
+                                                     client_secret=spotify_creds["client_secret"],
+                                                     redirect_uri=spotify_creds["redirect_uri"],
+                                                     scope="user-library-read"))
+
+class LazyClient:
+    """Stands in for an API client, which connect_API_clients() sets up the first time one of
+       its members is used."""
+    client = None
+
+    def __getattr__(self, member_name : str):
+        # Only called for members this class doesn't have, so everything else goes to the client
+        if self.client is None:
+            connect_API_clients()
+        return getattr(self.client, member_name)
+
+YTM = LazyClient()
+SP = LazyClient()
+_connect_lock = threading.Lock()
+
+def connect_API_clients():
+    """Asks the user for permission and sets up both clients, the first time it's called."""
+    with _connect_lock:
+        if YTM.client is not None and SP.client is not None:
+            return
+        if not prompt_user_for_bool(message="Okay to access Spotify API and emulate a YouTube Music client? ", allow_no_response=False):
+            sys.exit("Permission denied, aborting.\n")
+        YTM.client = create_YTM_client()
+        SP.client = create_spotify_client()
+
+def get_API_error_hint(error : Exception):
+    """Returns a hint to print after errors that look like authorization problems."""
+    if "Unauthorized" in str(error) or type(error).__name__ in ['SpotifyOauthError', 'SpotifyStateError']:
+        return "This may be an authorization error, so consider removing the authorization file to set up again. "
+    return None
+
+API_SCHEDULER = RequestScheduler(error_hint=get_API_error_hint)
+
+def run_API_request(operation : Callable, description="an unknown web request", service=SERVICE_YTM):
+    """Runs a lamba (presumably containing an API call) and returns its result.
+       Keeps to the service's rate limit and backs off upon exceptions (see api_scheduler)."""
+    connect_API_clients()
+    return API_SCHEDULER.run(operation, description, service)
+
+def submit_API_request(operation : Callable, description="an unknown web request", service=SERVICE_YTM) -> Future:
+    """Like run_API_request(), but returns a future right away so several requests can be in flight."""
+    connect_API_clients()
+    return API_SCHEDULER.submit(operation, description, service)
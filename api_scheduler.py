@@ -0,0 +1,164 @@
+"""
+Rate-limited web request scheduling, with a separate quota for each service.
+
+Each service (YouTube Music, Spotify) has a token bucket: requests spend a token, and tokens
+refill at the service's rate up to a small burst.  Requests run on a bounded pool of worker
+threads for their service and are handed back as futures.  Workers wait for their service's
+tokens, so each service has its own pool: a queue of YouTube Music requests waiting on the slow
+YouTube Music quota never holds up Spotify requests, and several requests to one service can
+be in flight within its quota.
+
+When a request fails, only its own service slows down (and honors any Retry-After header),
+then speeds back up again after a few requests succeed.
+"""
+
+import threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+# Services that requests can be scheduled for
+SERVICE_YTM = 'ytm'
+SERVICE_SPOTIFY = 'spotify'
+# Requests per second and burst size (most tokens a bucket holds) for each service
+DEFAULT_SERVICE_LIMITS = {SERVICE_YTM : (1.0, 1),
+                          SERVICE_SPOTIFY : (2.0, 4)}
+# Worker threads for each service
+DEFAULT_WORKER_COUNT = 4
+
+# Backoff after errors: every OPS_TO_INCREASE_BACKOFF failed attempts divide the service's rate by
+# TIME_MULTIPLICATION_FACTOR, down to 1 / MAX_TIME_MULTIPLIER of its normal rate, and every
+# OPS_TO_RESTORE_BACKOFF successful requests multiply it back up again
+OPS_TO_RESTORE_BACKOFF = 2
+OPS_TO_INCREASE_BACKOFF = 2
+MAX_TIME_MULTIPLIER = 16
+TIME_MULTIPLICATION_FACTOR = 4
+
+class TokenBucket:
+    """Hands out tokens at a steady rate, allowing short bursts.  Thread safe."""
+    default_rate = None # tokens per second when not backed off
+    rate = None # tokens per second
+    capacity = None
+    tokens = None
+    last_refill_time = None
+    paused_until_time = 0 # No tokens are handed out before this time, for Retry-After
+    ops_since_backoff = 0
+    lock = None
+
+    def __init__(self, rate : float, capacity : int):
+        self.default_rate = self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, current_time : float):
+        self.tokens = min(self.capacity, self.tokens + (current_time - self.last_refill_time) * self.rate)
+        self.last_refill_time = current_time
+
+    def acquire(self):
+        """Waits until a token is available, then takes it."""
+        while True:
+            with self.lock:
+                current_time = time.monotonic()
+                self._refill(current_time)
+                if current_time >= self.paused_until_time and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = max(self.paused_until_time - current_time, (1 - self.tokens) / self.rate)
+            time.sleep(wait_time)
+
+    def pause(self, pause_time_s : float):
+        """Hands out no tokens for the given number of seconds."""
+        with self.lock:
+            self.paused_until_time = max(self.paused_until_time, time.monotonic() + pause_time_s)
+
+    def is_fully_backed_off(self) -> bool:
+        return self.rate <= self.default_rate / MAX_TIME_MULTIPLIER
+
+    def slow_down(self) -> float:
+        """Lowers the rate after errors and returns the new time between requests."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.rate / TIME_MULTIPLICATION_FACTOR, self.default_rate / MAX_TIME_MULTIPLIER)
+            self.tokens = min(self.tokens, 0)
+            self.ops_since_backoff = 0
+            return 1 / self.rate
+
+    def record_success(self):
+        """Counts a successful request, and raises the rate again once enough have succeeded."""
+        with self.lock:
+            self.ops_since_backoff += 1
+            if self.rate < self.default_rate and self.ops_since_backoff >= OPS_TO_RESTORE_BACKOFF:
+                self._refill(time.monotonic())
+                self.rate = min(self.rate * TIME_MULTIPLICATION_FACTOR, self.default_rate)
+                self.ops_since_backoff = 0
+
+def get_retry_after_s(error : Exception):
+    """Returns the seconds to wait from an error's Retry-After header, if the error has one."""
+    headers = getattr(error, 'headers', None)
+    if headers is None and getattr(error, 'response', None) is not None:
+        headers = getattr(error.response, 'headers', None)
+    if not headers:
+        return None
+    for header_name, value in headers.items():
+        if header_name.lower() == 'retry-after':
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+class RequestScheduler:
+    """Runs requests for several services, each on its own pool of worker_count threads, keeping
+       each service within its own rate limit.  error_hint, if given, is called with each error and
+       can return a message to print after it (such as a hint about authorization)."""
+    buckets = None # dict of service name to TokenBucket
+    executors = None # dict of service name to ThreadPoolExecutor
+    error_hint = None # Callable taking an Exception and returning a str or None
+
+    def __init__(self, service_limits=DEFAULT_SERVICE_LIMITS, worker_count=DEFAULT_WORKER_COUNT, error_hint=None):
+        self.buckets = {service : TokenBucket(rate, capacity) for service, (rate, capacity) in service_limits.items()}
+        self.executors = {service : ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="api_request_" + service) for service in service_limits}
+        self.error_hint = error_hint
+
+    def submit(self, operation : Callable, description="an unknown web request", service=SERVICE_YTM) -> Future:
+        """Schedules a lambda (presumably containing an API call) and returns a future for its result.
+           The result is None if the request still failed after backing off as far as possible."""
+        assert service in self.buckets, "Unknown service " + str(service)
+        return self.executors[service].submit(self._run, operation, description, self.buckets[service])
+
+    def run(self, operation : Callable, description="an unknown web request", service=SERVICE_YTM):
+        """Runs a lambda like submit(), but waits for and returns its result."""
+        return self.submit(operation, description, service).result()
+
+    def _run(self, operation : Callable, description : str, bucket : TokenBucket):
+        attempt_count = 0
+        while True:
+            bucket.acquire()
+            attempt_count = attempt_count + 1
+            try:
+                result = operation()
+                if result is None:
+                    raise Exception("Invalid response received")
+                bucket.record_success()
+                return result
+            except Exception as error:
+                print("Error encountered while attempting " + description + ". ")
+                if self.error_hint is not None:
+                    hint = self.error_hint(error)
+                    if hint is not None:
+                        print(hint)
+                if bucket.is_fully_backed_off():
+                    print("Exceeded retries. Continuing... ")
+                    return None
+                retry_after_s = get_retry_after_s(error)
+                if retry_after_s is not None:
+                    print("Service asked to wait " + str(retry_after_s) + " seconds before retrying... ")
+                    bucket.pause(retry_after_s)
+                if attempt_count >= OPS_TO_INCREASE_BACKOFF:
+                    attempt_count = 0
+                    print("Temporarily spacing out requests by " + str(bucket.slow_down()) + " seconds... ")
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
@@ -0,0 +1,53 @@
+from foundation import *
+from scoring import get_current_similarity_score
+from solver import solve_for_playlist_order
+from local_search import solve_with_local_search
+
+import argparse, random
+
+# Compares the sorting engines on randomly generated songs, so no saved playlists are needed.
+
+parser = argparse.ArgumentParser(description="Compares wall time and final similarity score of the sorting engines on random songs.")
+parser.add_argument('--songs', type=int, nargs='+', default=[500, 2000],
+                    help="Playlist sizes to benchmark. Default: %(default)s")
+parser.add_argument('--seed', type=int, default=0,
+                    help="Random seed for the generated songs. Default: %(default)s")
+parser.add_argument('--time-limit', type=float, default=None,
+                    help="Time limit given to each engine, in seconds. Default: none")
+arguments = parser.parse_args()
+
+def generate_random_songs(song_count : int) -> dict[str, Song]:
+    """Makes songs with random keys, BPMs and ratings."""
+    random_songs = dict()
+    for song_number in range(song_count):
+        song = Song()
+        song.yt_id = "benchmark" + str(song_number)
+        song.name = "Benchmark song " + str(song_number)
+        song.set_camelot_position(random.randint(1, CAMELOT_POSITIONS))
+        song.camelot_is_minor = random.random() < 0.5
+        song.set_bpm(random.uniform(MIN_BPM, MAX_BPM))
+        song.user_ratings = {rating_name : random.randint(-2, 2) for rating_name in USER_RATINGS}
+        random_songs[song.yt_id] = song
+    return random_songs
+
+engines = {'ortools' : lambda song_ids, songs_cache: solve_for_playlist_order(song_ids, songs_cache, time_limit_s=arguments.time_limit, progress_callback=None),
+           'local-search' : lambda song_ids, songs_cache: solve_with_local_search(song_ids, songs_cache, time_limit_s=arguments.time_limit, progress_callback=None),
+           'local-search-knn' : lambda song_ids, songs_cache: solve_with_local_search(song_ids, songs_cache, time_limit_s=arguments.time_limit, progress_callback=None, candidates='knn')}
+
+results = []
+for song_count in arguments.songs:
+    random.seed(arguments.seed)
+    songs_cache = generate_random_songs(song_count)
+    song_ids = list(songs_cache.keys())
+    results.append((song_count, 'unsorted', 0.0, get_current_similarity_score(song_ids, songs_cache)))
+    for engine_name, engine in engines.items():
+        print("\nBenchmarking " + engine_name + " with " + str(song_count) + " songs...")
+        start_time = time.time()
+        sorted_song_ids = engine(song_ids, songs_cache)
+        elapsed_s = time.time() - start_time
+        assert sorted(sorted_song_ids) == sorted(song_ids), engine_name + " lost or duplicated songs"
+        results.append((song_count, engine_name, elapsed_s, get_current_similarity_score(sorted_song_ids, songs_cache)))
+
+print("\n" + "Songs".rjust(8) + "Engine".rjust(18) + "Seconds".rjust(10) + "Score".rjust(10))
+for song_count, engine_name, elapsed_s, score in results:
+    print(str(song_count).rjust(8) + engine_name.rjust(18) + ("%.2f" % elapsed_s).rjust(10) + ("%.4f" % score).rjust(10))
@@ -0,0 +1,169 @@
+"""
+Sparse candidate graphs: for each song, a short list of the other songs most worth playing next to it.
+
+Most of the n^2 jumps between songs are never worth making, since no good playlist goes from a
+90 BPM minor ballad straight to a 175 BPM major banger.  Songs are put in buckets ("cells") by
+camelot position, key mode and user ratings, which set almost all of the similarity score, and
+sorted by BPM inside each cell.  Each song is only scored against the nearby BPMs of the cells
+closest to its own, and its closest neighbor_count songs become its candidates.  Solvers then only
+try candidate jumps, so storing the graph costs O(n * k) instead of O(n^2) for a distance matrix.
+"""
+
+import numpy
+
+from song_model import CAMELOT_POSITIONS, MAX_BPM, MIN_BPM, USER_RATINGS
+from scoring import SongFeatures, get_similarity_matrix
+from distance import DISTANCE_COST_SCALE, get_scaled_distances
+
+# How many candidate songs to keep for each song
+CANDIDATE_NEIGHBOR_COUNT = 12
+# How many songs or cells to score at once, to keep temporary arrays small
+CANDIDATE_BLOCK_ROWS = 256
+# Most that BPMs can lower the similarity score of two songs (v1 score: 30% of a subscore that
+# only drops by 1 / max_bpm_difference).  Cells this much further away than the closest cells
+# that hold enough songs can still hold closer songs, so they are searched too.
+MAX_BPM_SCORE_PENALTY = 0.3 / ((MAX_BPM - MIN_BPM) / 2)
+# Cell costs are added up in a different order than the score, so allow for rounding when comparing them
+CELL_COST_TOLERANCE = 1e-9
+# How many of the closest cells to sort first when looking for enough songs, before sorting them all
+NEARBY_CELL_GUESS = 64
+
+def get_bpm_positions(features : SongFeatures) -> numpy.ndarray:
+    """Returns where each song's BPM falls around the BPM range (0.0 to 1.0) on a log scale,
+       so that the ends of the range meet, like the score treats doubled BPMs as matching."""
+    return numpy.log2(features.bpms / MIN_BPM) % 1.0
+
+def get_window(sorted_positions : numpy.ndarray, low_position : float, high_position : float, margin : int) -> numpy.ndarray:
+    """Returns the indices into sorted_positions from low_position to high_position, plus margin
+       more on either side, wrapping around the ends."""
+    count = len(sorted_positions)
+    first = int(numpy.searchsorted(sorted_positions, low_position, side='left')) - margin
+    last = int(numpy.searchsorted(sorted_positions, high_position, side='right')) + margin
+    if last - first >= count:
+        return numpy.arange(count)
+    return numpy.arange(first, last) % count
+
+def get_cell_cost_tables(cell_keys : numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Scores how much each key change and each rating change lowers the similarity score, since
+       the score is a sum of key, BPM and rating parts.  cell_keys has a row per cell of camelot
+       position, key mode, then user ratings.  Returns (key cost table, rating cost table, rating values),
+       where keys are numbered (camelot position - 1) * 2 + key mode and ratings by their index in rating values."""
+    key_features = SongFeatures()
+    key_features.song_ids = list(range(CAMELOT_POSITIONS * 2))
+    key_features.camelot_positions = numpy.repeat(numpy.arange(1, CAMELOT_POSITIONS + 1), 2)
+    key_features.camelot_is_minor = numpy.tile([False, True], CAMELOT_POSITIONS)
+    key_features.bpms = numpy.full(CAMELOT_POSITIONS * 2, float(MIN_BPM))
+    key_features.user_ratings = numpy.zeros((CAMELOT_POSITIONS * 2, len(USER_RATINGS)), dtype=numpy.int64)
+
+    # Songs whose ratings are all the same value, so each rating's share is the difference over the number of ratings
+    rating_values = numpy.unique(cell_keys[:, 2:])
+    rating_features = SongFeatures()
+    rating_features.song_ids = list(range(len(rating_values)))
+    rating_features.camelot_positions = numpy.ones(len(rating_values), dtype=numpy.int64)
+    rating_features.camelot_is_minor = numpy.zeros(len(rating_values), dtype=bool)
+    rating_features.bpms = numpy.full(len(rating_values), float(MIN_BPM))
+    rating_features.user_ratings = numpy.repeat(rating_values[:, numpy.newaxis], len(USER_RATINGS), axis=1)
+
+    key_costs = 1.0 - get_similarity_matrix(key_features)
+    rating_costs = (1.0 - get_similarity_matrix(rating_features)) / len(USER_RATINGS)
+    return key_costs, rating_costs, rating_values
+
+def get_cell_costs(cell_keys : numpy.ndarray, cell_cost_tables : tuple, cell_rows) -> numpy.ndarray:
+    """Returns how much the differences between each cell in cell_rows and every cell lower the
+       similarity score, without BPMs.  cell_cost_tables comes from get_cell_cost_tables()."""
+    key_costs, rating_costs, rating_values = cell_cost_tables
+    key_numbers = (cell_keys[:, 0] - 1) * 2 + cell_keys[:, 1]
+    rating_indices = numpy.searchsorted(rating_values, cell_keys[:, 2:])
+    row_rating_indices = rating_indices[cell_rows]
+    cell_costs = key_costs[key_numbers[cell_rows]][:, key_numbers]
+    for rating_column in range(rating_indices.shape[1]):
+        cell_costs += rating_costs[row_rating_indices[:, rating_column]][:, rating_indices[:, rating_column]]
+    return cell_costs
+
+def build_candidate_lists(features : SongFeatures, neighbor_count=CANDIDATE_NEIGHBOR_COUNT, cost_scale=DISTANCE_COST_SCALE) -> numpy.ndarray:
+    """Returns an (n, neighbor_count) array holding each song's candidates, closest first.
+       Candidates are the closest songs by similarity score, except that BPMs are only compared
+       by position in each cell, so ties between nearly equal BPMs can go either way."""
+    song_count = len(features)
+    neighbor_count = min(neighbor_count, song_count - 1)
+    candidate_lists = numpy.empty((song_count, max(neighbor_count, 0)), dtype=numpy.int64)
+    if neighbor_count <= 0:
+        return candidate_lists
+
+    # Songs with the same key and ratings only differ by BPM, so group them into cells sorted by BPM
+    cell_keys, cell_numbers = numpy.unique(numpy.column_stack([features.camelot_positions, features.camelot_is_minor, features.user_ratings]),
+                                           axis=0, return_inverse=True)
+    cell_numbers = cell_numbers.ravel()
+    cell_count = len(cell_keys)
+    bpm_positions = get_bpm_positions(features)
+    songs_by_cell = numpy.lexsort((bpm_positions, cell_numbers))
+    cell_starts = numpy.searchsorted(cell_numbers[songs_by_cell], numpy.arange(cell_count + 1))
+    cell_sizes = numpy.diff(cell_starts)
+
+    cell_cost_tables = get_cell_cost_tables(cell_keys)
+    for cell_block_start in range(0, cell_count, CANDIDATE_BLOCK_ROWS):
+        cell_block_costs = get_cell_costs(cell_keys, cell_cost_tables, slice(cell_block_start, cell_block_start + CANDIDATE_BLOCK_ROWS))
+        for cell, cell_costs in enumerate(cell_block_costs, cell_block_start):
+            # The closest cells that hold enough songs (counting this one), plus any that BPMs could make closer
+            closest_cells = numpy.argsort(cell_costs, kind='stable') if cell_count <= NEARBY_CELL_GUESS else \
+                            numpy.argpartition(cell_costs, NEARBY_CELL_GUESS - 1)[:NEARBY_CELL_GUESS]
+            closest_cells = closest_cells[numpy.argsort(cell_costs[closest_cells], kind='stable')]
+            enough_cells = int(numpy.searchsorted(numpy.cumsum(cell_sizes[closest_cells]), neighbor_count + 1))
+            if enough_cells == len(closest_cells):
+                # The guess didn't hold enough songs, so sort every cell
+                closest_cells = numpy.argsort(cell_costs, kind='stable')
+                enough_cells = int(numpy.searchsorted(numpy.cumsum(cell_sizes[closest_cells]), neighbor_count + 1))
+            cost_limit = cell_costs[closest_cells[enough_cells]] + MAX_BPM_SCORE_PENALTY + CELL_COST_TOLERANCE
+            nearby_cells = numpy.flatnonzero(cell_costs <= cost_limit)
+
+            cell_songs = songs_by_cell[cell_starts[cell]:cell_starts[cell + 1]]
+            for block_start in range(0, len(cell_songs), CANDIDATE_BLOCK_ROWS):
+                rows = cell_songs[block_start:block_start + CANDIDATE_BLOCK_ROWS]
+                # Only songs with nearby BPMs in each cell can be among the closest
+                column_groups = []
+                for nearby_cell in nearby_cells.tolist():
+                    nearby_cell_songs = songs_by_cell[cell_starts[nearby_cell]:cell_starts[nearby_cell + 1]]
+                    window = get_window(bpm_positions[nearby_cell_songs], bpm_positions[rows[0]], bpm_positions[rows[-1]], neighbor_count + 1)
+                    column_groups.append(nearby_cell_songs[window])
+                columns = numpy.concatenate(column_groups)
+
+                distances = get_scaled_distances(get_similarity_matrix(features, rows, columns), cost_scale)
+                distances[rows[:, numpy.newaxis] == columns[numpy.newaxis, :]] = numpy.inf # Never a candidate of itself
+                closest = numpy.argpartition(distances, neighbor_count - 1, axis=1)[:, :neighbor_count]
+                closest = numpy.take_along_axis(closest, numpy.argsort(numpy.take_along_axis(distances, closest, axis=1), axis=1, kind='stable'), axis=1)
+                candidate_lists[rows] = columns[closest]
+    return candidate_lists
+
+def get_symmetric_candidate_lists(candidate_lists : numpy.ndarray) -> list[numpy.ndarray]:
+    """Returns each song's candidates plus every song that has it as a candidate, so that a jump
+       allowed in one direction is allowed in the other too."""
+    song_count, neighbor_count = candidate_lists.shape
+    from_songs = numpy.repeat(numpy.arange(song_count), neighbor_count)
+    to_songs = candidate_lists.ravel()
+    arcs = numpy.unique(numpy.concatenate([from_songs * song_count + to_songs, to_songs * song_count + from_songs]))
+    arc_starts = numpy.searchsorted(arcs // song_count, numpy.arange(song_count + 1))
+    return [arcs[arc_starts[song_index]:arc_starts[song_index + 1]] % song_count for song_index in range(song_count)]
+
+def build_candidate_nearest_neighbor_order(distance_matrix, candidate_lists : numpy.ndarray, start_song_index=0) -> numpy.ndarray:
+    """Builds a first playlist order by always going to the closest candidate that hasn't been used yet.
+       Only when every candidate has been used are the remaining songs all scored, using distance_matrix
+       (a DistanceMatrix or FeatureDistances)."""
+    song_count = len(distance_matrix)
+    order = numpy.empty(song_count, dtype=numpy.int64)
+    if song_count == 0:
+        return order
+    visited = numpy.zeros(song_count, dtype=bool)
+    current_song_index = start_song_index
+    for position in range(song_count):
+        order[position] = current_song_index
+        visited[current_song_index] = True
+        if position == song_count - 1:
+            break
+        candidates = candidate_lists[current_song_index]
+        unvisited_candidates = candidates[~visited[candidates]]
+        if len(unvisited_candidates) > 0:
+            current_song_index = int(unvisited_candidates[0])
+        else:
+            unvisited_songs = numpy.flatnonzero(~visited)
+            current_song_index = int(unvisited_songs[numpy.argmin(distance_matrix.get_row(current_song_index, unvisited_songs))])
+    return order
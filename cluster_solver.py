@@ -0,0 +1,192 @@
+"""
+Cluster-then-route sorting for playlists too large for a full distance matrix.
+
+Songs are embedded as points whose distances roughly follow the similarity score, then split
+into clusters with k-means (recursively, until every cluster is small).  Each cluster is sorted
+on its own with the local search engine, the clusters are put in order by sorting one
+representative song per cluster, and each cluster's playlist is played forwards or backwards,
+whichever makes the jumps between clusters cheapest.  Finally the whole playlist is improved
+with local search over each song's candidates (see candidates.py), which fixes the jumps where
+clusters meet.  Memory is bounded by the largest cluster's distance matrix instead of growing
+with the square of the playlist size.
+"""
+
+import math, time
+
+import numpy
+
+from song_model import CAMELOT_POSITIONS, MIN_BPM, USER_RATINGS, Song
+from scoring import SongFeatures, get_similarity_matrix, pack_song_features
+from distance import DISTANCE_COST_SCALE, FeatureDistances, build_distance_matrix, get_scaled_distances
+from candidates import CANDIDATE_NEIGHBOR_COUNT, build_candidate_lists
+from local_search import improve_order, sort_distance_matrix
+from solver import get_average_similarity_for_cost, print_solver_progress
+
+# Clusters are made about this size, and any cluster over the maximum is split again
+TARGET_CLUSTER_SIZE = 300
+MAX_CLUSTER_SIZE = 2 * TARGET_CLUSTER_SIZE
+K_MEANS_ITERATION_LIMIT = 25
+# Share of the time limit spent sorting inside clusters; the rest goes to improving the whole playlist
+CLUSTER_TIME_SHARE = 0.5
+
+# Embedding scales, chosen so that one step of each feature moves a song about as far as it
+# lowers the similarity score: a camelot hop or key mode change costs 0.2 * 0.2, the largest
+# BPM difference costs 0.3, and one rating point costs 0.5 * 0.25 / (number of ratings)
+KEY_CIRCLE_RADIUS = (0.2 * 0.2) / (2 * math.sin(math.pi / CAMELOT_POSITIONS))
+MINOR_KEY_OFFSET = 0.2 * 0.2
+BPM_CIRCLE_RADIUS = 0.3 / 2
+RATING_POINT_SCALE = 0.5 * 0.25 / len(USER_RATINGS)
+
+def get_song_embedding(features : SongFeatures) -> numpy.ndarray:
+    """Turns song features into points where nearby songs are similar.  Keys go around a circle,
+       and so do BPMs, since the score treats doubled BPMs as matching."""
+    key_angles = 2 * numpy.pi * (features.camelot_positions - 1) / CAMELOT_POSITIONS
+    bpm_angles = 2 * numpy.pi * numpy.log2(features.bpms / MIN_BPM)
+    return numpy.column_stack([KEY_CIRCLE_RADIUS * numpy.cos(key_angles),
+                               KEY_CIRCLE_RADIUS * numpy.sin(key_angles),
+                               MINOR_KEY_OFFSET * features.camelot_is_minor,
+                               BPM_CIRCLE_RADIUS * numpy.cos(bpm_angles),
+                               BPM_CIRCLE_RADIUS * numpy.sin(bpm_angles),
+                               RATING_POINT_SCALE * features.user_ratings])
+
+def run_k_means(points : numpy.ndarray, cluster_count : int, rng : numpy.random.Generator, iteration_limit=K_MEANS_ITERATION_LIMIT) -> numpy.ndarray:
+    """Groups points into cluster_count clusters and returns each point's cluster number."""
+    point_count = len(points)
+    cluster_count = min(cluster_count, point_count)
+
+    # k-means++ starting centroids: each one is picked with odds weighted by distance from the others
+    centroids = numpy.empty((cluster_count, points.shape[1]))
+    centroids[0] = points[rng.integers(point_count)]
+    closest_squared_distances = ((points - centroids[0]) ** 2).sum(axis=1)
+    for centroid_number in range(1, cluster_count):
+        total = closest_squared_distances.sum()
+        chosen_point = rng.choice(point_count, p=closest_squared_distances / total) if total > 0 else rng.integers(point_count)
+        centroids[centroid_number] = points[chosen_point]
+        closest_squared_distances = numpy.minimum(closest_squared_distances, ((points - centroids[centroid_number]) ** 2).sum(axis=1))
+
+    labels = None
+    point_norms = (points ** 2).sum(axis=1)[:, numpy.newaxis]
+    for _ in range(iteration_limit):
+        squared_distances = point_norms - 2 * points @ centroids.T + (centroids ** 2).sum(axis=1)[numpy.newaxis, :]
+        new_labels = numpy.argmin(squared_distances, axis=1)
+        if labels is not None and numpy.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        cluster_sizes = numpy.bincount(labels, minlength=cluster_count)
+        for dimension in range(points.shape[1]):
+            centroids[:, dimension] = numpy.bincount(labels, weights=points[:, dimension], minlength=cluster_count) / numpy.maximum(cluster_sizes, 1)
+        # Restart empty clusters at the points farthest from their centroids
+        empty_clusters = numpy.flatnonzero(cluster_sizes == 0)
+        if len(empty_clusters) > 0:
+            farthest_points = numpy.argsort(squared_distances[numpy.arange(point_count), labels])[::-1][:len(empty_clusters)]
+            centroids[empty_clusters] = points[farthest_points]
+    return labels
+
+def split_into_clusters(points : numpy.ndarray, point_indices : numpy.ndarray, rng : numpy.random.Generator,
+                        target_cluster_size=TARGET_CLUSTER_SIZE, max_cluster_size=MAX_CLUSTER_SIZE) -> list[numpy.ndarray]:
+    """Splits the given points into clusters of at most max_cluster_size, returning arrays of point indices."""
+    if len(point_indices) <= max_cluster_size:
+        return [point_indices]
+    cluster_count = math.ceil(len(point_indices) / target_cluster_size)
+    labels = run_k_means(points[point_indices], cluster_count, rng)
+    clusters = []
+    for cluster_number in range(cluster_count):
+        cluster_indices = point_indices[labels == cluster_number]
+        if len(cluster_indices) == len(point_indices):
+            # k-means couldn't separate these points (they are probably identical), so just cut them into chunks
+            return [point_indices[chunk_start:chunk_start + target_cluster_size] for chunk_start in range(0, len(point_indices), target_cluster_size)]
+        if len(cluster_indices) > 0:
+            clusters.extend(split_into_clusters(points, cluster_indices, rng, target_cluster_size, max_cluster_size))
+    return clusters
+
+def get_features_subset(features : SongFeatures, rows : numpy.ndarray) -> SongFeatures:
+    """Returns the features of only the given rows."""
+    subset = SongFeatures()
+    subset.song_ids = [features.song_ids[row] for row in rows]
+    subset.camelot_positions = features.camelot_positions[rows]
+    subset.camelot_is_minor = features.camelot_is_minor[rows]
+    subset.bpms = features.bpms[rows]
+    subset.user_ratings = features.user_ratings[rows]
+    return subset
+
+def sort_cluster(features : SongFeatures, rows : numpy.ndarray, cost_scale : int, time_limit_s=None) -> numpy.ndarray:
+    """Sorts the songs in one cluster and returns their rows in sorted order."""
+    if len(rows) < 3:
+        return rows
+    distance_matrix = build_distance_matrix(get_features_subset(features, rows), cost_scale, for_solver=False)
+    return rows[sort_distance_matrix(distance_matrix, time_limit_s=time_limit_s)]
+
+def choose_cluster_directions(features : SongFeatures, sorted_clusters : list[numpy.ndarray], cost_scale : int) -> list[numpy.ndarray]:
+    """Picks whether to play each cluster forwards or backwards so the jumps between clusters cost
+       as little as possible in total (a two-state shortest path over the cluster order)."""
+    if len(sorted_clusters) < 2:
+        return sorted_clusters
+
+    def get_jump_cost(from_row, to_row):
+        return int(get_scaled_distances(get_similarity_matrix(features, [from_row], [to_row]), cost_scale)[0, 0])
+
+    # For each cluster and direction (0 = forwards, 1 = backwards): the song it starts and ends on
+    ends = [[(cluster[0], cluster[-1]), (cluster[-1], cluster[0])] for cluster in sorted_clusters]
+    best_costs = [0, 0]
+    best_previous_directions = []
+    for cluster_number in range(1, len(sorted_clusters)):
+        new_costs = []
+        previous_directions = []
+        for direction in [0, 1]:
+            options = [best_costs[previous_direction] + get_jump_cost(ends[cluster_number - 1][previous_direction][1], ends[cluster_number][direction][0])
+                       for previous_direction in [0, 1]]
+            previous_directions.append(int(numpy.argmin(options)))
+            new_costs.append(min(options))
+        best_costs = new_costs
+        best_previous_directions.append(previous_directions)
+
+    # Walk back through the choices
+    direction = int(numpy.argmin(best_costs))
+    directions = [direction]
+    for previous_directions in reversed(best_previous_directions):
+        direction = previous_directions[direction]
+        directions.append(direction)
+    directions.reverse()
+    return [cluster if direction == 0 else cluster[::-1] for cluster, direction in zip(sorted_clusters, directions)]
+
+def solve_with_clusters(song_ids : list, songs_cache : dict[str, Song], cost_scale=DISTANCE_COST_SCALE, target_cluster_size=TARGET_CLUSTER_SIZE,
+                        time_limit_s=None, random_seed=None, progress_callback=print_solver_progress, neighbor_count=CANDIDATE_NEIGHBOR_COUNT) -> list:
+    """
+    Sorts a playlist of any size by clustering similar songs, sorting inside each cluster,
+    then sorting the clusters, then improving the whole playlist using neighbor_count candidates
+    per song.  Returns the song IDs in sorted order.  Song IDs should be unique.  Part of
+    time_limit_s is shared between the clusters by size, and the rest is left for the final pass.
+    """
+    song_count = len(song_ids)
+    if song_count < 3:
+        return list(song_ids)
+    start_time = time.time()
+    rng = numpy.random.default_rng(random_seed)
+
+    print("Clustering songs...")
+    features = pack_song_features(song_ids, songs_cache)
+    clusters = split_into_clusters(get_song_embedding(features), numpy.arange(song_count), rng, target_cluster_size, 2 * target_cluster_size)
+    print("Sorting " + str(len(clusters)) + " clusters of up to " + str(max(len(cluster) for cluster in clusters)) + " songs...")
+
+    sorted_clusters = []
+    for cluster in clusters:
+        cluster_time_limit_s = None if time_limit_s is None else time_limit_s * CLUSTER_TIME_SHARE * len(cluster) / song_count
+        sorted_clusters.append(sort_cluster(features, cluster, cost_scale, cluster_time_limit_s))
+
+    # Put the clusters in order by sorting each cluster's middle song
+    representative_rows = numpy.array([cluster[len(cluster) // 2] for cluster in sorted_clusters])
+    cluster_order = sort_cluster(features, representative_rows, cost_scale)
+    cluster_number_for_row = {int(row) : cluster_number for cluster_number, row in enumerate(representative_rows)}
+    sorted_clusters = [sorted_clusters[cluster_number_for_row[int(row)]] for row in cluster_order]
+    sorted_clusters = choose_cluster_directions(features, sorted_clusters, cost_scale)
+
+    song_order = numpy.concatenate(sorted_clusters)
+
+    # Improve the whole playlist, mostly where clusters meet, trying only each song's candidates
+    print("Improving the playlist across clusters...")
+    feature_distances = FeatureDistances(features, cost_scale)
+    remaining_time_s = None if time_limit_s is None else max(time_limit_s - (time.time() - start_time), 0)
+    song_order = improve_order(feature_distances, song_order, build_candidate_lists(features, neighbor_count, cost_scale), remaining_time_s)
+    if progress_callback is not None:
+        progress_callback(time.time() - start_time, get_average_similarity_for_cost(feature_distances.get_path_cost(song_order), song_count, cost_scale))
+    return [song_ids[row] for row in song_order]
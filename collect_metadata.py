@@ -1,6 +1,7 @@
 import os
 
 from foundation import *
+from song_pipeline import resolve_songs
 
 # Check which playlists are already saved
 playlists_db, songs_cache = load_data_files()
@@ -20,6 +21,8 @@ user_name = input("Account name or channel ID: ")
 overwrite_all_playlists = prompt_user_for_bool(message="Redownload and overwrite playlists that are already saved? Leave answer empty to prompt for every playlist. This will preserve song metadata and ratings. ", allow_no_response=True)
 
 num_playlists_processed = 0
+# Songs that couldn't be found on Spotify without help, to ask about after every playlist is downloaded
+songs_needing_review = []
 
 for candidate_playlist in ytm_playlists:
     local_playlist = Playlist()
@@ -45,18 +48,14 @@ for candidate_playlist in ytm_playlists:
         # Get songs in the playlist
         remote_playlist_contents = run_API_request(lambda : YTM.get_playlist(playlistId=local_playlist.yt_id, limit=int(candidate_playlist['count']) + 1), "to get the songs for YouTube Music playlist \"" + local_playlist.name + "\"")
         playlist_length = str(len(remote_playlist_contents['tracks']))
-        print("Playlist has " + playlist_length + " songs to check, please wait a few moments for each song... ")
+        print("Playlist has " + playlist_length + " songs to check... ")
 
-        # Store song info in a Song object
-        for song_count, playlist_song in enumerate(remote_playlist_contents['tracks']):
-            # Print update every 10 songs since this can take a few seconds per song
-            if song_count % 10 == 9:
-                print("Checking song " + str(song_count + 1) + " of " + playlist_length + "... ")
-
-            # Create Song object from YTM's response for the playlist contents
+        # Make a Song object from YTM's response for each new song, then look them all up together
+        new_songs = dict()
+        for playlist_song in remote_playlist_contents['tracks']:
             local_song = Song()
             local_song.yt_id = playlist_song['videoId']
-            if local_song.yt_id not in songs_cache:
+            if local_song.yt_id not in songs_cache and local_song.yt_id not in new_songs:
                 if playlist_song['album'] is not None:
                     local_song.album = playlist_song['album']['name']
                 local_song.artist = playlist_song['artists'][0]['name']
@@ -65,25 +64,41 @@ for candidate_playlist in ytm_playlists:
                     # Convert song duration to number of seconds
                     time_strings = playlist_song['duration'].split(':')
                     local_song.duration_s = 60 * int(time_strings[0]) + int(time_strings[1])
-                else:
-                    # Some YTM songs don't include duration in the playlist response
-                    print("Using alternate method to get duration of song \"" + local_song.name + "\". ")
-                    alt_lookup_song = download_metadata_from_YT_id(local_song.yt_id)
-                    local_song.duration_s = alt_lookup_song.duration_s
-
-                process_song_metadata(song=local_song, search_spotify=True, edit_metadata=False, get_features=True)
-                songs_cache[local_song.yt_id] = local_song
+                # Otherwise the duration is looked up separately
+                new_songs[local_song.yt_id] = local_song
 
             local_playlist.song_ids.append(local_song.yt_id)
             local_playlist.order_ids.append(playlist_song['setVideoId'])
 
+        if len(new_songs) > 0:
+            print("Looking up " + str(len(new_songs)) + " new songs on YouTube Music and Spotify... ")
+            def add_song_to_cache(song):
+                songs_cache[song.yt_id] = song
+                save_song(song)
+            songs_needing_review.extend(resolve_songs(list(new_songs.values()), add_song_to_cache))
+
         # Store complete playlist
-        playlist_file = open('./' + PLAYLIST_FILE_PREFIX + local_playlist.yt_id + PLAYLIST_FILE_EXTENSION, "wb")
-        pickle.dump(local_playlist, playlist_file)
-        playlist_file.close()
+        write_song_cache(songs_cache)
+        save_playlist(local_playlist)
         playlists_db[local_playlist.yt_id] = local_playlist
         print("Done processing playlist \"" + local_playlist.name + "\"; saved to folder. ")
         num_playlists_processed = num_playlists_processed + 1
-        write_song_cache(songs_cache)
 
-print("Processed " + str(num_playlists_processed) + " playlists; exiting. ")
+print("Processed " + str(num_playlists_processed) + " playlists. ")
+
+if len(songs_needing_review) > 0:
+    print(str(len(songs_needing_review)) + " new songs couldn't be matched to a Spotify song automatically. They are saved and flagged for review. ")
+    if prompt_user_for_bool("Help find them on Spotify now? Otherwise you can fix them later with metadata_fixer.py. "):
+        for review_count, song in enumerate(songs_needing_review):
+            print("Song " + str(review_count + 1) + " of " + str(len(songs_needing_review)) + ": \"" + str(song.name) + "\" by " + str(song.artist) + ". ")
+            if song.duration_s is None:
+                # Its YouTube Music details lookup failed, and matching on Spotify needs the duration
+                try:
+                    song.duration_s = download_metadata_from_YT_id(song.yt_id).duration_s
+                except (AttributeError, TypeError, KeyError, ValueError):
+                    print("Couldn't look up the song's duration on YouTube Music, so it stays flagged for review. ")
+                    continue
+            process_song_metadata(song=song, search_spotify=True, edit_metadata=False, get_features=True)
+            save_song(song)
+        write_song_cache(songs_cache)
+print("Exiting. ")
@@ -0,0 +1,11 @@
+from foundation import *
+
+print("Cache converter")
+print("Moves songs and playlists from the old cache and playlist files into the song store, and upgrades the store to the latest format. ")
+print("The old files are kept as a backup. Other programs do this automatically when they load songs. ")
+
+imported_song_count, imported_playlist_count = import_legacy_files()
+song_store = get_song_store()
+song_store.compact(force=True)
+print("Imported " + str(imported_song_count) + " songs and " + str(imported_playlist_count) + " playlists. " + \
+      "The song store holds " + str(len(song_store)) + " songs and " + str(len(song_store.get_playlist_index())) + " playlists. ")
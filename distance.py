@@ -0,0 +1,186 @@
+"""
+Integer "distance" (travel cost) matrices between songs, for use by the playlist solver.
+
+A distance is the inverted similarity score (1.0 - score) scaled to an integer, since
+OR-Tools only works with integer arc costs.  Distances are symmetric, so only the upper
+triangle of the matrix is stored, in the smallest unsigned integer type that fits the scale.
+FeatureDistances gives the same distances without storing any, scoring songs as they are asked for.
+"""
+
+import numpy
+from operator import itemgetter
+
+from scoring import SongFeatures, get_pair_similarity_scores, get_similarity_matrix
+
+# Default multiplier used to turn distances (0.0 to 1.0) into integers.  Fits in uint16.
+DISTANCE_COST_SCALE = 10000
+# Default maximum memory to spend on a distance matrix, including the solver's copy of it
+DEFAULT_MEMORY_BUDGET_BYTES = 1024 * 1024 * 1024
+# How many matrix rows to score at once while building, to keep temporary arrays small
+BUILD_BLOCK_ROWS = 256
+
+# Bytes per cell used by the solver's full copy: OR-Tools keeps an int64 matrix internally,
+# and the Python rows passed to it hold one 8-byte pointer per cell while registering
+SOLVER_BYTES_PER_CELL = 8 + 8
+
+def get_cost_dtype(cost_scale : int) -> numpy.dtype:
+    """Returns the smallest unsigned integer type that can store costs up to cost_scale."""
+    for dtype in [numpy.uint16, numpy.uint32]:
+        if cost_scale <= numpy.iinfo(dtype).max:
+            return numpy.dtype(dtype)
+    raise ValueError("Cost scale " + str(cost_scale) + " is too large for a compact distance matrix")
+
+def get_distance_matrix_memory_bytes(song_count : int, cost_scale=DISTANCE_COST_SCALE, for_solver=True) -> int:
+    """Estimates the peak memory needed to build a distance matrix for the given number of songs
+       (and optionally hand it to OR-Tools, which includes a dummy start node)."""
+    triangle_bytes = (song_count * (song_count - 1) // 2) * get_cost_dtype(cost_scale).itemsize
+    block_bytes = BUILD_BLOCK_ROWS * song_count * 8 * 4 # A few float64 temporaries while scoring
+    solver_bytes = ((song_count + 1) ** 2) * SOLVER_BYTES_PER_CELL if for_solver else 0
+    return triangle_bytes + block_bytes + solver_bytes
+
+def check_memory_budget(song_count : int, memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES, cost_scale=DISTANCE_COST_SCALE, for_solver=True) -> bool:
+    """Returns whether a distance matrix for the given number of songs fits in the memory budget."""
+    return get_distance_matrix_memory_bytes(song_count, cost_scale, for_solver) <= memory_budget_bytes
+
+class DistanceMatrix:
+    """A symmetric matrix of integer distances between songs, stored as a condensed upper triangle.
+       Rows and columns are in the same order as the SongFeatures the matrix was built from."""
+    song_count = 0
+    cost_scale = DISTANCE_COST_SCALE
+    triangle = None # 1D array of the cells above the diagonal, row by row
+
+    def __len__(self):
+        return self.song_count
+
+    def _get_triangle_index(self, row, column):
+        """Converts (row, column) pairs with row < column into positions in the triangle array."""
+        return row * self.song_count - (row * (row + 1)) // 2 + (column - row - 1)
+
+    def get(self, row : int, column : int) -> int:
+        """Returns the distance between two songs."""
+        if row == column:
+            return 0
+        if row > column:
+            row, column = column, row
+        return int(self.triangle[self._get_triangle_index(row, column)])
+
+    def get_pairs(self, rows, columns) -> numpy.ndarray:
+        """Returns the distances between each song in rows and the song at the same position in columns."""
+        rows, columns = numpy.broadcast_arrays(numpy.asarray(rows), numpy.asarray(columns))
+        lower_rows = numpy.minimum(rows, columns)
+        higher_columns = numpy.maximum(rows, columns)
+        on_diagonal = lower_rows == higher_columns
+        if len(self.triangle) == 0:
+            return numpy.zeros(rows.shape, dtype=self.triangle.dtype)
+        triangle_indices = numpy.where(on_diagonal, 0, self._get_triangle_index(lower_rows, higher_columns))
+        return numpy.where(on_diagonal, 0, self.triangle[triangle_indices]).astype(self.triangle.dtype)
+
+    def get_row(self, row : int, columns=None) -> numpy.ndarray:
+        """Returns the distances from one song to the given columns (defaults to every song)."""
+        if columns is None:
+            columns = numpy.arange(self.song_count)
+        return self.get_pairs(row, columns)
+
+    def get_path_cost(self, song_order) -> int:
+        """Returns the total distance of playing the songs in the given order (a list of row numbers)."""
+        song_order = numpy.asarray(song_order)
+        if len(song_order) < 2:
+            return 0
+        return int(self.get_pairs(song_order[:-1], song_order[1:]).astype(numpy.int64).sum())
+
+    def to_square(self) -> numpy.ndarray:
+        """Expands the matrix to a full (song_count x song_count) array."""
+        square = numpy.zeros((self.song_count, self.song_count), dtype=self.triangle.dtype)
+        upper_rows, upper_columns = numpy.triu_indices(self.song_count, k=1)
+        square[upper_rows, upper_columns] = self.triangle
+        square[upper_columns, upper_rows] = self.triangle
+        return square
+
+    def get_routing_rows(self) -> list:
+        """Returns the matrix as a list of row tuples for RoutingModel.RegisterTransitMatrix(),
+           with a dummy start node 0 that costs nothing to travel to or from.  Song i is node i + 1.
+           Cells reuse one shared int object per distinct cost, so the Python copy stays small."""
+        shared_costs = list(range(self.cost_scale + 1)) if self.triangle.dtype == numpy.uint16 else None
+        routing_rows = [tuple([0] * (self.song_count + 1))]
+        for row in range(self.song_count):
+            row_costs = [0] + self.get_row(row).tolist()
+            routing_rows.append(itemgetter(*row_costs)(shared_costs) if shared_costs is not None else tuple(row_costs))
+        return routing_rows
+
+class FeatureDistances:
+    """Distances between songs scored on the fly from their features instead of stored, for
+       playlists too large for a DistanceMatrix.  Works anywhere a DistanceMatrix is only read
+       through len(), get(), get_pairs(), get_row() and get_path_cost()."""
+    song_count = 0
+    cost_scale = DISTANCE_COST_SCALE
+    features = None # SongFeatures
+
+    def __init__(self, features : SongFeatures, cost_scale=DISTANCE_COST_SCALE):
+        self.song_count = len(features)
+        self.cost_scale = cost_scale
+        self.features = features
+
+    def __len__(self):
+        return self.song_count
+
+    def get(self, row : int, column : int) -> int:
+        """Returns the distance between two songs."""
+        if row == column:
+            return 0
+        return int(self.get_pairs(row, column))
+
+    def get_pairs(self, rows, columns) -> numpy.ndarray:
+        """Returns the distances between each song in rows and the song at the same position in columns."""
+        rows, columns = numpy.broadcast_arrays(numpy.asarray(rows), numpy.asarray(columns))
+        distances = get_scaled_distances(get_pair_similarity_scores(self.features, rows, columns), self.cost_scale).astype(get_cost_dtype(self.cost_scale))
+        return numpy.where(rows == columns, 0, distances).astype(distances.dtype)
+
+    def get_row(self, row : int, columns=None) -> numpy.ndarray:
+        """Returns the distances from one song to the given columns (defaults to every song)."""
+        if columns is None:
+            columns = numpy.arange(self.song_count)
+        return self.get_pairs(row, columns)
+
+    def get_path_cost(self, song_order) -> int:
+        """Returns the total distance of playing the songs in the given order (a list of row numbers)."""
+        song_order = numpy.asarray(song_order)
+        if len(song_order) < 2:
+            return 0
+        return int(self.get_pairs(song_order[:-1], song_order[1:]).astype(numpy.int64).sum())
+
+def get_scaled_distances(similarity_scores : numpy.ndarray, cost_scale=DISTANCE_COST_SCALE) -> numpy.ndarray:
+    """Inverts similarity scores into distances and rounds them to integers of the given scale."""
+    return numpy.rint((1.0 - similarity_scores) * cost_scale).clip(0, cost_scale)
+
+def build_distance_matrix(features : SongFeatures, cost_scale=DISTANCE_COST_SCALE, memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES, for_solver=True,
+                          distance_cache=None) -> DistanceMatrix:
+    """Scores every pair of songs and stores the integer distances in a DistanceMatrix.
+       Raises MemoryError if the matrix wouldn't fit in the memory budget.  If a DistanceCache
+       is given, cached distances are used instead of scoring those pairs again."""
+    song_count = len(features)
+    if not check_memory_budget(song_count, memory_budget_bytes, cost_scale, for_solver):
+        raise MemoryError("A distance matrix for " + str(song_count) + " songs needs about " + \
+                          str(get_distance_matrix_memory_bytes(song_count, cost_scale, for_solver) // (1024 * 1024)) + " MiB, " + \
+                          "which is over the memory budget of " + str(memory_budget_bytes // (1024 * 1024)) + " MiB. ")
+
+    if distance_cache is not None:
+        return distance_cache.build_distance_matrix(features, cost_scale)
+    return score_distance_matrix(features, cost_scale)
+
+def score_distance_matrix(features : SongFeatures, cost_scale=DISTANCE_COST_SCALE) -> DistanceMatrix:
+    """Scores every pair of songs into a DistanceMatrix, without checking the memory budget."""
+    song_count = len(features)
+    distance_matrix = DistanceMatrix()
+    distance_matrix.song_count = song_count
+    distance_matrix.cost_scale = cost_scale
+    distance_matrix.triangle = numpy.empty(song_count * (song_count - 1) // 2, dtype=get_cost_dtype(cost_scale))
+
+    # Score blocks of rows against the columns to their right, then copy each row's part of the upper triangle
+    for block_start in range(0, song_count, BUILD_BLOCK_ROWS):
+        block_end = min(block_start + BUILD_BLOCK_ROWS, song_count)
+        block_distances = get_scaled_distances(get_similarity_matrix(features, slice(block_start, block_end), slice(block_start, song_count)), cost_scale)
+        for row in range(block_start, block_end):
+            if row + 1 < song_count:
+                triangle_start = distance_matrix._get_triangle_index(row, row + 1)
+                distance_matrix.triangle[triangle_start:triangle_start + song_count - row - 1] = block_distances[row - block_start, row - block_start + 1:]
+    return distance_matrix
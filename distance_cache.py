@@ -0,0 +1,221 @@
+"""
+An on-disk cache of song distances, so sorting the same or overlapping playlists again only
+scores the pairs of songs that weren't scored before.
+
+Songs are identified by a fingerprint of their features (key, BPM and ratings), not by ID, so
+a song whose features or ratings change simply stops matching its old distances.  The cache is
+a set of blocks, each holding the fingerprints of the songs in one sorted playlist and the
+upper triangle of their distance matrix, in a raw file that is memory-mapped when read:
+
+    fingerprints: one uint64 per song
+    triangle:     the distances, row by row, in the cost type of the scale they were made with
+
+An SQLite index in the cache folder lists the blocks with the scoring version, cost scale and
+rating names they were made with (blocks made differently are never used) and when each was
+last used.  The least recently used blocks are removed when the cache grows over its size cap,
+and blocks whose songs are all in a newer block are removed right away.
+"""
+
+import hashlib, os, sqlite3, time, uuid
+
+import numpy
+
+from song_model import USER_RATINGS
+from scoring import SCORING_VERSION, SongFeatures, get_pair_similarity_scores
+from distance import BUILD_BLOCK_ROWS, DISTANCE_COST_SCALE, DistanceMatrix, get_cost_dtype, get_scaled_distances, score_distance_matrix
+
+DISTANCE_CACHE_DIRECTORY = 'distance_cache'
+DISTANCE_CACHE_INDEX_FILE = 'index.db'
+# Default size cap for all blocks together
+DEFAULT_DISTANCE_CACHE_BYTES = 256 * 1024 * 1024
+# Most pairs of songs to score at once, to keep temporary arrays small
+SCORE_CHUNK_PAIRS = 1024 * 1024
+
+def get_feature_fingerprints(features : SongFeatures) -> numpy.ndarray:
+    """Returns a uint64 fingerprint of each song's features.  Songs with the same features get
+       the same fingerprint."""
+    rows = numpy.zeros(len(features), dtype=[('camelot_position', '<i8'), ('camelot_is_minor', '?'), ('bpm', '<f8'),
+                                             ('user_ratings', '<i8', (features.user_ratings.shape[1],))])
+    rows['camelot_position'] = features.camelot_positions
+    rows['camelot_is_minor'] = features.camelot_is_minor
+    rows['bpm'] = features.bpms
+    rows['user_ratings'] = features.user_ratings
+    return numpy.array([int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), 'little') for row in rows], dtype=numpy.uint64)
+
+def get_scoring_key(cost_scale=DISTANCE_COST_SCALE) -> str:
+    """Describes how distances are made, so that blocks made another way aren't used."""
+    return "v" + str(SCORING_VERSION) + " scale " + str(cost_scale) + " ratings " + ",".join(USER_RATINGS)
+
+def get_positions(block_fingerprints : numpy.ndarray, fingerprints : numpy.ndarray) -> numpy.ndarray:
+    """Returns the position of each fingerprint in a block, or -1 if the block doesn't have it."""
+    sorted_positions = numpy.argsort(block_fingerprints, kind='stable')
+    sorted_fingerprints = block_fingerprints[sorted_positions]
+    found_at = numpy.minimum(numpy.searchsorted(sorted_fingerprints, fingerprints), len(sorted_fingerprints) - 1)
+    return numpy.where(sorted_fingerprints[found_at] == fingerprints, sorted_positions[found_at], -1)
+
+class DistanceCache:
+    """Distance blocks in a folder, used in place of scoring every pair when building a
+       DistanceMatrix.  max_bytes caps the size of all blocks together."""
+    directory = None
+    connection = None
+    max_bytes = DEFAULT_DISTANCE_CACHE_BYTES
+
+    def __init__(self, directory=DISTANCE_CACHE_DIRECTORY, max_bytes=DEFAULT_DISTANCE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, DISTANCE_CACHE_INDEX_FILE))
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS blocks (file_name TEXT PRIMARY KEY, scoring_key TEXT NOT NULL, " + \
+                                    "song_count INTEGER NOT NULL, cost_dtype TEXT NOT NULL, byte_count INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self._remove_unindexed_files()
+
+    def get_byte_count(self) -> int:
+        """Returns the size of all blocks together."""
+        return self.connection.execute("SELECT COALESCE(SUM(byte_count), 0) FROM blocks").fetchone()[0]
+
+    def _remove_unindexed_files(self):
+        """Removes block files left behind by a save or removal that was interrupted."""
+        indexed_files = {file_name for file_name, in self.connection.execute("SELECT file_name FROM blocks")}
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("block_") and file_name not in indexed_files:
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except OSError:
+                    pass # Still open somewhere (on Windows); try again next time
+
+    def _open_block(self, file_name : str, song_count : int, cost_dtype : str) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Maps a block's fingerprints and triangle read-only."""
+        path = os.path.join(self.directory, file_name)
+        fingerprints = numpy.memmap(path, dtype=numpy.uint64, mode='r', shape=(song_count,))
+        triangle = numpy.memmap(path, dtype=numpy.dtype(cost_dtype), mode='r', offset=song_count * 8, shape=(song_count * (song_count - 1) // 2,))
+        return fingerprints, triangle
+
+    def build_distance_matrix(self, features : SongFeatures, cost_scale=DISTANCE_COST_SCALE) -> DistanceMatrix:
+        """Builds a DistanceMatrix for the given songs from the cached distances, scoring only
+           the pairs that aren't cached, then saves it as a block for next time."""
+        song_count = len(features)
+        distance_matrix = DistanceMatrix()
+        distance_matrix.song_count = song_count
+        distance_matrix.cost_scale = cost_scale
+        distance_matrix.triangle = numpy.zeros(song_count * (song_count - 1) // 2, dtype=get_cost_dtype(cost_scale))
+        if song_count < 2:
+            return distance_matrix
+        fingerprints = get_feature_fingerprints(features)
+        scoring_key = get_scoring_key(cost_scale)
+
+        # Copy distances from the most recently used blocks first
+        is_filled = numpy.zeros(len(distance_matrix.triangle), dtype=bool)
+        used_blocks = []
+        replaced_blocks = []
+        for file_name, block_song_count, cost_dtype in self.connection.execute("SELECT file_name, song_count, cost_dtype FROM blocks " + \
+                                                                              "WHERE scoring_key = ? ORDER BY last_used DESC", (scoring_key,)).fetchall():
+            try:
+                block_fingerprints, block_triangle = self._open_block(file_name, block_song_count, cost_dtype)
+            except (OSError, ValueError):
+                replaced_blocks.append(file_name) # Missing or cut short, so remove it with the next save
+                continue
+            if numpy.isin(block_fingerprints, fingerprints).all():
+                replaced_blocks.append(file_name)
+            if not is_filled.all() and self._copy_block_distances(distance_matrix, is_filled, get_positions(numpy.array(block_fingerprints), fingerprints),
+                                                                    block_triangle, block_song_count):
+                used_blocks.append(file_name)
+            del block_fingerprints, block_triangle
+
+        # Score the rest, a chunk of pairs at a time (or all at once, if no block had any)
+        unfilled_indices = numpy.flatnonzero(~is_filled)
+        scored_new_pairs = len(unfilled_indices) > 0
+        if len(used_blocks) == 0:
+            distance_matrix = score_distance_matrix(features, cost_scale)
+        elif len(unfilled_indices) > 0:
+            row_starts = distance_matrix._get_triangle_index(numpy.arange(song_count), numpy.arange(song_count) + 1)
+            scored_new_pairs = False
+            for chunk_start in range(0, len(unfilled_indices), SCORE_CHUNK_PAIRS):
+                chunk_indices = unfilled_indices[chunk_start:chunk_start + SCORE_CHUNK_PAIRS]
+                rows = numpy.searchsorted(row_starts, chunk_indices, side='right') - 1
+                columns = chunk_indices - row_starts[rows] + rows + 1
+                distance_matrix.triangle[chunk_indices] = get_scaled_distances(get_pair_similarity_scores(features, rows, columns), cost_scale)
+                # Pairs of songs with the same features can't be cached, so they don't need a new block
+                scored_new_pairs = scored_new_pairs or bool((fingerprints[rows] != fingerprints[columns]).any())
+            if scored_new_pairs:
+                print("Scored " + str(len(unfilled_indices)) + " song pairs that weren't in the distance cache. ")
+
+        with self.connection:
+            self.connection.executemany("UPDATE blocks SET last_used = ? WHERE file_name = ?", [(time.time(), file_name) for file_name in used_blocks])
+        if scored_new_pairs or len(used_blocks) > 1:
+            self._save_block(scoring_key, fingerprints, distance_matrix.triangle, replaced_blocks)
+        return distance_matrix
+
+    def _copy_block_distances(self, distance_matrix : DistanceMatrix, is_filled : numpy.ndarray, positions : numpy.ndarray,
+                              block_triangle : numpy.ndarray, block_song_count : int) -> bool:
+        """Copies the distances between songs found in a block (at positions, -1 if not found)
+           into the unfilled cells of a matrix.  Returns whether any were copied."""
+        present_rows = numpy.flatnonzero(positions >= 0)
+        if len(present_rows) < 2:
+            return False
+        # Where each row starts in the matrix's and the block's triangles
+        row_starts = distance_matrix._get_triangle_index(numpy.arange(distance_matrix.song_count), numpy.arange(distance_matrix.song_count) + 1)
+        block_row_starts = numpy.arange(block_song_count) * block_song_count - (numpy.arange(block_song_count) * (numpy.arange(block_song_count) + 1)) // 2
+        copied_any = False
+        for block_start in range(0, len(present_rows), BUILD_BLOCK_ROWS):
+            rows = present_rows[block_start:block_start + BUILD_BLOCK_ROWS, numpy.newaxis]
+            columns = present_rows[numpy.newaxis, block_start + 1:]
+            is_pair = columns > rows
+            rows, columns = numpy.broadcast_to(rows, is_pair.shape)[is_pair], numpy.broadcast_to(columns, is_pair.shape)[is_pair]
+            triangle_indices = row_starts[rows] + (columns - rows - 1)
+            row_positions, column_positions = positions[rows], positions[columns]
+            # Songs with the same features share a position, and the block has no distance between them
+            is_new = (row_positions != column_positions) & ~is_filled[triangle_indices]
+            if not is_new.any():
+                continue
+            if not is_new.all():
+                triangle_indices, row_positions, column_positions = triangle_indices[is_new], row_positions[is_new], column_positions[is_new]
+            lower_positions = numpy.minimum(row_positions, column_positions)
+            higher_positions = numpy.maximum(row_positions, column_positions)
+            distance_matrix.triangle[triangle_indices] = block_triangle[block_row_starts[lower_positions] + (higher_positions - lower_positions - 1)]
+            is_filled[triangle_indices] = True
+            copied_any = True
+        return copied_any
+
+    def _save_block(self, scoring_key : str, fingerprints : numpy.ndarray, triangle : numpy.ndarray, replaced_blocks : list):
+        """Saves a new block, removes the blocks it replaces, then removes the least recently used
+           blocks until the cache fits under its size cap.  Blocks bigger than the cap aren't saved."""
+        byte_count = fingerprints.nbytes + triangle.nbytes
+        if byte_count > self.max_bytes:
+            return
+        file_name = "block_" + uuid.uuid4().hex + ".bin"
+        block_file = open(os.path.join(self.directory, file_name), "wb")
+        block_file.write(fingerprints.astype('<u8').tobytes())
+        block_file.write(triangle.tobytes())
+        block_file.flush()
+        os.fsync(block_file.fileno())
+        block_file.close()
+        with self.connection:
+            self.connection.execute("INSERT INTO blocks (file_name, scoring_key, song_count, cost_dtype, byte_count, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                                    (file_name, scoring_key, len(fingerprints), triangle.dtype.str, byte_count, time.time()))
+        removed_blocks = list(replaced_blocks)
+        total_bytes = self.get_byte_count()
+        for old_file_name, old_byte_count in self.connection.execute("SELECT file_name, byte_count FROM blocks WHERE file_name != ? ORDER BY last_used", (file_name,)).fetchall():
+            if old_file_name in replaced_blocks:
+                total_bytes -= old_byte_count
+            elif total_bytes > self.max_bytes:
+                removed_blocks.append(old_file_name)
+                total_bytes -= old_byte_count
+        self.remove_blocks(removed_blocks)
+
+    def remove_blocks(self, file_names : list):
+        """Removes blocks from the index, then deletes their files."""
+        with self.connection:
+            self.connection.executemany("DELETE FROM blocks WHERE file_name = ?", [(file_name,) for file_name in file_names])
+        for file_name in file_names:
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass # Removed when the cache is next opened
+
+    def clear(self):
+        """Removes every block."""
+        self.remove_blocks([file_name for file_name, in self.connection.execute("SELECT file_name FROM blocks")])
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,174 @@
+"""
+A memory-mapped file of every stored song's numeric features, for sorting without loading songs.
+
+The file is a flat array of fixed-size rows (see get_feature_dtype()) with no header, so it can
+be opened with numpy.memmap and read straight away, and concurrent sorts share the OS page cache.
+The song store's database holds the index from song ID to row, and what layout the file uses.
+Rows are rewritten in place when a song changes and appended for new songs, so keeping the file
+up to date costs about as much as saving the changed songs.  Removed songs leave unused rows
+behind until the file is compacted.
+
+The file is marked out of date in the same commit that saves songs (and before any other
+write), and up to date again in the commit that indexes their rows, so if a save is
+interrupted in between, the store sees that the file is out of date and rebuilds it.
+"""
+
+import os, sqlite3
+
+import numpy
+
+SONG_FEATURES_FILE = 'song_features.bin'
+# Compact the file when at least this share of its rows are unused, and at least this many
+COMPACTION_UNUSED_ROW_SHARE = 0.25
+COMPACTION_MIN_UNUSED_ROWS = 1024
+# Most song IDs to look up in one query, below SQLite's limit on query parameters
+INDEX_QUERY_BLOCK_SIZE = 500
+
+def get_feature_dtype(rating_count : int) -> numpy.dtype:
+    """Returns the layout of one row.  is_set is False for unused rows."""
+    return numpy.dtype([('is_set', '?'), ('camelot_position', 'i1'), ('camelot_is_minor', '?'),
+                        ('bpm', '<f8'), ('user_ratings', 'i1', (rating_count,))])
+
+class FeatureFile:
+    """The feature rows of the songs in a song store.  Songs need camelot_position,
+       camelot_is_minor, bpm and user_ratings members, with ratings in an array named
+       rating_numbers (as in SongRatings) holding no_rating for ratings not given."""
+    path = None
+    connection = None # The song store's sqlite3 connection, which holds the row index
+    dtype = None
+    no_rating = None
+
+    def __init__(self, connection : sqlite3.Connection, rating_count : int, no_rating : int, path=SONG_FEATURES_FILE):
+        self.path = path
+        self.connection = connection
+        self.dtype = get_feature_dtype(rating_count)
+        self.no_rating = no_rating
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS feature_rows (yt_id TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+
+    def get_row_count(self) -> int:
+        """Returns the number of rows in the file, including unused rows."""
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // self.dtype.itemsize
+
+    def get_layout(self) -> str:
+        """Describes the row layout, so a file written with a different layout can be detected."""
+        return str(self.dtype.descr)
+
+    def is_up_to_date(self) -> bool:
+        """Returns whether the file exists, matches the index and has the current layout."""
+        row = self.connection.execute("SELECT value FROM store_info WHERE name = 'feature_file_layout'").fetchone()
+        return os.path.exists(self.path) and row is not None and row[0] == self.get_layout()
+
+    def mark_out_of_date(self):
+        """Marks the file out of date, as part of the connection's current transaction."""
+        self.connection.execute("INSERT OR REPLACE INTO store_info (name, value) VALUES ('feature_file_layout', '')")
+
+    def _mark_up_to_date(self):
+        self.connection.execute("INSERT OR REPLACE INTO store_info (name, value) VALUES ('feature_file_layout', ?)", (self.get_layout(),))
+
+    def pack_rows(self, songs : list) -> numpy.ndarray:
+        """Returns the feature rows of the given songs."""
+        rows = numpy.zeros(len(songs), dtype=self.dtype)
+        rows['is_set'] = True
+        rows['bpm'] = numpy.nan
+        rows['user_ratings'] = self.no_rating
+        for row, song in enumerate(songs):
+            if song.camelot_position is not None and song.camelot_is_minor is not None:
+                rows['camelot_position'][row] = song.camelot_position
+                rows['camelot_is_minor'][row] = song.camelot_is_minor
+            if song.bpm is not None:
+                rows['bpm'][row] = song.bpm
+            if song.user_ratings is not None:
+                rows['user_ratings'][row] = song.user_ratings.rating_numbers
+        return rows
+
+    def get_rows(self, song_ids : list) -> numpy.ndarray:
+        """Returns the row of each song ID, or -1 for songs without one."""
+        row_for_id = dict()
+        for block_start in range(0, len(song_ids), INDEX_QUERY_BLOCK_SIZE):
+            block = song_ids[block_start:block_start + INDEX_QUERY_BLOCK_SIZE]
+            row_for_id.update(self.connection.execute("SELECT yt_id, row FROM feature_rows WHERE yt_id IN (" + ", ".join(["?"] * len(block)) + ")", block).fetchall())
+        return numpy.array([row_for_id.get(song_id, -1) for song_id in song_ids], dtype=numpy.int64)
+
+    def write_songs(self, songs_by_id : dict):
+        """Writes the rows of the given songs, adding rows for new songs, then records them in
+           the index in one commit."""
+        if len(songs_by_id) == 0:
+            return
+        with self.connection:
+            self.mark_out_of_date()
+        song_ids = list(songs_by_id)
+        rows = self.get_rows(song_ids)
+        new_songs = rows == -1
+        rows[new_songs] = self.get_row_count() + numpy.arange(numpy.count_nonzero(new_songs))
+        packed_rows = self.pack_rows([songs_by_id[song_id] for song_id in song_ids])
+        feature_file = open(self.path, "r+b" if os.path.exists(self.path) else "w+b")
+        for row, packed_row in sorted(zip(rows.tolist(), packed_rows), key=lambda row_and_packed_row : row_and_packed_row[0]):
+            feature_file.seek(row * self.dtype.itemsize)
+            feature_file.write(packed_row.tobytes())
+        feature_file.flush()
+        os.fsync(feature_file.fileno())
+        feature_file.close()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO feature_rows (yt_id, row) VALUES (?, ?)",
+                                        [(song_id, row) for song_id, row, is_new in zip(song_ids, rows.tolist(), new_songs.tolist()) if is_new])
+            self._mark_up_to_date()
+
+    def remove_songs(self, song_ids : list):
+        """Removes songs from the index and marks their rows unused."""
+        rows = self.get_rows(list(song_ids))
+        rows = rows[rows >= 0]
+        with self.connection:
+            self.connection.executemany("DELETE FROM feature_rows WHERE yt_id = ?", [(song_id,) for song_id in song_ids])
+        if len(rows) > 0:
+            features = numpy.memmap(self.path, dtype=self.dtype, mode='r+')
+            features['is_set'][rows] = False
+            features.flush()
+            del features
+
+    def rebuild(self, songs_by_id : dict):
+        """Writes a new file holding only the given songs, and replaces the index to match."""
+        song_ids = list(songs_by_id)
+        self._replace(song_ids, self.pack_rows([songs_by_id[song_id] for song_id in song_ids]))
+
+    def compact(self, force=False) -> bool:
+        """Rewrites the file without unused rows if there are enough of them (or if forced).
+           Returns whether it was rewritten."""
+        indexed_rows = self.connection.execute("SELECT yt_id, row FROM feature_rows ORDER BY row").fetchall()
+        unused_row_count = self.get_row_count() - len(indexed_rows)
+        if not force and (unused_row_count < COMPACTION_MIN_UNUSED_ROWS or unused_row_count < COMPACTION_UNUSED_ROW_SHARE * self.get_row_count()):
+            return False
+        features = self.open_memmap()
+        packed_rows = numpy.array(features[[row for _, row in indexed_rows]]) if len(indexed_rows) > 0 else numpy.zeros(0, dtype=self.dtype)
+        del features
+        try:
+            self._replace([song_id for song_id, _ in indexed_rows], packed_rows)
+        except PermissionError:
+            # Windows can't replace a file while another program has it mapped, so try again next time
+            return False
+        return True
+
+    def _replace(self, song_ids : list, packed_rows : numpy.ndarray):
+        """Writes a new file of the given rows, then swaps it in and indexes the songs by row."""
+        with self.connection:
+            self.mark_out_of_date()
+        new_path = self.path + '.new'
+        new_file = open(new_path, "wb")
+        new_file.write(packed_rows.tobytes())
+        new_file.flush()
+        os.fsync(new_file.fileno())
+        new_file.close()
+        os.replace(new_path, self.path)
+        with self.connection:
+            self.connection.execute("DELETE FROM feature_rows")
+            self.connection.executemany("INSERT INTO feature_rows (yt_id, row) VALUES (?, ?)", [(song_id, row) for row, song_id in enumerate(song_ids)])
+            self._mark_up_to_date()
+
+    def open_memmap(self) -> numpy.ndarray:
+        """Maps the file read-only, returning a structured array with a row per song (or an
+           empty array if there are no rows yet)."""
+        if self.get_row_count() == 0:
+            return numpy.zeros(0, dtype=self.dtype)
+        return numpy.memmap(self.path, dtype=self.dtype, mode='r', shape=(self.get_row_count(),))
@@ -1,287 +1,66 @@
 # Basic Python imports
 import glob, json, pickle, os, re, sys, time
 
-from functools import total_ordering
-from typing import Callable
-
-# Library imports for API access
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from ytmusicapi import YTMusic
+# API clients are set up on first use (see api_clients), so importing this doesn't touch the network
+from api_clients import API_SCHEDULER, SP, SPOTIFY_AUTH_FILE, YTM, YTM_AUTH_FILE, connect_API_clients, get_API_error_hint, \
+                        run_API_request, submit_API_request
+from api_scheduler import SERVICE_SPOTIFY, SERVICE_YTM
+from feature_file import SONG_FEATURES_FILE
+from prompts import prompt_user_for_bool
+from song_model import CAMELOT_POSITIONS, DEPRECATED_RATINGS, MAX_BPM, MIN_BPM, RATING_COLUMNS, USER_RATINGS, Playlist, Song, \
+                       SongRatings, set_slots_from_state
+from song_records import NO_RATING
+from song_store import SONG_STORE_FILE, LazyPlaylists, LazySongCache, SongStore
 
 """
 Global variables and init functions
 """
 
-# A dictionary of user-ratable traits for each song, where each key is a trait/category
-# and each value is an explanation.  Capitalize strings correctly for UI display.  
-# Can be updated by adding new rating fields and/or moving out deprecated fields.  
-# Ratings are presumed to go from +2 (strongly matches category) to -2 (extreme opposite of category)
-# TODO: Ideas: Frission?  Boppable (but that's basicaly drive)?
-USER_RATINGS = {'Positivity' : 'Hopeful and optimistic, or regretful and pessimistic.',
-                'Drive' : 'Driving and forceful, or unhurried and gentle.',
-                'Presence' : 'Captivating and focused, or detached and distant.',
-                'Complexity' : 'Crowded and busy, or simple and manageable.'}
-
-# Deprecated ratings can be moved here so program will prompt users to re-rate accordingly
-DEPRECATED_RATINGS = {}
-
 # Maximum different in time between YouTube Music and Spotify.
 # Keep in mind that YouTube music durations are in seconds and Spotify is accurate to milliseconds.  
 MAX_SONG_TIME_DIFFERENCE = 2
 
-# File names and extensions
+# File names and extensions.  Playlist files are from older versions and are imported into the song store.
 PLAYLIST_FILE_PREFIX = 'playlist_'
 PLAYLIST_FILE_EXTENSION = '.ytp'
 """
 Song metadata, including user-generated ratings and basic metadata from music services.
 This cache has no expiration because at any time, a user may wish to sort different playlists 
 with overlapping sets of songs.  I want to avoid spamming 1000+ requests unless necessary.  
+Songs are saved in the song store (SONG_STORE_FILE), which keeps their numeric features in a
+memory-mapped file (SONG_FEATURES_FILE) too.  The old single-pickle cache file is only read
+once, to import it into the store.
 """
 SONG_METADATA_CACHE_FILE = 'cached_song_metadata.yts'
-YTM_AUTH_FILE = 'headers_auth.json'
-SPOTIFY_AUTH_FILE = 'spotify.json'
 
-# Constants for logic
-CAMELOT_POSITIONS = 12
-MIN_BPM = 90 # Inclusive
-MAX_BPM = 180 # Exclusive
-assert MIN_BPM * 2 == MAX_BPM, "BPM range is invalid"
+# Spotify pitch classes (0 is C, 1 is C sharp, etc.) and their camelot wheel position numbers,
+# as tuples of (position for major key, position for minor key)
+SPOTIFY_KEY_TO_CAMELOT = {
+    0: (8, 5),
+    1: (3, 12),
+    2: (10, 7),
+    3: (5, 2),
+    4: (12, 9),
+    5: (7, 4),
+    6: (2, 11),
+    7: (9, 6),
+    8: (4, 1),
+    9: (11, 8),
+    10: (6, 3),
+    11: (1, 10)
+}
+# Most track IDs that Spotify's audio features endpoint takes in one request
+SPOTIFY_FEATURES_BATCH_SIZE = 100
 
 # Check Python version on init because this uses ordered dicts
 MIN_PYTHON = (3, 6)
 if sys.version_info < MIN_PYTHON:
     sys.exit("Python %s.%s or later is required.\n" % MIN_PYTHON)
 
-# TODO: Allow user to specify [a]bort
-def prompt_user_for_bool(message:str, allow_no_response = False) -> bool:
-    """Prompts the user to respond to a message with 'y' or 'n', or optionally no response"""
-    user_input = None
-    input_options_string = "[y]es/[n]o/[empty]" if allow_no_response else "[y]es/[n]o"
-    while user_input != 'y' and user_input != 'n' and not (allow_no_response and user_input == ""):
-        user_input = input(message + "(" + input_options_string + "): ")
-    if user_input == 'y':
-        return True
-    if user_input == 'n':
-        return False
-    return None
-
 print("Starting playlist optimizer libraries and foundation functions.")
-if not prompt_user_for_bool(message="Okay to access Spotify API and emulate a YouTube Music client? ", allow_no_response=False):
-    sys.exit("Permission denied, aborting.\n")
-
-# Init YouTube Music library
-if not os.path.exists(YTM_AUTH_FILE):
-    print("YouTube Music header file not found. Starting setup; follow the instructions at https://ytmusicapi.readthedocs.io/en/latest/setup.html")
-    YTMusic.setup(filepath=YTM_AUTH_FILE)
-YTM = YTMusic(YTM_AUTH_FILE)
-
-# Load Spotify creds from JSON file and init "Spotipy" library
-spotify_creds_file = None
-spotify_creds = {}
-try:
-    # Try loading existing file
-    spotify_creds_file = open('./' + SPOTIFY_AUTH_FILE, "rt")
-    spotify_creds = json.load(spotify_creds_file)
-    spotify_creds_file.close()
-except FileNotFoundError:
-    # File does not exist, write a new one
-    spotify_creds_file = open('./' + SPOTIFY_AUTH_FILE, "xt")
-    spotify_creds_file.write("{}")
-    spotify_creds_file.close()
-except json.JSONDecodeError:
-    spotify_creds_file.close()
-    sys.exit("Spotify credential file\"" + SPOTIFY_AUTH_FILE + "\" could not be read, exiting. Consider moving/deleting it so a new file can be put in its place. \n")
-
-# Validate fields in config file
-spotify_cred_fields = ["client_id", "client_secret", "redirect_uri"]
-spotify_creds_file_needs_update = False
-for spotify_field in spotify_cred_fields:
-    if spotify_field not in spotify_creds:
-        spotify_creds[spotify_field] = ""
-        spotify_creds_file_needs_update = True
-if spotify_creds_file_needs_update:
-    spotify_creds_file = open('./' + SPOTIFY_AUTH_FILE, "wt")
-    json.dump(spotify_creds, spotify_creds_file)
-    spotify_creds_file.close()
-    print("Please put Spotify API credentials into \"" + SPOTIFY_AUTH_FILE + "\". ")
-    print("Get/create credentials at https://developer.spotify.com/dashboard/applications and set the redirect URI to http://localhost")
-    print(" or if using another URL, use your browser's Developer Tools to capture the redirect URL. ")
-    sys.exit("Please relaunch after updating credentials. \n")
-
-SP = spotipy.Spotify(auth_manager=SpotifyOAuth(client_id=spotify_creds["client_id"],
-                                               client_secret=spotify_creds["client_secret"],
-                                               redirect_uri=spotify_creds["redirect_uri"],
-                                               scope="user-library-read"))
-
-LAST_OP_TIME = time.time()
-TIME_BETWEEN_OPS = DEFAULT_TIME_BETWEEN_OPS = 1
-OPS_SINCE_BACKOFF = 0
-OPS_TO_RESTORE_BACKOFF = 2
-OPS_TO_INCREASE_BACKOFF = 2
-MAX_TIME_MULTIPLIER = 16
-TIME_MULTIPLICATION_FACTOR = 4
-def run_API_request(operation : Callable, description="an unknown web request"):
-    """Runs a lamba (presumably containing an API call) and returns its result.
-       Keeps a rate limit and backs off upon exceptions."""
-    global LAST_OP_TIME, TIME_BETWEEN_OPS, OPS_SINCE_BACKOFF, DEFAULT_TIME_BETWEEN_OPS, OPS_TO_RESTORE_BACKOFF, MAX_TIME_MULTIPLIER
-    attempt_count = 0
-
-    # Check if it's safe to try faster requests
-    if TIME_BETWEEN_OPS != DEFAULT_TIME_BETWEEN_OPS and OPS_SINCE_BACKOFF >= OPS_TO_RESTORE_BACKOFF:
-        TIME_BETWEEN_OPS = TIME_BETWEEN_OPS / TIME_MULTIPLICATION_FACTOR
-        OPS_SINCE_BACKOFF = 0
-
-    # Run the operation, retrying on exceptions
-    result = None
-    while result is None:
-        try:
-            remaining_time = (LAST_OP_TIME + TIME_BETWEEN_OPS) - time.time()
-            if remaining_time > 0:
-                time.sleep(remaining_time)
-            LAST_OP_TIME = time.time()
-            attempt_count = attempt_count + 1
-
-            result = operation()
-            OPS_SINCE_BACKOFF = OPS_SINCE_BACKOFF + 1
-            if result is None:
-                raise Exception("Invalid response received")
-        except Exception as error:
-            print("Error encountered while attempting " + description + ". ")
-            if TIME_BETWEEN_OPS == DEFAULT_TIME_BETWEEN_OPS * MAX_TIME_MULTIPLIER:
-                break
-            if attempt_count >= OPS_TO_INCREASE_BACKOFF:
-                attempt_count = 0
-                TIME_BETWEEN_OPS = TIME_BETWEEN_OPS * TIME_MULTIPLICATION_FACTOR
-                print("Temporarily spacing out requests by " + str(TIME_BETWEEN_OPS) + " seconds... ")
-            OPS_SINCE_BACKOFF = 0
-            if "Unauthorized" in str(error) or type(error) in [spotipy.oauth2.SpotifyOauthError, spotipy.oauth2.SpotifyStateError]:
-                print("This may be an authorization error, so consider removing the authorization file to set up again. ")
-    if result is None:
-        print("Exceeded retries. Continuing... ")
-    return result
-
-"""
-Global classes
-"""
-
-class Playlist:
-    """A YouTube Music playlist containing songs"""
-    name = None
-    song_ids = None # list of strs
-    yt_id = None
-    order_ids = None # list of strs
-
-@total_ordering
-class Song:
-    """A song (presumably shared between YouTube Music and Spotify)"""
-    # Members are referenced by strings in dict metadata_fields in download_song_features(), 
-    # so update that dict when changing member names here. 
-    album = None
-    artist = None
-    name = None
-    duration_s = None # integer
-
-    yt_id = None
-    spotify_id = None
-    spotify_preview_url = None
-    metadata_needs_review = None # None if not downloaded, false if all downloaded, true if downloaded with error
-    is_private = None
-
-    camelot_position = None
-    camelot_is_minor = None
-    bpm = None
-
-    user_ratings = None # Can't be empty dict() or pickling will consolidate all songs' ratings into one instance
-
-    def has_latest_ratings(self):
-        global USER_RATINGS
-        if self.user_ratings is None:
-            return False
-        for trait in USER_RATINGS:
-            if trait not in self.user_ratings or self.user_ratings[trait] == None:
-                return False
-        return True
-
-    def set_bpm(self, bpm : float):
-        if bpm is not None:
-            assert bpm is None or bpm > 0, "BPM must be a positive value"
-            # Keep BPM in the same range/scale
-            while bpm < MIN_BPM:
-                bpm = bpm * 2
-            while bpm >= MAX_BPM:
-                bpm = bpm / 2
-        self.bpm = bpm
-
-    def set_camelot_position(self, camelot_position : int):
-        assert camelot_position is None or 1 <= camelot_position <= CAMELOT_POSITIONS, "Camelot wheel position is invalid"
-        self.camelot_position = camelot_position
-
-    def set_user_rating(self, rating_name : str, rating_number : int):
-        assert rating_number is None or -2 <= rating_number <= 2, "Rating is not between -2 and +2"
-        self.user_ratings[rating_name] = rating_number
-
-    def __lt__(self, other) -> bool:
-        # Ensure other object is a Song
-        if not isinstance(other, Song):
-            return False
-
-        # Priority one: YT ID known
-        if self.yt_id is None and other.yt_id is not None:
-            return True
-
-        # Priority two: Metadata doesn't need review
-        # or we at least know if it needs review (i.e. is set)
-        if self.metadata_needs_review == True and other.metadata_needs_review == False or\
-           self.metadata_needs_review is None and other.metadata_needs_review is not None:
-            return True
-
-        # Priority three: Basic metadata known (including Spotify ID)
-        def get_missing_metadata_count(target_song_obj, field_names):
-            missing_field_count = 0
-            for field_name in field_names:
-                if getattr(target_song_obj, field_name) is None:
-                    missing_field_count = missing_field_count + 1
-            return missing_field_count
-
-        basic_fields = ['album', 'artist', 'name', 'duration_s', 'spotify_id']
-        if get_missing_metadata_count(self, basic_fields) > get_missing_metadata_count(other, basic_fields):
-            return True
-
-        # Priority four: Advanced "feature" metadata known
-        advanced_fields = ['camelot_position', 'camelot_is_minor', 'bpm']
-        if get_missing_metadata_count(self, advanced_fields) > get_missing_metadata_count(other, advanced_fields):
-            return True
-
-        # Priority five: Rated with as many current keys as possible
-        def get_ratings_count(target_ratings_dict):
-            ratings_count = 0
-            for rating_name in USER_RATINGS:
-                if rating_name in target_ratings_dict and target_ratings_dict[rating_name] is not None:
-                    ratings_count = ratings_count + 1
-            return ratings_count
-        return get_ratings_count(self.user_ratings) < get_ratings_count(other.user_ratings)
-
-    def __eq__(self, other) -> bool:
-        # Ensure other object is a Song
-        if not isinstance(other, Song):
-            return False
-
-        # Check all basic fields (i.e. all fields with a few exceptions)
-        basic_fields = dir(Song)
-        basic_fields.remove('user_ratings')
-        #basic_fields.remove('owning_playlists')
-        for member_name in basic_fields:
-            if getattr(self, member_name) != getattr(other, member_name):
-                return False
-    
-        # Check user ratings, ignoring deprecated ratings
-        for rating_name in USER_RATINGS:
-            if (rating_name in self.user_ratings != rating_name in other.user_ratings) or (self.user_ratings[rating_name] != other.user_ratings[rating_name]):
-                return False
 
-        # Ignore owning playlists since that just relates to 
-        return True
+# Opened by get_song_store()
+SONG_STORE = None
 
 """
 Global funtions
@@ -301,6 +80,78 @@ def download_metadata_from_YT_id(id:str) -> Song:
         print("Song \"" + local_song.name + "\" returned a different id (" + local_song.yt_id + ") than the one used to look it up (" + id + "). Ignoring the returned id. ")
     return local_song
 
+def apply_spotify_features(song:Song, features:dict):
+    """Sets a Song's BPM and key from one track of a Spotify audio features response.
+       Flags the song for review if Spotify had no features or no key for it."""
+    if features is None:
+        song.metadata_needs_review = True
+        return
+    song.set_bpm(float(features['tempo']))
+
+    # Validate Spotify pitch class then convert to camelot wheel position number
+    if features['key'] == -1:
+        print("Spotify omitted the musical key for " + str(song.name) + " " + str(song.artist))
+        song.metadata_needs_review = True
+    else:
+        if features['mode'] == 1:
+            song.camelot_position, _ = SPOTIFY_KEY_TO_CAMELOT[features['key']]
+            song.camelot_is_minor = False
+        else:
+            _, song.camelot_position = SPOTIFY_KEY_TO_CAMELOT[features['key']]
+            song.camelot_is_minor = True
+        if song.metadata_needs_review is None:
+            song.metadata_needs_review = False
+
+def download_spotify_features(songs:list[Song]):
+    """Looks up Spotify musical features for every Song that has a Spotify ID, up to
+       SPOTIFY_FEATURES_BATCH_SIZE songs per request, and applies them to each Song.
+       All batches are requested at once, so they can be in flight together within Spotify's rate limit."""
+    songs_with_ids = [song for song in songs if song.spotify_id is not None]
+    batches = []
+    for batch_start in range(0, len(songs_with_ids), SPOTIFY_FEATURES_BATCH_SIZE):
+        batch = songs_with_ids[batch_start:batch_start + SPOTIFY_FEATURES_BATCH_SIZE]
+        batch_ids = [song.spotify_id for song in batch]
+        description = "to look up Spotify musical features for track ID " + batch_ids[0] if len(batch_ids) == 1 else \
+                      "to look up Spotify musical features for " + str(len(batch_ids)) + " tracks"
+        batches.append((batch, submit_API_request(lambda batch_ids=batch_ids : SP.audio_features(tracks=batch_ids), description, SERVICE_SPOTIFY)))
+
+    for batch, batch_future in batches:
+        batch_features = batch_future.result()
+        if batch_features is None:
+            batch_features = [None] * len(batch)
+        # Spotify returns features in the same order as the IDs, with None for unknown IDs
+        for song, features in zip(batch, batch_features):
+            apply_spotify_features(song, features)
+
+def find_spotify_match(song:Song) -> dict:
+    """Searches Spotify for a Song without asking the user anything, the way process_song_metadata()
+       starts its search: by name and artist, then without any "feat." in the name.  Returns the
+       first track within MAX_SONG_TIME_DIFFERENCE of the song's duration, or None if the user has to help."""
+    if song.name is None or song.artist is None or song.duration_s is None:
+        return None
+    initial_spotify_search_str = song.name + " " + song.artist
+    query_strings = [initial_spotify_search_str]
+    # Spotify doesn't seem to like "feat." in the track name
+    query_string_without_feat = re.sub('( \(\s*feat.+\))', '', initial_spotify_search_str, flags=re.IGNORECASE)
+    if query_string_without_feat != initial_spotify_search_str:
+        query_strings.append(query_string_without_feat)
+    for query_string in query_strings:
+        search_results = run_API_request(lambda : SP.search(query_string, type='track'), "to search for a matching song on Spotify", SERVICE_SPOTIFY)
+        if search_results:
+            for candidate_song in search_results['tracks']['items']:
+                time_difference_s = (float(candidate_song['duration_ms'])/1000) - float(song.duration_s)
+                if abs(time_difference_s) <= MAX_SONG_TIME_DIFFERENCE:
+                    return candidate_song
+    return None
+
+def apply_spotify_match(song:Song, matching_spotify_song:dict):
+    """Sets a Song's Spotify ID and preview URL from a Spotify track, and its album if it has none."""
+    song.spotify_preview_url = matching_spotify_song['preview_url']
+    song.spotify_id = matching_spotify_song['id']
+    # Fill album name from Spotify if YTM alt endpoint was used
+    if song.album is None:
+        song.album = matching_spotify_song['album']['name']
+
 # TODO later: Break into multiple functions
 def process_song_metadata(song:Song, search_spotify:bool, edit_metadata:bool, get_features:bool) -> Song:
     """Takes a Song and expands its metadata with Spotify song search, Spotify Track Features API, and/or manual user input."""
@@ -322,7 +173,7 @@ def process_song_metadata(song:Song, search_spotify:bool, edit_metadata:bool, ge
         user_search_string = "" 
         while True:
             # TODO: Why no prompt for song name after exceeding HTTP errors?
-            search_results = run_API_request(lambda : SP.search(query_string, type='track'), "to search for a matching song on Spotify")
+            search_results = run_API_request(lambda : SP.search(query_string, type='track'), "to search for a matching song on Spotify", SERVICE_SPOTIFY)
 
             # Results were returned, check them
             if search_results and len(search_results['tracks']['items']) > 0:
@@ -377,49 +228,9 @@ def process_song_metadata(song:Song, search_spotify:bool, edit_metadata:bool, ge
 
         # Song was found.  Look up its "features" and process them before saving song to playlist.
         else:
-            song.spotify_preview_url = matching_spotify_song['preview_url']
-            song.spotify_id = matching_spotify_song['id']
-            # Fill album name from Spotify if YTM alt endpoint was used
-            if song.album is None:
-                song.album = matching_spotify_song['album']['name']
-
+            apply_spotify_match(song, matching_spotify_song)
             if get_features:
-                features = run_API_request(lambda : SP.audio_features(tracks=[song.spotify_id])[0], "to look up Spotify musical features for track ID " + song.spotify_id)
-                if features is None:
-                    song.metadata_needs_review = True
-                else:
-                    song.set_bpm(float(features['tempo']))
-
-                    # Validate Spotify pitch class then convert to camelot wheel position number 
-                    # Camelot position numbers are in tuples (position for major key, position for minor key)
-                    camelot_lookup = {
-                        0: (8, 5),
-                        1: (3, 12),
-                        2: (10, 7),
-                        3: (5, 2),
-                        4: (12, 9),
-                        5: (7, 4), 
-                    5: (7, 4), 
-                        5: (7, 4), 
-                        6: (2, 11),
-                        7: (9, 6),
-                        8: (4, 1),
-                        9: (11, 8),
-                        10: (6, 3),
-                        11: (1, 10)
-                    }
-                    if features['key'] == -1:
-                        print("Spotify omitted the musical key for " + initial_spotify_search_str)
-                        song.metadata_needs_review = True
-                    else:
-                        if features['mode'] == 1:
-                            song.camelot_position, _ = camelot_lookup[features['key']]
-                            song.camelot_is_minor = False
-                        else:
-                            _, song.camelot_position = camelot_lookup[features['key']]
-                            song.camelot_is_minor = True
-                        if song.metadata_needs_review is None:
-                            song.metadata_needs_review = False
+                download_spotify_features([song])
 
     # Metadata editor that can compare to metadata retrieved from Spotify
     if edit_metadata:
@@ -615,72 +426,111 @@ def process_song_metadata(song:Song, search_spotify:bool, edit_metadata:bool, ge
 
     return song
 
-def load_data_files(path = '.') -> tuple[dict[str, Playlist], dict[str, Song]]:
-    """Loads local playlist files into a dict (keyed by YT id) and returns it.  
-    Also returns dict of songs by YT id.  Takes optional path argument or just seaches current directory."""
-
-    print("Loading songs cache and playlist files from folder \"" + path + "\". You may be prompted to correct errors. ")
-
-    # Load songs cache, checking for backup in case save was interrupted
-    songs_cache = dict()
-    if os.path.exists(SONG_METADATA_CACHE_FILE + '.bak'):
-        print("Songs cache backup detected; last save may have failed.")
-        if prompt_user_for_bool("Replace the primary copy with the backup? "):
-            os.rename(SONG_METADATA_CACHE_FILE + '.bak', SONG_METADATA_CACHE_FILE)
-        else:
-            os.remove(SONG_METADATA_CACHE_FILE + '.bak')
-    if os.path.exists(SONG_METADATA_CACHE_FILE):
-        songs_file = open(SONG_METADATA_CACHE_FILE, "rb")
-        songs_cache = pickle.load(songs_file)
-        songs_file.close()
-
-    # Load playlist files
-    # TODO later: switch from glob to os to reduce imports
-    playlist_files = glob.glob(PLAYLIST_FILE_PREFIX + '*' + PLAYLIST_FILE_EXTENSION, dir_fd=glob.glob(path)[0])
-    playlists_db = dict()
-    for playlist_file_name in playlist_files:
-        playlist_file = open(playlist_file_name, "rb")
-        playlist = pickle.load(playlist_file)
-        playlist_file.close()
-        playlists_db[playlist.yt_id] = playlist
-
-        # Check if any songs are not in the cache and download them
+def import_legacy_files(path = '.') -> tuple[int, int]:
+    """Imports songs and playlists from the old pickled cache and playlist files into the song
+    store, if they weren't imported already.  The old files are kept as a backup.
+    Returns (imported song count, imported playlist count)."""
+    song_store = get_song_store(path)
+    imported_song_count = 0
+    imported_playlist_count = 0
+
+    # Import the old songs cache the first time, checking for backup in case its last save was interrupted
+    legacy_cache_path = os.path.join(path, SONG_METADATA_CACHE_FILE)
+    if song_store.get_info('imported_legacy_cache') is None:
+        if os.path.exists(legacy_cache_path + '.bak'):
+            print("Songs cache backup detected; last save may have failed.")
+            if prompt_user_for_bool("Replace the primary copy with the backup? "):
+                os.replace(legacy_cache_path + '.bak', legacy_cache_path)
+            else:
+                os.remove(legacy_cache_path + '.bak')
+        if os.path.exists(legacy_cache_path):
+            print("Moving songs cache into the song store... ")
+            imported_song_count = song_store.import_legacy_cache(legacy_cache_path)
+            print("Imported " + str(imported_song_count) + " songs. The old cache file is kept as a backup. ")
+
+    # Import old playlist files that aren't in the store yet, which their file names tell without opening them
+    stored_playlist_ids = {playlist_id for playlist_id, _, _ in song_store.get_playlist_index()}
+    for playlist_file_name in glob.glob(os.path.join(glob.escape(path), PLAYLIST_FILE_PREFIX + '*' + PLAYLIST_FILE_EXTENSION)):
+        if os.path.basename(playlist_file_name)[len(PLAYLIST_FILE_PREFIX):-len(PLAYLIST_FILE_EXTENSION)] not in stored_playlist_ids:
+            playlist_file = open(playlist_file_name, "rb")
+            playlist = pickle.load(playlist_file)
+            playlist_file.close()
+            song_store.save_playlist(playlist.yt_id, playlist.name, playlist.song_ids or [], playlist.order_ids)
+            print("Imported playlist \"" + playlist.name + "\" into the song store. ")
+            imported_playlist_count = imported_playlist_count + 1
+    return imported_song_count, imported_playlist_count
+
+def load_data_files(path = '.') -> tuple[LazyPlaylists, LazySongCache]:
+    """Opens the song store and returns its playlists and songs as dicts keyed by YT id, which
+    load each playlist or song the first time it is used.  Takes optional path argument or just
+    seaches current directory.  Old cache and playlist files are imported into the store first."""
+
+    print("Loading songs and playlists from folder \"" + path + "\". You may be prompted to correct errors. ")
+
+    song_store = get_song_store(path)
+    import_legacy_files(path)
+
+    playlists_db = LazyPlaylists(song_store, Playlist)
+    songs_cache = LazySongCache(song_store)
+    for playlist_id, name, song_count in playlists_db.get_index():
+        if song_count == 0:
+            print("Warning: playlist ID " + playlist_id + " seems empty and should be redownloaded. ")
+
+    # Check if any songs are not in the cache and download them
+    missing_song_ids = dict()
+    for playlist_id, song_id in song_store.get_missing_playlist_songs():
+        missing_song_ids.setdefault(playlist_id, []).append(song_id)
+    for playlist_id, playlist_song_ids in missing_song_ids.items():
         missing_metadata_count = 0
-        if playlist.song_ids is None:
-            print("Warning: playlist ID " + playlist.yt_id + " seems empty and should be redownloaded. ")
-        for song_id in playlist.song_ids:
+        for song_id in playlist_song_ids:
             if song_id not in songs_cache:
                 # Print update every 10 retrievals since they take a while
                 if missing_metadata_count % 10 == 9:
                     print("Correcting metadata for " + str(missing_metadata_count + 1) + "th song. ")
                 songs_cache[song_id] = process_song_metadata(song=download_metadata_from_YT_id(song_id), search_spotify=True, edit_metadata=True, get_features=True)
-                songs_cache[song_id].yt_id = songs_cache[song_id] # Don't use alternative ID
+                songs_cache[song_id].yt_id = song_id # Don't use alternative ID
+                save_song(songs_cache[song_id])
                 missing_metadata_count = missing_metadata_count + 1
         if missing_metadata_count > 0:
-            print("Updated " + str(missing_metadata_count) + " songs that had no data while loading playlist \"" + playlist.name + "\". Note that album names cannot be loaded. ")
+            print("Updated " + str(missing_metadata_count) + " songs that had no data while loading playlist \"" + playlists_db.index[playlist_id][0] + "\". Note that album names cannot be loaded. ")
 
-    print("Loaded " + str(len(playlists_db.keys())) + " saved playlists and " + str(len(songs_cache.keys())) + " cached songs. ")
+    print("Found " + str(len(playlists_db)) + " saved playlists and " + str(len(song_store)) + " cached songs. ")
     return playlists_db, songs_cache
 
+def get_song_store(path = '.') -> SongStore:
+    """Opens the song store on first use and returns it."""
+    global SONG_STORE
+    if SONG_STORE is None:
+        SONG_STORE = SongStore(Song, list(USER_RATINGS), os.path.join(path, SONG_STORE_FILE), os.path.join(path, SONG_FEATURES_FILE))
+    return SONG_STORE
+
+def save_song(song : Song):
+    """Saves one song to the song store right away, if it changed since it was loaded or last saved."""
+    get_song_store().save_song(song.yt_id, song)
+
+def save_playlist(playlist : Playlist):
+    """Saves a playlist and its song IDs to the song store right away."""
+    get_song_store().save_playlist(playlist.yt_id, playlist.name, playlist.song_ids, playlist.order_ids)
+
 def write_song_cache(all_songs : dict[str, Song]):
-    """Save song metadata cache, moving old copy to backup location in case saving is interrupted."""
-    if os.path.exists(SONG_METADATA_CACHE_FILE):
-        os.rename(SONG_METADATA_CACHE_FILE, SONG_METADATA_CACHE_FILE + '.bak')
-    songs_file = open(SONG_METADATA_CACHE_FILE, "wb")
-    pickle.dump(all_songs, songs_file)
-    songs_file.close()
-    if os.path.exists(SONG_METADATA_CACHE_FILE + '.bak'):
-        os.remove(SONG_METADATA_CACHE_FILE + '.bak')
+    """Save song metadata cache.  Only songs that changed since they were loaded or last saved are
+       written, and songs no longer in the dict are removed."""
+    song_store = get_song_store()
+    if isinstance(all_songs, LazySongCache):
+        all_songs.save()
+    else:
+        song_store.save_songs(all_songs)
+        removed_song_ids = [song_id for song_id in song_store.get_stored_ids() if song_id not in all_songs]
+        if len(removed_song_ids) > 0:
+            song_store.delete_songs(removed_song_ids)
+    song_store.compact()
 
 def cleanup_song_cache(songs_cache : dict[str, Song], playlists_db : dict[str, Playlist]):
     """Checks and offers to remove songs in cache not used by any playlist."""
-    unseen_songs = [song_id for song_id in songs_cache]
+    used_song_ids = set()
     for playlist in playlists_db.values():
-        for song_id in playlist.song_ids:
-            try:
-                unseen_songs.remove(song_id)
-            except:
-                pass
+        used_song_ids.update(playlist.song_ids)
+    unseen_songs = [song_id for song_id in songs_cache if song_id not in used_song_ids]
     if len(unseen_songs) > 0:
         print(str(len(unseen_songs)) + " songs in the cache are not used by a playlist. ")
         if prompt_user_for_bool("Remove them? "):
@@ -688,11 +538,13 @@ def cleanup_song_cache(songs_cache : dict[str, Song], playlists_db : dict[str, P
                 songs_cache.pop(song_id)
     return songs_cache
 
-def prompt_for_playlist(playlists_db : dict[str, Playlist]) -> Playlist:
-    """Prompts user to select playlists from the given dict. Allows user to select none to load all songs."""
-    for number, playlist in enumerate(list(playlists_db.values())):
-        print(str(number + 1) + ": " + playlist.name)
+def prompt_for_playlist(playlists_db : LazyPlaylists) -> Playlist:
+    """Prompts user to select playlists from the given dict. Allows user to select none to load all songs.
+       Only the selected playlist is loaded."""
+    playlist_index = playlists_db.get_index()
+    for number, (playlist_id, name, song_count) in enumerate(playlist_index):
+        print(str(number + 1) + ": " + name + " (" + str(song_count) + " songs)")
     selection = input("Playlist: ")
     if selection != "":
-        return list(playlists_db.values())[int(selection) - 1]
+        return playlists_db[playlist_index[int(selection) - 1][0]]
     return None
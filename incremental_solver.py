@@ -0,0 +1,85 @@
+"""
+Re-sorts a playlist that was sorted before by fitting its new songs into the last sorted order,
+instead of sorting the whole playlist again.
+
+Songs removed since the last sort are dropped from the old order, then each new song is put in
+the spot between two songs (or at either end) where it adds the least distance.  Finally the
+local search engine's 2-opt and Or-opt moves are tried, but only around the new songs (and
+any songs that a move then changes), for a bounded time.  Distances are scored as needed, so
+nothing of size n^2 is built.  If there are too many new songs, or the result is too much worse
+than the old order, the caller should do a full sort instead.
+"""
+
+import time
+
+import numpy
+
+from song_model import Song
+from scoring import pack_song_features
+from distance import DISTANCE_COST_SCALE, FeatureDistances
+from local_search import NEIGHBOR_COUNT, LazyNeighborLists, improve_order
+from solver import get_average_similarity_for_cost
+
+# Do a full sort instead if more than this share of the playlist is new
+MAX_NEW_SONG_SHARE = 0.2
+# Do a full sort instead if the average similarity between neighboring songs drops more than this below the last sort
+MAX_SIMILARITY_LOSS = 0.01
+# Time limit of the local search around the new songs
+REPAIR_TIME_LIMIT_S = 1.0
+
+def insert_songs(distances : FeatureDistances, song_order : list, new_song_indices : list) -> list:
+    """Puts each new song where it adds the least distance to an open playlist order (a list of
+       song indices), one at a time, and returns the new order."""
+    song_order = list(song_order)
+    for new_song_index in new_song_indices:
+        if len(song_order) == 0:
+            song_order.append(new_song_index)
+            continue
+        order = numpy.array(song_order, dtype=numpy.int64)
+        distances_to_new_song = distances.get_row(new_song_index, order).astype(numpy.int64)
+        # Inserting between two songs replaces the distance between them; either end only adds one distance
+        gap_costs = distances_to_new_song[:-1] + distances_to_new_song[1:] - distances.get_pairs(order[:-1], order[1:]).astype(numpy.int64)
+        insert_costs = numpy.concatenate([[distances_to_new_song[0]], gap_costs, [distances_to_new_song[-1]]])
+        song_order.insert(int(numpy.argmin(insert_costs)), new_song_index)
+    return song_order
+
+def solve_incrementally(song_ids : list, sorted_song_ids : list, songs_cache : dict[str, Song], cost_scale=DISTANCE_COST_SCALE,
+                        neighbor_count=NEIGHBOR_COUNT, time_limit_s=REPAIR_TIME_LIMIT_S, max_new_song_share=MAX_NEW_SONG_SHARE,
+                        max_similarity_loss=MAX_SIMILARITY_LOSS) -> list:
+    """
+    Sorts song_ids starting from sorted_song_ids, the order of the last sort, and returns the
+    song IDs in sorted order.  Song IDs should be unique.  Returns None if a full sort should be
+    done instead: if more than max_new_song_share of the songs are new, or if the average
+    similarity between neighboring songs would drop more than max_similarity_loss below that of
+    the last sort.  songs_cache can be a dict of Songs or a SongTable.
+    """
+    playlist_song_ids = set(song_ids)
+    kept_song_ids = [song_id for song_id in dict.fromkeys(sorted_song_ids) if song_id in playlist_song_ids]
+    kept_song_id_set = set(kept_song_ids)
+    new_song_ids = [song_id for song_id in song_ids if song_id not in kept_song_id_set]
+    if len(kept_song_ids) < 2 or len(new_song_ids) > max_new_song_share * len(song_ids):
+        return None
+
+    start_time = time.time()
+    all_song_ids = kept_song_ids + new_song_ids
+    distances = FeatureDistances(pack_song_features(all_song_ids, songs_cache), cost_scale)
+    kept_song_indices = list(range(len(kept_song_ids)))
+    new_song_indices = list(range(len(kept_song_ids), len(all_song_ids)))
+    last_similarity = get_average_similarity_for_cost(distances.get_path_cost(kept_song_indices), len(kept_song_ids), cost_scale)
+
+    song_order = insert_songs(distances, kept_song_indices, new_song_indices)
+    if len(new_song_indices) > 0 and len(song_order) >= 3:
+        # Start the search at the new songs and the songs they were put between
+        positions = numpy.flatnonzero(numpy.isin(song_order, new_song_indices))
+        start_song_indices = [song_order[position] for position in numpy.unique(numpy.clip(numpy.concatenate([positions - 1, positions, positions + 1]), 0, len(song_order) - 1))]
+        song_order = improve_order(distances, song_order, LazyNeighborLists(distances, neighbor_count), time_limit_s,
+                                   start_song_indices=start_song_indices).tolist()
+
+    similarity = get_average_similarity_for_cost(distances.get_path_cost(song_order), len(song_order), cost_scale)
+    if similarity < last_similarity - max_similarity_loss:
+        print("Fitting " + str(len(new_song_ids)) + " new songs into the last sorted order would lower the similarity from " + \
+              str(round(last_similarity, 4)) + " to " + str(round(similarity, 4)) + ", so sorting the whole playlist instead. ")
+        return None
+    print("Fit " + str(len(new_song_ids)) + " new songs into the last sorted order (without " + str(len(sorted_song_ids) - len(kept_song_ids)) + \
+          " removed songs) in " + str(round(time.time() - start_time, 2)) + " seconds, with similarity " + str(round(similarity, 4)) + ". ")
+    return [all_song_ids[song_index] for song_index in song_order]
@@ -0,0 +1,312 @@
+"""
+A lightweight playlist solver that doesn't need OR-Tools: a nearest-neighbor first order,
+improved with 2-opt and Or-opt moves until no move helps (or a time limit is hit).
+
+Like the OR-Tools solver, the playlist is treated as a round trip through a dummy node that
+costs nothing to travel to or from, so the trip can be cut there into an open playlist.
+Moves are only tried towards each song's closest neighbors, and only around songs whose
+surroundings changed, so a pass costs O(n * k) distance lookups instead of O(n^2).  With a
+candidate graph (see candidates.py) and FeatureDistances, nothing of size n^2 is ever built.
+"""
+
+import time
+from collections import deque
+
+import numpy
+
+from song_model import Song
+from scoring import pack_song_features
+from distance import DEFAULT_MEMORY_BUDGET_BYTES, DISTANCE_COST_SCALE, DistanceMatrix, FeatureDistances, build_distance_matrix, check_memory_budget
+from candidates import build_candidate_lists, build_candidate_nearest_neighbor_order
+from solver import PROGRESS_REPORT_INTERVAL_S, get_average_similarity_for_cost, print_solver_progress
+
+# How many of each song's closest songs are tried when looking for a better neighbor
+NEIGHBOR_COUNT = 12
+# Longest run of songs that an Or-opt move will pick up and reinsert elsewhere
+MAX_OR_OPT_SEGMENT_LENGTH = 3
+
+def get_neighbor_lists(distance_matrix : DistanceMatrix, neighbor_count=NEIGHBOR_COUNT) -> numpy.ndarray:
+    """Returns an (n, neighbor_count) array holding each song's closest other songs, closest first."""
+    song_count = len(distance_matrix)
+    neighbor_count = min(neighbor_count, song_count - 1)
+    neighbor_lists = numpy.empty((song_count, neighbor_count), dtype=numpy.int64)
+    if neighbor_count <= 0:
+        return neighbor_lists
+    for song_index in range(song_count):
+        row = distance_matrix.get_row(song_index).astype(numpy.int64)
+        row[song_index] = numpy.iinfo(numpy.int64).max # Never a neighbor of itself
+        closest = numpy.argpartition(row, neighbor_count - 1)[:neighbor_count]
+        neighbor_lists[song_index] = closest[numpy.argsort(row[closest], kind='stable')]
+    return neighbor_lists
+
+class LazyNeighborLists:
+    """Each song's closest other songs, like get_neighbor_lists(), but only found the first time
+       a song's list is asked for, so a search that only looks at a few songs doesn't need every row."""
+    distance_matrix = None # DistanceMatrix or FeatureDistances
+    neighbor_count = NEIGHBOR_COUNT
+    neighbor_lists = None # dict of song index to its neighbor list
+
+    def __init__(self, distance_matrix : DistanceMatrix, neighbor_count=NEIGHBOR_COUNT):
+        self.distance_matrix = distance_matrix
+        self.neighbor_count = min(neighbor_count, len(distance_matrix) - 1)
+        self.neighbor_lists = dict()
+
+    def __getitem__(self, song_index : int) -> numpy.ndarray:
+        if song_index not in self.neighbor_lists:
+            row = self.distance_matrix.get_row(song_index).astype(numpy.int64)
+            row[song_index] = numpy.iinfo(numpy.int64).max # Never a neighbor of itself
+            closest = numpy.argpartition(row, self.neighbor_count - 1)[:self.neighbor_count]
+            self.neighbor_lists[song_index] = closest[numpy.argsort(row[closest], kind='stable')]
+        return self.neighbor_lists[song_index]
+
+def build_nearest_neighbor_order(distance_matrix : DistanceMatrix, start_song_index=0) -> numpy.ndarray:
+    """Builds a first playlist order by always going to the closest song that hasn't been used yet."""
+    song_count = len(distance_matrix)
+    order = numpy.empty(song_count, dtype=numpy.int64)
+    if song_count == 0:
+        return order
+    visited = numpy.zeros(song_count, dtype=bool)
+    current_song_index = start_song_index
+    for position in range(song_count):
+        order[position] = current_song_index
+        visited[current_song_index] = True
+        if position == song_count - 1:
+            break
+        row = distance_matrix.get_row(current_song_index).astype(numpy.int64)
+        row[visited] = numpy.iinfo(numpy.int64).max
+        current_song_index = int(numpy.argmin(row))
+    return order
+
+class LocalSearchTour:
+    """A round trip through every song plus the dummy node.  Songs are nodes 0 to n - 1, in the
+       order of the distance matrix (or FeatureDistances), and the dummy is node n.  order holds the nodes in trip order,
+       and position holds each node's index in order."""
+    distance_matrix = None # DistanceMatrix
+    dummy_node = None # int
+    order = None # int64 array
+    position = None # int64 array
+
+    def __init__(self, distance_matrix : DistanceMatrix, song_order):
+        self.distance_matrix = distance_matrix
+        self.dummy_node = len(distance_matrix)
+        self.order = numpy.concatenate([[self.dummy_node], numpy.asarray(song_order, dtype=numpy.int64)])
+        self.position = numpy.empty(len(self.order), dtype=numpy.int64)
+        self.position[self.order] = numpy.arange(len(self.order))
+
+    def __len__(self):
+        return len(self.order)
+
+    def get_costs(self, from_nodes, to_nodes) -> numpy.ndarray:
+        """Returns the cost of traveling between each pair of nodes; anything touching the dummy is free."""
+        from_nodes, to_nodes = numpy.broadcast_arrays(numpy.asarray(from_nodes), numpy.asarray(to_nodes))
+        touches_dummy = (from_nodes == self.dummy_node) | (to_nodes == self.dummy_node)
+        costs = self.distance_matrix.get_pairs(numpy.where(touches_dummy, 0, from_nodes), numpy.where(touches_dummy, 0, to_nodes)).astype(numpy.int64)
+        return numpy.where(touches_dummy, 0, costs)
+
+    def get_cost(self, from_node : int, to_node : int) -> int:
+        if from_node == self.dummy_node or to_node == self.dummy_node:
+            return 0
+        return self.distance_matrix.get(from_node, to_node)
+
+    def get_total_cost(self) -> int:
+        return int(self.get_costs(self.order, numpy.roll(self.order, -1)).sum())
+
+    def get_next(self, nodes):
+        return self.order[(self.position[nodes] + 1) % len(self.order)]
+
+    def get_previous(self, nodes):
+        return self.order[(self.position[nodes] - 1) % len(self.order)]
+
+    def reverse(self, start_position : int, end_position : int):
+        """Reverses the trip from start_position through end_position, wrapping around the end of the array.
+           Reverses the rest of the trip instead if that is shorter, which gives the same round trip."""
+        trip_length = len(self.order)
+        segment_length = (end_position - start_position) % trip_length + 1
+        if segment_length * 2 > trip_length:
+            start_position, end_position = end_position + 1, start_position - 1
+            segment_length = trip_length - segment_length
+        positions = (start_position + numpy.arange(segment_length)) % trip_length
+        self.order[positions] = self.order[positions[::-1]]
+        self.position[self.order[positions]] = positions
+
+    def move_segment(self, segment_start_position : int, segment_length : int, after_node : int, reverse_segment : bool):
+        """Takes segment_length nodes starting at segment_start_position and puts them right after after_node."""
+        trip_length = len(self.order)
+        segment_positions = (segment_start_position + numpy.arange(segment_length)) % trip_length
+        segment = self.order[segment_positions]
+        if reverse_segment:
+            segment = segment[::-1]
+        remaining_nodes = numpy.delete(self.order, segment_positions)
+        insert_position = int(numpy.flatnonzero(remaining_nodes == after_node)[0]) + 1
+        self.order = numpy.concatenate([remaining_nodes[:insert_position], segment, remaining_nodes[insert_position:]])
+        self.position[self.order] = numpy.arange(trip_length)
+
+    def get_song_order(self) -> numpy.ndarray:
+        """Cuts the round trip at the dummy node and returns the song order."""
+        dummy_position = self.position[self.dummy_node]
+        return numpy.concatenate([self.order[dummy_position + 1:], self.order[:dummy_position]])
+
+    def try_2_opt(self, node : int, candidates : numpy.ndarray) -> list:
+        """Applies the best 2-opt move that connects node to one of the candidates, if any improves the trip.
+           Returns the nodes whose neighbors changed."""
+        best_gain = 0
+        best_move = None
+        for direction in [1, -1]:
+            # Replace edges (node, neighbor_node) and (candidate, candidate_neighbor) with
+            # (node, candidate) and (neighbor_node, candidate_neighbor), where both neighbors are in the same direction
+            if direction == 1:
+                neighbor_node = self.get_next(node)
+                candidate_neighbors = self.get_next(candidates)
+            else:
+                neighbor_node = self.get_previous(node)
+                candidate_neighbors = self.get_previous(candidates)
+            gains = self.get_cost(node, neighbor_node) + self.get_costs(candidates, candidate_neighbors) - \
+                    self.get_costs(node, candidates) - self.get_costs(neighbor_node, candidate_neighbors)
+            gains[(candidates == neighbor_node) | (candidate_neighbors == node) | (candidates == node)] = 0
+            best_candidate_index = int(numpy.argmax(gains))
+            if gains[best_candidate_index] > best_gain:
+                best_gain = gains[best_candidate_index]
+                best_move = (direction, neighbor_node, int(candidates[best_candidate_index]), int(candidate_neighbors[best_candidate_index]))
+        if best_move is None:
+            return []
+
+        direction, neighbor_node, candidate, candidate_neighbor = best_move
+        if direction == 1:
+            self.reverse(self.position[neighbor_node], self.position[candidate])
+        else:
+            self.reverse(self.position[node], self.position[candidate_neighbor])
+        return [node, neighbor_node, candidate, candidate_neighbor]
+
+    def try_or_opt(self, node : int, neighbor_lists : numpy.ndarray) -> list:
+        """Applies the best move of a run of songs starting at node to a spot next to one of its
+           ends' neighbors, if any improves the trip.  Returns the nodes whose neighbors changed."""
+        trip_length = len(self.order)
+        start_position = self.position[node]
+        best_gain = 0
+        best_move = None
+        for segment_length in range(1, min(MAX_OR_OPT_SEGMENT_LENGTH, trip_length - 3) + 1):
+            segment_positions = (start_position + numpy.arange(segment_length)) % trip_length
+            segment = self.order[segment_positions]
+            first_node, last_node = int(segment[0]), int(segment[-1])
+            before_node = int(self.order[(start_position - 1) % trip_length])
+            after_node = int(self.order[(start_position + segment_length) % trip_length])
+            removal_gain = self.get_cost(before_node, first_node) + self.get_cost(last_node, after_node) - self.get_cost(before_node, after_node)
+            if removal_gain <= 0:
+                continue
+
+            # Candidate spots are the gaps on either side of each end's neighbors
+            candidates = numpy.concatenate([self._get_candidates(first_node, neighbor_lists), self._get_candidates(last_node, neighbor_lists)])
+            gap_starts = numpy.concatenate([candidates, self.get_previous(candidates)])
+            gap_ends = self.get_next(gap_starts)
+            in_segment = numpy.isin(gap_starts, segment) | numpy.isin(gap_ends, segment)
+            gap_costs = self.get_costs(gap_starts, gap_ends)
+            forward_costs = self.get_costs(gap_starts, first_node) + self.get_costs(last_node, gap_ends) - gap_costs
+            reversed_costs = self.get_costs(gap_starts, last_node) + self.get_costs(first_node, gap_ends) - gap_costs
+            insert_costs = numpy.minimum(forward_costs, reversed_costs)
+            insert_costs[in_segment] = numpy.iinfo(numpy.int64).max // 2
+            best_gap_index = int(numpy.argmin(insert_costs))
+            gain = removal_gain - insert_costs[best_gap_index]
+            if gain > best_gain:
+                best_gain = gain
+                best_move = (segment_length, first_node, last_node, before_node, after_node,
+                             int(gap_starts[best_gap_index]), int(gap_ends[best_gap_index]),
+                             bool(reversed_costs[best_gap_index] < forward_costs[best_gap_index]))
+        if best_move is None:
+            return []
+
+        segment_length, first_node, last_node, before_node, after_node, gap_start, gap_end, reverse_segment = best_move
+        self.move_segment(start_position, segment_length, gap_start, reverse_segment)
+        return [first_node, last_node, before_node, after_node, gap_start, gap_end]
+
+    def _get_candidates(self, node : int, neighbor_lists : numpy.ndarray) -> numpy.ndarray:
+        """Returns a node's neighbor list, plus the dummy so that songs can become the first or last song."""
+        if node == self.dummy_node:
+            return numpy.array([], dtype=numpy.int64)
+        return numpy.append(neighbor_lists[node], self.dummy_node)
+
+def improve_order(distance_matrix : DistanceMatrix, song_order, neighbor_lists=None, time_limit_s=None,
+                  progress_callback=None, start_song_indices=None) -> numpy.ndarray:
+    """Improves a playlist order (a list of song indices into the distance matrix) with 2-opt and
+       Or-opt moves until no move helps or the time limit is hit, and returns the new order.
+       neighbor_lists defaults to get_neighbor_lists(distance_matrix).  If start_song_indices is
+       given, only moves around those songs are tried at first, instead of around every song."""
+    song_count = len(distance_matrix)
+    if song_count < 3:
+        return numpy.asarray(song_order, dtype=numpy.int64)
+    if neighbor_lists is None:
+        neighbor_lists = get_neighbor_lists(distance_matrix)
+
+    start_time = time.time()
+    last_report_time = start_time
+    tour = LocalSearchTour(distance_matrix, song_order)
+
+    # Only look around songs whose neighbors changed since they were last checked
+    pending_nodes = deque(tour.order.tolist() if start_song_indices is None else dict.fromkeys(int(song_index) for song_index in start_song_indices))
+    is_pending = numpy.zeros(len(tour), dtype=bool)
+    is_pending[list(pending_nodes)] = True
+    while len(pending_nodes) > 0:
+        if time_limit_s is not None and time.time() - start_time >= time_limit_s:
+            break
+        node = pending_nodes.popleft()
+        is_pending[node] = False
+
+        changed_nodes = []
+        candidates = tour._get_candidates(node, neighbor_lists)
+        if len(candidates) > 0:
+            changed_nodes = tour.try_2_opt(node, candidates)
+        if len(changed_nodes) == 0:
+            changed_nodes = tour.try_or_opt(node, neighbor_lists)
+        for changed_node in changed_nodes:
+            if not is_pending[changed_node]:
+                is_pending[changed_node] = True
+                pending_nodes.append(changed_node)
+
+        if progress_callback is not None and len(changed_nodes) > 0 and time.time() - last_report_time >= PROGRESS_REPORT_INTERVAL_S:
+            last_report_time = time.time()
+            progress_callback(last_report_time - start_time, get_average_similarity_for_cost(tour.get_total_cost(), song_count, distance_matrix.cost_scale))
+
+    if progress_callback is not None:
+        progress_callback(time.time() - start_time, get_average_similarity_for_cost(tour.get_total_cost(), song_count, distance_matrix.cost_scale))
+    return tour.get_song_order()
+
+def sort_distance_matrix(distance_matrix : DistanceMatrix, start_song_index=0, neighbor_count=NEIGHBOR_COUNT,
+                         time_limit_s=None, progress_callback=None, candidate_lists=None) -> numpy.ndarray:
+    """Sorts the songs of a distance matrix, starting the nearest-neighbor order from the given song,
+       and returns the song indices in sorted order.  If candidate_lists is given (see
+       candidates.build_candidate_lists()), only those songs are tried as neighbors instead of
+       searching every row of the matrix for the closest neighbor_count songs."""
+    if candidate_lists is None:
+        song_order = build_nearest_neighbor_order(distance_matrix, start_song_index)
+        return improve_order(distance_matrix, song_order, get_neighbor_lists(distance_matrix, neighbor_count), time_limit_s, progress_callback)
+    song_order = build_candidate_nearest_neighbor_order(distance_matrix, candidate_lists, start_song_index)
+    return improve_order(distance_matrix, song_order, candidate_lists, time_limit_s, progress_callback)
+
+def solve_with_local_search(song_ids : list, songs_cache : dict[str, Song], cost_scale=DISTANCE_COST_SCALE,
+                            memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES, neighbor_count=NEIGHBOR_COUNT,
+                            time_limit_s=None, progress_callback=print_solver_progress, candidates='all', distance_cache=None) -> list:
+    """
+    Sorts songs with the built-in nearest-neighbor, 2-opt and Or-opt heuristics and returns the
+    song IDs in sorted order.  Song IDs should be unique.  Takes the same limits and progress
+    callback as solver.solve_for_playlist_order().  candidates is 'all' to score every pair of
+    songs into a distance matrix, or 'knn' to only score each song's neighbor_count candidates
+    and score moves on the fly (also used if the matrix would exceed the memory budget).
+    distance_cache is used for the distance matrix, as in solver.solve_for_playlist_order().
+    """
+    assert candidates in ['all', 'knn'], "Unknown candidate mode " + str(candidates)
+    if len(song_ids) < 3:
+        return list(song_ids)
+    if candidates == 'all' and not check_memory_budget(len(song_ids), memory_budget_bytes, cost_scale, for_solver=False):
+        print("Playlist is too large for a distance matrix within the memory budget; only trying each song's closest songs instead. ")
+        candidates = 'knn'
+
+    print("Scoring songs...")
+    features = pack_song_features(song_ids, songs_cache)
+    if candidates == 'knn':
+        distance_matrix = FeatureDistances(features, cost_scale)
+        candidate_lists = build_candidate_lists(features, neighbor_count, cost_scale)
+    else:
+        distance_matrix = build_distance_matrix(features, cost_scale, memory_budget_bytes, for_solver=False, distance_cache=distance_cache)
+        candidate_lists = None
+    print("Sorting playlist...")
+    song_order = sort_distance_matrix(distance_matrix, 0, neighbor_count, time_limit_s, progress_callback, candidate_lists)
+    return [song_ids[song_index] for song_index in song_order]
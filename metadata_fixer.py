@@ -27,6 +27,7 @@ for song_id in song_ids_to_check:
         check_result = process_song_metadata(song=song, search_spotify=search_spotify, edit_metadata=True, get_features=False)
         if check_result is None:
             break
+        save_song(song)
 
 # TODO later: Make "private song fixer" that checks video ID against YouTube, prompts if private, and offers to update remote playlist
 
@@ -0,0 +1,155 @@
+"""
+Runs several independent playlist solves at once in a process pool and keeps the best order.
+
+The distance matrix is built once in the main process and put in shared memory, so workers
+read the same triangle instead of each receiving a pickled copy.  Each restart varies the
+search: the local search engine starts its nearest-neighbor order from a different random
+song, and the OR-Tools engine cycles through first solution strategies.
+
+Workers are forked where the system can fork, so they start without importing anything again.
+Elsewhere (Windows) they're spawned, which imports the main program's file again in each
+worker, so a program that sorts with restarts has to run only under `if __name__ == '__main__':`.
+"""
+
+import multiprocessing, os, random, time
+from multiprocessing import shared_memory
+
+import numpy
+
+from song_model import Song
+from scoring import pack_song_features
+from distance import DEFAULT_MEMORY_BUDGET_BYTES, DISTANCE_COST_SCALE, DistanceMatrix, build_distance_matrix, get_distance_matrix_memory_bytes
+from solver import FIRST_SOLUTION_STRATEGIES, get_average_similarity_for_cost, solve_routing_problem
+from local_search import NEIGHBOR_COUNT, sort_distance_matrix
+
+# Changes to the neighbor list size that local search restarts cycle through, for a little more variety than the start song alone
+RESTART_NEIGHBOR_COUNT_OFFSETS = [0, -4, 4]
+
+# How worker processes are started; fork is quickest to start, but not every system has it
+POOL_START_METHOD = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Set in each worker process by _attach_worker()
+_worker_shared_memory = None
+_worker_distance_matrix = None
+
+class Restart:
+    """Settings for one independent solve."""
+    restart_number = None # int
+    engine = None # 'local-search' or 'ortools'
+    start_song_index = 0 # local search only
+    neighbor_count = NEIGHBOR_COUNT # local search only
+    first_solution_strategy = 'PATH_CHEAPEST_ARC' # ortools only
+    metaheuristic = None # ortools only
+    solution_limit = None # ortools only
+    time_limit_s = None
+
+    def describe(self) -> str:
+        if self.engine == 'ortools':
+            return self.first_solution_strategy.lower() + ("" if self.metaheuristic is None else ", " + self.metaheuristic)
+        return "start song " + str(self.start_song_index) + ", " + str(self.neighbor_count) + " neighbors"
+
+def _attach_worker(shared_memory_name : str, song_count : int, cost_scale : int, triangle_dtype : str):
+    """Process pool initializer that maps the shared distance matrix into the worker."""
+    global _worker_shared_memory, _worker_distance_matrix
+    _worker_shared_memory = shared_memory.SharedMemory(name=shared_memory_name)
+    _worker_distance_matrix = DistanceMatrix()
+    _worker_distance_matrix.song_count = song_count
+    _worker_distance_matrix.cost_scale = cost_scale
+    _worker_distance_matrix.triangle = numpy.ndarray((song_count * (song_count - 1) // 2,), dtype=numpy.dtype(triangle_dtype), buffer=_worker_shared_memory.buf)
+
+def _run_restart(restart : Restart) -> tuple[int, list, Restart]:
+    """Runs one restart in a worker and returns (total cost, song order, restart)."""
+    if restart.engine == 'ortools':
+        song_order, total_cost = solve_routing_problem(len(_worker_distance_matrix), _worker_distance_matrix.cost_scale, distance_matrix=_worker_distance_matrix,
+                                                       first_solution_strategy=restart.first_solution_strategy, time_limit_s=restart.time_limit_s,
+                                                       solution_limit=restart.solution_limit, metaheuristic=restart.metaheuristic, progress_callback=None)
+    else:
+        song_order = sort_distance_matrix(_worker_distance_matrix, restart.start_song_index, restart.neighbor_count, restart.time_limit_s).tolist()
+        total_cost = _worker_distance_matrix.get_path_cost(song_order)
+    return total_cost, song_order, restart
+
+def make_restarts(engine : str, restart_count : int, song_count : int, random_seed=None, time_limit_s=None, metaheuristic=None,
+                  neighbor_count=NEIGHBOR_COUNT, solution_limit=None) -> list[Restart]:
+    """Makes the settings for each restart.  The first restart always matches a normal single solve."""
+    rng = random.Random(random_seed)
+    restarts = []
+    for restart_number in range(restart_count):
+        restart = Restart()
+        restart.restart_number = restart_number
+        restart.engine = engine
+        restart.time_limit_s = time_limit_s
+        restart.metaheuristic = metaheuristic
+        restart.solution_limit = solution_limit
+        restart.first_solution_strategy = FIRST_SOLUTION_STRATEGIES[restart_number % len(FIRST_SOLUTION_STRATEGIES)]
+        restart.neighbor_count = max(1, neighbor_count + RESTART_NEIGHBOR_COUNT_OFFSETS[restart_number % len(RESTART_NEIGHBOR_COUNT_OFFSETS)])
+        restart.start_song_index = 0 if restart_number == 0 else rng.randrange(song_count)
+        restarts.append(restart)
+    return restarts
+
+def solve_in_parallel(song_ids : list, songs_cache : dict[str, Song], engine='local-search', restart_count=None, process_count=None,
+                      target_similarity=None, time_limit_s=None, metaheuristic=None, cost_scale=DISTANCE_COST_SCALE,
+                      memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES, random_seed=None, distance_cache=None,
+                      neighbor_count=NEIGHBOR_COUNT, solution_limit=None) -> list:
+    """
+    Sorts songs with restart_count independent solves (default: one per process) spread over
+    process_count processes (default: one per CPU), and returns the song IDs in the best order found.
+    If target_similarity is given, stops as soon as a restart finishes with that average
+    similarity between neighboring songs or better; it is only checked when a restart finishes,
+    so a restart that reaches it partway through still runs to its own limit first.
+    time_limit_s, metaheuristic and solution_limit (ortools only) apply to each restart, and
+    local search restarts use about neighbor_count neighbors.  Every restart uses all songs as
+    candidates.  distance_cache is used for the shared distance matrix, as in
+    solver.solve_for_playlist_order().  Raises MemoryError if the restarts would exceed the memory budget.
+    """
+    assert engine in ['local-search', 'ortools'], "Unknown engine " + str(engine)
+    song_count = len(song_ids)
+    if song_count < 3:
+        return list(song_ids)
+    if process_count is None:
+        process_count = os.cpu_count() or 1
+    if restart_count is None:
+        restart_count = process_count
+    process_count = min(process_count, restart_count)
+
+    # The triangle is shared, but every OR-Tools worker makes its own full copy for the solver
+    shared_bytes = get_distance_matrix_memory_bytes(song_count, cost_scale, for_solver=False)
+    per_worker_bytes = get_distance_matrix_memory_bytes(song_count, cost_scale, for_solver=True) - shared_bytes if engine == 'ortools' else 0
+    if shared_bytes + per_worker_bytes * process_count > memory_budget_bytes:
+        raise MemoryError("Sorting " + str(song_count) + " songs in " + str(process_count) + " processes needs about " + \
+                          str((shared_bytes + per_worker_bytes * process_count) // (1024 * 1024)) + " MiB, which is over the memory budget. " + \
+                          "Try fewer processes. ")
+
+    print("Scoring songs...")
+    distance_matrix = build_distance_matrix(pack_song_features(song_ids, songs_cache), cost_scale, memory_budget_bytes, for_solver=False,
+                                            distance_cache=distance_cache)
+    triangle_shared_memory = shared_memory.SharedMemory(create=True, size=max(distance_matrix.triangle.nbytes, 1))
+    try:
+        triangle_dtype = distance_matrix.triangle.dtype.str
+        shared_triangle = numpy.ndarray(distance_matrix.triangle.shape, dtype=distance_matrix.triangle.dtype, buffer=triangle_shared_memory.buf)
+        shared_triangle[:] = distance_matrix.triangle
+        del shared_triangle, distance_matrix # Free the private copy; workers only need the shared one
+
+        print("Sorting playlist with " + str(restart_count) + " restarts in " + str(process_count) + " processes...")
+        start_time = time.time()
+        best_cost = None
+        best_song_order = None
+        restarts = make_restarts(engine, restart_count, song_count, random_seed, time_limit_s, metaheuristic, neighbor_count, solution_limit)
+        with multiprocessing.get_context(POOL_START_METHOD).Pool(process_count, initializer=_attach_worker,
+                                                                 initargs=(triangle_shared_memory.name, song_count, cost_scale, triangle_dtype)) as pool:
+            for total_cost, song_order, restart in pool.imap_unordered(_run_restart, restarts):
+                similarity = get_average_similarity_for_cost(total_cost, song_count, cost_scale)
+                print("Restart " + str(restart.restart_number + 1) + " (" + restart.describe() + ") reached similarity " + \
+                      str(round(similarity, 4)) + " after " + str(round(time.time() - start_time, 1)) + " seconds. ")
+                if best_cost is None or total_cost < best_cost:
+                    best_cost = total_cost
+                    best_song_order = song_order
+                if target_similarity is not None and similarity >= target_similarity:
+                    print("Target similarity reached, stopping the other restarts. ")
+                    pool.terminate()
+                    break
+    finally:
+        triangle_shared_memory.close()
+        triangle_shared_memory.unlink()
+
+    print("Best similarity: " + str(round(get_average_similarity_for_cost(best_cost, song_count, cost_scale), 4)))
+    return [song_ids[song_index] for song_index in best_song_order]
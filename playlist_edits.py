@@ -0,0 +1,249 @@
+"""
+Plans of YouTube Music playlist edits, which are worked out in full before any are made, then
+made one call at a time with progress saved after every call.
+
+A plan is a list of calls: moving one entry (YouTube Music only moves one entry per call),
+adding or removing a batch of songs, or creating a playlist.  Adds and removes are batched up
+to EDIT_BATCH_SIZE songs per call.  The plan and how many of its calls are done are saved to
+PLAYLIST_EDIT_PLAN_FILE, so if the edits are interrupted, the rest of the plan can be made
+later instead of starting over.  A call that was made just before an interruption, but not yet
+saved as done, is made again.  Moves can be repeated safely, but YouTube Music rejects a whole
+add with any song already in the playlist, and a remove of entries that are gone, so before
+the first add or remove of a resumed plan, songs already added and entries already removed are
+dropped from it.  A create call can't be checked that way, so making it again creates a second
+playlist, and the first one has to be deleted by hand.  A call that YouTube Music rejects even
+after retries stops the edits without counting as done, so it is tried again next time.
+"""
+
+import json, os
+
+from api_scheduler import DEFAULT_SERVICE_LIMITS, SERVICE_YTM
+from playlist_reorder import get_target_order_ids, plan_playlist_moves
+
+PLAYLIST_EDIT_PLAN_FILE = 'playlist_edit_plan.json'
+# Kinds of calls in a plan
+EDIT_MOVE = 'move'
+EDIT_ADD = 'add'
+EDIT_REMOVE = 'remove'
+EDIT_CREATE = 'create'
+# Most songs to add or remove in one call
+EDIT_BATCH_SIZE = 100
+# Rough time a call takes to come back, for estimating how long a plan takes
+ESTIMATED_CALL_LATENCY_S = 0.5
+# Print progress every this many calls
+PROGRESS_REPORT_INTERVAL_CALLS = 10
+
+class PlaylistEditError(Exception):
+    """A call in a plan failed, so the rest of the plan was left saved."""
+
+class PlaylistEdit:
+    """One call to YouTube Music in a plan."""
+    call = None # EDIT_MOVE, EDIT_ADD, EDIT_REMOVE or EDIT_CREATE
+    order_id = None # move: the entry (set video ID) to move
+    successor_order_id = None # move: the entry to put it right before, or None for the bottom
+    video_ids = None # add and create: the songs to add; remove: the songs of the entries to remove
+    order_ids = None # remove: the entries to remove
+    title = None # create
+    description = None # create
+
+    def describe(self) -> str:
+        if self.call == EDIT_MOVE:
+            return "to move a song in the YouTube Music playlist"
+        if self.call == EDIT_CREATE:
+            return "to create YouTube Music playlist \"" + str(self.title) + "\""
+        return "to " + self.call + " " + str(len(self.video_ids)) + " songs in the YouTube Music playlist"
+
+class PlaylistEditPlan:
+    """The calls that edit one playlist, and how many of them have been made."""
+    playlist_id = None # None until a create call has been made
+    playlist_name = None
+    edits = None # list of PlaylistEdit
+    done_count = 0
+    is_resumed = False # Whether the plan was loaded from its file, so its next call may already have been made
+    # For edits of a saved playlist, its songs and entries once every call is made, to update the saved copy
+    final_song_ids = None
+    final_order_ids = None
+
+    def __init__(self):
+        self.edits = list()
+
+    def count_calls(self, call=None) -> int:
+        """Returns how many calls (of one kind, if given) are left to make."""
+        return len([edit for edit in self.edits[self.done_count:] if call is None or edit.call == call])
+
+    def get_estimated_duration_s(self) -> float:
+        """Estimates how long the calls left take, at YouTube Music's rate limit."""
+        requests_per_second, _ = DEFAULT_SERVICE_LIMITS[SERVICE_YTM]
+        return self.count_calls() * max(1.0 / requests_per_second, ESTIMATED_CALL_LATENCY_S)
+
+    def describe(self) -> str:
+        counts = [str(self.count_calls(call)) + " " + name for call, name in
+                  [(EDIT_CREATE, "create"), (EDIT_REMOVE, "remove"), (EDIT_ADD, "add"), (EDIT_MOVE, "move")] if self.count_calls(call) > 0]
+        return str(self.count_calls()) + " calls to edit playlist \"" + str(self.playlist_name) + "\"" + \
+               (" (" + ", ".join(counts) + ")" if len(counts) > 0 else "") + \
+               ", taking about " + str(round(self.get_estimated_duration_s() / 60, 1)) + " minutes"
+
+    def save(self, path=PLAYLIST_EDIT_PLAN_FILE):
+        """Saves the plan, replacing the file in one step so it is never left half written."""
+        state = {member_name : value for member_name, value in vars(self).items() if member_name not in ['edits', 'is_resumed']}
+        state['edits'] = [vars(edit) for edit in self.edits]
+        new_path = path + '.new'
+        with open(new_path, "w") as plan_file:
+            json.dump(state, plan_file)
+            plan_file.flush()
+            os.fsync(plan_file.fileno())
+        os.replace(new_path, path)
+
+def load_plan(path=PLAYLIST_EDIT_PLAN_FILE) -> PlaylistEditPlan:
+    """Returns the saved plan, or None if there isn't one."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as plan_file:
+        state = json.load(plan_file)
+    plan = PlaylistEditPlan()
+    for edit_state in state.pop('edits'):
+        edit = PlaylistEdit()
+        vars(edit).update(edit_state)
+        plan.edits.append(edit)
+    vars(plan).update(state)
+    plan.is_resumed = True
+    return plan
+
+def remove_plan(path=PLAYLIST_EDIT_PLAN_FILE):
+    if os.path.exists(path):
+        os.remove(path)
+
+def _get_batches(items : list) -> list:
+    return [items[batch_start:batch_start + EDIT_BATCH_SIZE] for batch_start in range(0, len(items), EDIT_BATCH_SIZE)]
+
+def plan_reorder(playlist, sorted_song_ids : list, remove_duplicates=False, current_entries=None) -> PlaylistEditPlan:
+    """Plans the calls that put a saved playlist in sorted order.  Each sorted song uses its first
+       entry; other entries of the same song are removed, or else stay at the top.  Moves are
+       relative to the entries around them, so current_entries, the playlist's (song IDs, order IDs)
+       as they are on YouTube Music now (see get_playlist_entries()), should be given for a plan
+       that will be made; the saved copy of the playlist is used otherwise.  Songs added to the
+       playlist since it was sorted stay at the top, and sorted songs no longer in it are left out."""
+    plan = PlaylistEditPlan()
+    plan.playlist_id = playlist.yt_id
+    plan.playlist_name = playlist.name
+    song_ids, order_ids = current_entries if current_entries is not None else (playlist.song_ids, playlist.order_ids)
+    song_ids, order_ids = list(song_ids), list(order_ids)
+    target_order_ids = get_target_order_ids(song_ids, order_ids, sorted_song_ids)
+    if remove_duplicates:
+        sorted_song_id_set = set(sorted_song_ids)
+        first_order_ids = dict()
+        duplicates = []
+        for song_id, order_id in zip(song_ids, order_ids):
+            if first_order_ids.setdefault(song_id, order_id) != order_id and song_id in sorted_song_id_set:
+                duplicates.append((song_id, order_id))
+        for batch in _get_batches(duplicates):
+            edit = PlaylistEdit()
+            edit.call = EDIT_REMOVE
+            edit.video_ids = [song_id for song_id, _ in batch]
+            edit.order_ids = [order_id for _, order_id in batch]
+            plan.edits.append(edit)
+        duplicate_order_ids = set(order_id for _, order_id in duplicates)
+        song_ids = [song_id for song_id, order_id in zip(song_ids, order_ids) if order_id not in duplicate_order_ids]
+        order_ids = [order_id for order_id in order_ids if order_id not in duplicate_order_ids]
+        target_order_ids = [order_id for order_id in target_order_ids if order_id not in duplicate_order_ids]
+    for order_id, successor_order_id in plan_playlist_moves(order_ids, target_order_ids):
+        edit = PlaylistEdit()
+        edit.call = EDIT_MOVE
+        edit.order_id = order_id
+        edit.successor_order_id = successor_order_id
+        plan.edits.append(edit)
+    song_ids_by_order_id = dict(zip(order_ids, song_ids))
+    plan.final_song_ids = [song_ids_by_order_id[order_id] for order_id in target_order_ids]
+    plan.final_order_ids = target_order_ids
+    return plan
+
+def plan_new_playlist(title : str, description : str, song_ids : list) -> PlaylistEditPlan:
+    """Plans the calls that create a playlist with the given songs, in order."""
+    plan = PlaylistEditPlan()
+    plan.playlist_name = title
+    for batch_number, batch in enumerate(_get_batches(list(song_ids)) or [[]]):
+        edit = PlaylistEdit()
+        edit.call = EDIT_CREATE if batch_number == 0 else EDIT_ADD
+        edit.video_ids = batch
+        if edit.call == EDIT_CREATE:
+            edit.title = title
+            edit.description = description
+        plan.edits.append(edit)
+    return plan
+
+def get_playlist_entries(ytm, run_request, playlist_id : str) -> tuple[list, list]:
+    """Loads a playlist's current songs and entries (set video IDs) from YouTube Music, in order.
+       Raises PlaylistEditError if it can't be loaded."""
+    playlist_contents = run_request(lambda : ytm.get_playlist(playlistId=playlist_id, limit=None), "to get the current songs of the YouTube Music playlist")
+    if playlist_contents is None:
+        raise PlaylistEditError("Failed to get the current songs of the YouTube Music playlist. ")
+    tracks = playlist_contents['tracks']
+    return [track['videoId'] for track in tracks], [track['setVideoId'] for track in tracks]
+
+def _drop_finished_songs(plan : PlaylistEditPlan, ytm, run_request):
+    """Drops songs already in the playlist from the next add of a resumed plan, and entries no
+       longer in it from the next remove, in case the call was made before the interruption."""
+    edit = plan.edits[plan.done_count]
+    if edit.call not in [EDIT_ADD, EDIT_REMOVE]:
+        return
+    song_ids, order_ids = get_playlist_entries(ytm, run_request, plan.playlist_id)
+    if edit.call == EDIT_ADD:
+        present_song_ids = set(song_ids)
+        edit.video_ids = [video_id for video_id in edit.video_ids if video_id not in present_song_ids]
+    else:
+        present_order_ids = set(order_ids)
+        entries = [(video_id, order_id) for video_id, order_id in zip(edit.video_ids, edit.order_ids) if order_id in present_order_ids]
+        edit.video_ids = [video_id for video_id, _ in entries]
+        edit.order_ids = [order_id for _, order_id in entries]
+
+def _is_call_successful(edit : PlaylistEdit, result) -> bool:
+    """Checks a call's result.  Rejected calls return the response (or a failed status) instead of
+       a status containing SUCCEEDED, or for a create, instead of the new playlist's ID."""
+    if result is None:
+        return False
+    if edit.call == EDIT_CREATE:
+        return isinstance(result, str)
+    status = result.get('status') if isinstance(result, dict) else result
+    return isinstance(status, str) and 'SUCCEEDED' in status
+
+def _make_call(ytm, playlist_id : str, edit : PlaylistEdit):
+    """Makes one call, raising an exception if YouTube Music rejects it so it's retried."""
+    if edit.call == EDIT_MOVE:
+        result = ytm.edit_playlist(playlist_id, moveItem=(edit.order_id, edit.successor_order_id))
+    elif edit.call == EDIT_ADD:
+        result = ytm.add_playlist_items(playlist_id, videoIds=edit.video_ids, duplicates=False)
+    elif edit.call == EDIT_REMOVE:
+        result = ytm.remove_playlist_items(playlist_id, [{'videoId' : video_id, 'setVideoId' : order_id} for video_id, order_id in zip(edit.video_ids, edit.order_ids)])
+    elif edit.call == EDIT_CREATE:
+        result = ytm.create_playlist(title=edit.title, description=edit.description, video_ids=edit.video_ids or None)
+    else:
+        raise ValueError("Unknown playlist edit " + str(edit.call))
+    if not _is_call_successful(edit, result):
+        raise PlaylistEditError("YouTube Music rejected the call: " + str(result))
+    return result
+
+def run_plan(plan : PlaylistEditPlan, ytm, run_request, path=PLAYLIST_EDIT_PLAN_FILE):
+    """Makes the calls of a plan that aren't done yet with run_request (such as
+       foundation.run_API_request) and the YTMusic client, saving progress after every call.
+       Removes the saved plan once every call is made.  Raises PlaylistEditError if a call fails,
+       leaving the plan saved with that call not done."""
+    plan.save(path)
+    total_count = len(plan.edits)
+    if plan.is_resumed and plan.done_count < total_count:
+        _drop_finished_songs(plan, ytm, run_request)
+    while plan.done_count < total_count:
+        edit = plan.edits[plan.done_count]
+        if edit.call in [EDIT_ADD, EDIT_REMOVE] and len(edit.video_ids) == 0:
+            pass # Every song was already added or removed
+        else:
+            # run_request returns None once it gives up on a call
+            result = run_request(lambda : _make_call(ytm, plan.playlist_id, edit), edit.describe())
+            if result is None:
+                raise PlaylistEditError("Failed " + edit.describe() + " after " + str(plan.done_count) + " of " + str(total_count) + " playlist edits. ")
+            if edit.call == EDIT_CREATE:
+                plan.playlist_id = result
+        plan.done_count = plan.done_count + 1
+        plan.save(path)
+        if plan.done_count % PROGRESS_REPORT_INTERVAL_CALLS == 0:
+            print("Made " + str(plan.done_count) + " of " + str(total_count) + " playlist edits. ")
+    remove_plan(path)
@@ -0,0 +1,72 @@
+"""
+Plans the fewest YouTube Music playlist edits that put a playlist in a new order.
+
+Each playlist entry has a set video ID (a playlist's order_ids), and one edit moves an entry
+right before another entry, or to the bottom.  The longest run of entries that are already in
+the right order relative to each other (a longest increasing subsequence of their new
+positions) never has to move.  Every other entry is moved once, right before the entry that
+follows it in the new order, going from the end of the new order to the start, so that entry
+is always already in place.  A mostly sorted playlist then only needs a few edits, instead of
+one edit per song.
+"""
+
+from bisect import bisect_left
+
+def get_longest_increasing_subsequence(values : list) -> list:
+    """Returns the indices of a longest strictly increasing subsequence of values, in order."""
+    tail_indices = [] # tail_indices[length - 1] ends the increasing run of that length with the smallest last value
+    tail_values = []
+    previous_indices = [None] * len(values)
+    for index, value in enumerate(values):
+        length = bisect_left(tail_values, value)
+        if length > 0:
+            previous_indices[index] = tail_indices[length - 1]
+        if length == len(tail_values):
+            tail_indices.append(index)
+            tail_values.append(value)
+        else:
+            tail_indices[length] = index
+            tail_values[length] = value
+    subsequence = []
+    index = tail_indices[-1] if len(tail_indices) > 0 else None
+    while index is not None:
+        subsequence.append(index)
+        index = previous_indices[index]
+    return subsequence[::-1]
+
+def get_target_order_ids(song_ids : list, order_ids : list, sorted_song_ids : list) -> list:
+    """Returns a playlist's entries (order IDs) in sorted order.  Each sorted song uses its first
+       entry, and any other entries (of the same song, or of songs that weren't sorted) stay at the
+       top in their current order.  Sorted songs that aren't in the playlist are left out."""
+    first_order_ids = dict()
+    for song_id, order_id in zip(song_ids, order_ids):
+        first_order_ids.setdefault(song_id, order_id)
+    sorted_order_ids = [first_order_ids[song_id] for song_id in sorted_song_ids if song_id in first_order_ids]
+    sorted_order_id_set = set(sorted_order_ids)
+    return [order_id for order_id in order_ids if order_id not in sorted_order_id_set] + sorted_order_ids
+
+def plan_playlist_moves(order_ids : list, target_order_ids : list) -> list[tuple]:
+    """Returns the moves that turn a playlist's entries (order IDs) into target_order_ids, as
+       (order ID, order ID to put it before, or None for the bottom), in the order to make them.
+       Both lists must hold the same unique order IDs."""
+    assert len(order_ids) == len(target_order_ids) and set(order_ids) == set(target_order_ids), "The new order must have the same playlist entries"
+    target_positions = {order_id : position for position, order_id in enumerate(target_order_ids)}
+    unmoved_order_ids = {order_ids[index] for index in get_longest_increasing_subsequence([target_positions[order_id] for order_id in order_ids])}
+    moves = []
+    for position in range(len(target_order_ids) - 1, -1, -1):
+        order_id = target_order_ids[position]
+        if order_id not in unmoved_order_ids:
+            successor_order_id = target_order_ids[position + 1] if position + 1 < len(target_order_ids) else None
+            moves.append((order_id, successor_order_id))
+    return moves
+
+def apply_playlist_moves(order_ids : list, moves : list[tuple]) -> list:
+    """Returns the playlist's entries (order IDs) after making the given moves, as YouTube Music would."""
+    order_ids = list(order_ids)
+    for order_id, successor_order_id in moves:
+        order_ids.remove(order_id)
+        if successor_order_id is None:
+            order_ids.append(order_id)
+        else:
+            order_ids.insert(order_ids.index(successor_order_id), order_id)
+    return order_ids
@@ -0,0 +1,16 @@
+"""
+Prompts for the user, shared by every script.
+"""
+
+# TODO: Allow user to specify [a]bort
+def prompt_user_for_bool(message:str, allow_no_response = False) -> bool:
+    """Prompts the user to respond to a message with 'y' or 'n', or optionally no response"""
+    user_input = None
+    input_options_string = "[y]es/[n]o/[empty]" if allow_no_response else "[y]es/[n]o"
+    while user_input != 'y' and user_input != 'n' and not (allow_no_response and user_input == ""):
+        user_input = input(message + "(" + input_options_string + "): ")
+    if user_input == 'y':
+        return True
+    if user_input == 'n':
+        return False
+    return None
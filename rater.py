@@ -1,6 +1,11 @@
 from foundation import *
 
-import requests, signal, subprocess
+import requests
+
+from rating_queue import RatingQueue
+from sample_player import ClipPool, SamplePlayer, make_player_backend
+from song_store import RATING_ORDER_FEWEST_MISSING, RATING_ORDER_MOST_USED, RATING_ORDER_PLAYLIST
+from stream_resolver import PREFETCH_SONG_COUNT, StreamResolver, StreamURLCache
 
 print("Song rater")
 print("Allows rating songs by certain traits (+2 to -2) while playing a sample of the song. ")
@@ -10,9 +15,25 @@ playlists_db, songs_cache = load_data_files()
 
 # Prompt user to select playlist
 print("\nEnter a playlist number to rate, or enter nothing to rate all songs in the cache. ")
-selected_song_ids = prompt_for_playlist(playlists_db).song_ids
-if selected_song_ids is None:
-    selected_song_ids = songs_cache.keys()
+selected_playlist = prompt_for_playlist(playlists_db)
+
+print("\nWhich songs should be rated first? ")
+rating_orders = {"p" : RATING_ORDER_PLAYLIST, "m" : RATING_ORDER_MOST_USED, "f" : RATING_ORDER_FEWEST_MISSING}
+selected_rating_order = None
+while selected_rating_order is None:
+    order_input = input("[P]laylist order, songs in the [m]ost playlists, or songs missing the [f]ewest ratings: ").lower()
+    if order_input == "":
+        order_input = "p"
+    selected_rating_order = rating_orders.get(order_input[:1])
+    if selected_rating_order is None:
+        print("Invalid order. Enter p, m or f. ")
+
+# Songs missing ratings come from the song store's index, without loading every song
+rating_queue = RatingQueue(get_song_store().get_unrated_song_ids(None if selected_playlist is None else selected_playlist.yt_id, selected_rating_order))
+if len(rating_queue) == 0:
+    print("\nEvery song already has the latest ratings. ")
+else:
+    print("\n" + str(len(rating_queue)) + " songs need ratings, which should take about " + str(round(rating_queue.get_estimated_time_left_s() / 60)) + " minutes. ")
 
 print("\nWhat output volume should song samples be played at?  0 disables playback. ")
 desired_volume = None
@@ -62,129 +83,67 @@ if desired_volume > 0:
 
 num_songs_rated = 0
 
-def extract_playback_url_from_json(json):
-    """
-    Parse the response JSON to find preferred audio formats
-    251 is higher quality OPUS audio (for all videos)
-    140 and 141 are YouTube Music AAC formats
-    18 is 360p MP4, a legacy non-DASH video+audio format
-    """
-    # TODO: Warn user to refresh cookies.txt if lower quality detected, premium only song encountered, or private song encountered
-    for perferred_format in ["251", "140", "141", "18"]:
-        for format_json in json['formats']:
-            if format_json['format_id'] == perferred_format:
-                return format_json['url'], perferred_format
-    return None, None
-
-# TODO: Notify user of how many songs to rate (have to iterate over every song, check if rated, and tally)
+# Look up and decode samples of the next few songs while the current one is rated
+clip_pool = None
+sample_player = None
+if desired_volume > 0:
+    clip_pool = ClipPool(StreamResolver(cookies_file_path, url_cache=StreamURLCache()), sample_time_offset, desired_volume, PREFETCH_SONG_COUNT + 1)
+    sample_player = SamplePlayer(make_player_backend())
 
 # For each song, prompt user to rate on each trait
-for index, song_id in enumerate(selected_song_ids):
+while len(rating_queue) > 0:
     should_exit_rating_loop = False
     skip_to_next_song = False
     song_rated = False
 
-    target_song = songs_cache[song_id]
-
-    if not target_song.has_latest_ratings():
-        print("\n\"" + target_song.name + "\" by \"" + target_song.artist + "\"")
-
-        # Play a sample of the song in the background, unless disabled
-        player = None
-        if desired_volume > 0:
-            play_url = None
-            play_format = None
-            ytdlp_path_candidates = ["yt-dlp", "./yt-dlp", "yt-dlp.exe", "./yt-dlp.exe"] # TODO: Are last 2 not necessary?
-            for ytdlp_path_index, ytdlp_path in enumerate(ytdlp_path_candidates):
-                ytdlp_found = False
-                try:
-                    yt_manifest_text = subprocess.check_output(ytdlp_path + " -j " + \
-                                                               ("--cookies " + cookies_file_path + " " if cookies_file_path is not None else " ") + \
-                                                               "--extractor-args player_client:web_music " + \
-                                                               "-- " + song_id)
-                    yt_manifest = json.loads(yt_manifest_text)
-                    play_url, play_format = extract_playback_url_from_json(yt_manifest)
-                    if play_url is not None:
-                        break
-                except Exception as error:
-                    print("Failed to acquire stream for song sample (ID " + song_id + "). ")
-                    if type(error) is FileNotFoundError and not ytdlp_found:
-                        print("Helper program not found, please install yt-dlp, or be sure you placed yt-dlp.exe in this program folder. ")
-                    else:
-                        ytdlp_found = True
-            song_time_offset = sample_time_offset
-            if play_url is None:
-                # If youtube playback isn't available, try Spotify's MP3 preview
-                print("Falling back to Spotify song preview")
-                play_url = target_song.spotify_preview_url
-                # Preview is short so ignore offset
-                song_time_offset = 0
-            if play_url is not None:
-                # Try different ffplay paths
-                ffplay_path_candidates = ["ffplay.exe", "ffmpeg/bin/ffplay.exe", "ffplay", "ffmpeg/bin/ffplay"]
-                for ffplay_path_index, ffplay_path in enumerate(ffplay_path_candidates):
-                    try:
-                        player = subprocess.Popen(ffplay_path + " " + play_url + " -volume " + str(desired_volume) + " -ss " + str(song_time_offset) + " -nodisp -loglevel error", stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
-                        # stdout=subprocess.DEVNULL,
-                        break # Player launched successfully, stop trying ffplay paths
-                    except Exception as error:
-                        if ffplay_path_index == len(ffplay_path_candidates) - 1: # Exhausted ffplay paths
-                            print("Failed to play stream for song sample (ID " + song_id + "). ")
-                            if type(error) is FileNotFoundError:
-                                print("Helper program not found, please install ffmpeg and yt-dlp, or be sure you placed yt-dlp.exe and a copy of the folder \"ffmpeg\" (containing bin/ff*.exe) in this program folder. ")
-        target_ratings = target_song.user_ratings
-        if target_ratings is None:
-            target_ratings = dict()
-            target_song.user_ratings = target_ratings
-        for trait in USER_RATINGS:
-            while trait not in target_ratings or target_ratings[trait] is None:
-                # TODO: Support undoing rating
-                try:
-                    rating_input = input(trait + ": ")
-                    if rating_input == "e":
-                        should_exit_rating_loop = True
-                        break
-                    elif rating_input == "s":
-                        skip_to_next_song = True
-                        break
-                    rating = int(rating_input)
-                    assert -2 <= rating <= 2
-                    target_ratings[trait] = rating
-                    song_rated = True
-                except:
-                    print("Invalid rating. Enter -2 to 2, [e]xit, or [s]kip. ")
-            if should_exit_rating_loop or skip_to_next_song:
-                break
-        if song_rated:
-            if desired_reminder_frequency != 0 and num_songs_rated % desired_reminder_frequency == 0:
-                print_traits_info()
-            num_songs_rated = num_songs_rated + 1
-        if player is not None:
-            # TODO: if windows, else...
-            subprocess.call(['taskkill', '/F', '/T', '/PID',  str(player.pid)], stdout=subprocess.DEVNULL) #, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-            #os.kill(player.pid, signal.SIGTERM)
-            # TODO: Sometimes termianting the player leaves its child running, try switching from Popen() to run(), and also maybe running process with shell flag enabled
-            # Can't use signal 1, it kills python process
-            # signal.SIGBREAK and signal.SIG_DFL not found (at least on Windows)
-            """
-            for index, signal in enumerate([signal.SIGINT, signal.SIGTERM]):
-                try:
-                    print("Trying to kill player with signal " + str(index))
-                    player.send_signal(signal)
-                    if player.poll() == None: # Player alive after signal sent
-                        time.sleep(1.5) # Wait a moment for player to die
-                        if player.poll() != None: # Player killed after waiting
-                            break # Stop trying kill signals
-                    else: # Player was instantly killed
-                        break # Stop trying kill signals
-                except:
-                    pass
-            """
-        if should_exit_rating_loop:
+    target_song = songs_cache[rating_queue.take()]
+    print("\n" + rating_queue.describe_progress() + ". ")
+    print("\"" + target_song.name + "\" by \"" + target_song.artist + "\"")
+
+    # Play a sample of the song in the background, unless disabled
+    if clip_pool is not None:
+        clip_pool.prepare([target_song] + [songs_cache[song_id] for song_id in rating_queue.peek(PREFETCH_SONG_COUNT)])
+        sample_player.play_when_ready(clip_pool.get_clip(target_song))
+    if target_song.user_ratings is None:
+        target_song.user_ratings = dict()
+    target_ratings = target_song.user_ratings
+    for trait in USER_RATINGS:
+        while trait not in target_ratings or target_ratings[trait] is None:
+            # TODO: Support undoing rating
+            if sample_player is not None:
+                sample_player.print_messages()
+            try:
+                rating_input = input(trait + ": ")
+                if rating_input == "e":
+                    should_exit_rating_loop = True
+                    break
+                elif rating_input == "s":
+                    skip_to_next_song = True
+                    break
+                rating = int(rating_input)
+                assert -2 <= rating <= 2
+                target_ratings[trait] = rating
+                song_rated = True
+            except:
+                print("Invalid rating. Enter -2 to 2, [e]xit, or [s]kip. ")
+        if should_exit_rating_loop or skip_to_next_song:
             break
-        elif skip_to_next_song:
-            continue
-
+    if song_rated:
+        save_song(target_song)
+        if desired_reminder_frequency != 0 and num_songs_rated % desired_reminder_frequency == 0:
+            print_traits_info()
+        num_songs_rated = num_songs_rated + 1
+    if clip_pool is not None:
+        sample_player.stop()
+        clip_pool.forget(target_song.yt_id)
+    if should_exit_rating_loop:
+        break
+    elif skip_to_next_song:
+        continue
+
+rating_queue.finish()
+if clip_pool is not None:
+    clip_pool.close()
 print("\nRated " + str(num_songs_rated) + " songs; saving song cache and exiting. ")
 cleanup_song_cache(songs_cache, playlists_db)
 write_song_cache(songs_cache)
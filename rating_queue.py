@@ -0,0 +1,52 @@
+"""
+The songs left to rate in one rater session, with how many are done and how long the rest
+should take.  The songs come from the song store's index of unrated songs, so nothing has to
+be loaded to find or count them.
+"""
+
+import collections, time
+
+# Guess of how long rating a song takes, until some songs have been rated this session
+ESTIMATED_RATING_TIME_S = 30
+
+class RatingQueue:
+    """Song IDs to rate, in order.  Times each song from when it's taken to when the next one is."""
+    song_ids = None # deque of song IDs not taken yet
+    total_count = 0
+    done_count = 0 # Songs taken and finished, rated or skipped
+    done_time_s = 0.0 # Time spent on finished songs
+    current_start_time = None # When the song being rated was taken, or None
+
+    def __init__(self, song_ids : list):
+        self.song_ids = collections.deque(song_ids)
+        self.total_count = len(self.song_ids)
+
+    def __len__(self) -> int:
+        """Returns how many songs haven't been taken yet."""
+        return len(self.song_ids)
+
+    def take(self) -> str:
+        """Finishes the song being rated, if any, and returns the next song ID."""
+        self.finish()
+        self.current_start_time = time.time()
+        return self.song_ids.popleft()
+
+    def finish(self):
+        """Marks the song being rated as done."""
+        if self.current_start_time is not None:
+            self.done_count = self.done_count + 1
+            self.done_time_s = self.done_time_s + time.time() - self.current_start_time
+            self.current_start_time = None
+
+    def peek(self, count : int) -> list:
+        """Returns up to count of the next song IDs, without taking them."""
+        return [self.song_ids[index] for index in range(min(count, len(self.song_ids)))]
+
+    def get_estimated_time_left_s(self) -> float:
+        """Estimates how long the songs not finished yet take, from how long finished ones took."""
+        time_per_song_s = self.done_time_s / self.done_count if self.done_count > 0 else ESTIMATED_RATING_TIME_S
+        return (self.total_count - self.done_count) * time_per_song_s
+
+    def describe_progress(self) -> str:
+        return "Song " + str(self.done_count + 1) + " of " + str(self.total_count) + \
+               ", about " + str(round(self.get_estimated_time_left_s() / 60)) + " minutes left"
@@ -0,0 +1,325 @@
+"""
+Plays song samples from memory, decoding the next few songs' samples ahead of time.
+
+Starting a player on a stream URL means seeking over the network before anything plays, and
+starting a new player program for each song.  Instead, a pool of worker threads runs ffmpeg
+for each of the next few songs to rate, decoding only the sample (SAMPLE_LENGTH_S seconds
+starting at the chosen offset) into a buffer of PCM audio held in memory.  When a song comes
+up, its sample is usually ready, so it starts playing right away, and stopping it is instant.
+Samples decoded ahead of time wait as long as it takes to find the YouTube stream.  If a song
+comes up before its sample is ready, and it has a Spotify preview, the sample only gets a
+moment (MAX_RESOLVE_WAIT_S) to finish before the preview is decoded instead, so a slow lookup
+doesn't hold up the user.
+
+Playback goes through a backend: the sounddevice library if it's installed, else ffplay
+reading the buffer from its input, else (or when playback is disabled) a backend that plays
+nothing and only records what it was asked to play, for running without audio.  Every helper
+program this starts is tracked, and stopped (terminated, then killed if it doesn't exit) when
+its sample is no longer needed or the program exits, so none are left running.
+"""
+
+import atexit, os, signal, subprocess, threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+import numpy
+
+from stream_resolver import FFMPEG_PATH_CANDIDATES, FFPLAY_PATH_CANDIDATES, MAX_RESOLVE_WAIT_S, STREAM_YOUTUBE, StreamResolver, \
+                            find_helper_program
+
+# Seconds of each song to play
+SAMPLE_LENGTH_S = 30
+# Samples are decoded to mono 16-bit PCM at this rate, the raw audio format's default in ffmpeg
+SAMPLE_RATE_HZ = 44100
+# Longest a helper program gets to decode a sample
+DECODE_TIMEOUT_S = 60
+# How long a helper program gets to exit after being asked to, before it's killed
+PROCESS_STOP_TIMEOUT_S = 1.0
+
+class Clip:
+    """A song's decoded sample."""
+    yt_id = None
+    pcm = None # numpy array of int16 samples
+    stream_kind = None # STREAM_YOUTUBE or STREAM_SPOTIFY_PREVIEW
+    messages = None # list of notes for the user about how the sample was found
+
+    def __init__(self, yt_id : str):
+        self.yt_id = yt_id
+        self.messages = list()
+
+    def get_duration_s(self) -> float:
+        return len(self.pcm) / SAMPLE_RATE_HZ
+
+class HelperProcesses:
+    """
+    Starts helper programs and stops them when asked, or when this program exits.  Thread safe.
+    On POSIX systems each program gets its own process group, so stopping it stops any programs
+    it started too.
+    """
+    processes = None # set of running Popen
+    lock = None
+
+    def __init__(self):
+        self.processes = set()
+        self.lock = threading.Lock()
+        atexit.register(self.stop_all)
+
+    def start(self, args : list, **popen_args) -> subprocess.Popen:
+        if os.name == 'posix':
+            popen_args['start_new_session'] = True
+        process = subprocess.Popen(args, **popen_args)
+        with self.lock:
+            self.processes.add(process)
+        return process
+
+    def stop(self, process : subprocess.Popen):
+        """Asks a process to exit, kills it if it doesn't, and waits for it."""
+        with self.lock:
+            self.processes.discard(process)
+        if process.poll() is None:
+            self._send_stop_signal(process, is_forced=False)
+            try:
+                process.wait(timeout=PROCESS_STOP_TIMEOUT_S)
+            except subprocess.TimeoutExpired:
+                self._send_stop_signal(process, is_forced=True)
+                process.wait()
+            if os.name == 'posix':
+                # Stop anything the program started that is still running
+                self._send_stop_signal(process, is_forced=True)
+        for pipe in [process.stdin, process.stdout]:
+            if pipe is not None:
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+
+    def _send_stop_signal(self, process : subprocess.Popen, is_forced : bool):
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, signal.SIGKILL if is_forced else signal.SIGTERM)
+            elif is_forced:
+                process.kill()
+            else:
+                process.terminate()
+        except (ProcessLookupError, PermissionError):
+            pass # Already exited
+
+    def stop_all(self):
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            self.stop(process)
+
+HELPER_PROCESSES = HelperProcesses()
+
+def decode_sample(url : str, offset_s : float, length_s : float, volume_percent : int, ffmpeg_path : str) -> numpy.ndarray:
+    """Runs ffmpeg to decode length_s seconds of a stream starting at offset_s, at the given
+       volume, and returns the samples.  Raises RuntimeError if ffmpeg fails."""
+    process = HELPER_PROCESSES.start([ffmpeg_path, "-nostdin", "-loglevel", "error", "-ss", str(offset_s), "-t", str(length_s), "-i", url,
+                                      "-filter:a", "volume=" + str(volume_percent / 100), "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE_HZ), "-"],
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        pcm_bytes, _ = process.communicate(timeout=DECODE_TIMEOUT_S)
+    except subprocess.TimeoutExpired:
+        raise RuntimeError("Decoding the sample took too long")
+    finally:
+        HELPER_PROCESSES.stop(process)
+    if process.returncode != 0 or len(pcm_bytes) == 0:
+        raise RuntimeError("Decoding the sample failed")
+    return numpy.frombuffer(pcm_bytes[:len(pcm_bytes) // 2 * 2], dtype=numpy.int16)
+
+class NullBackend:
+    """Plays nothing, and remembers which clips it was asked to play."""
+    played_clips = None # list of Clip
+    playing_clip = None
+
+    def __init__(self):
+        self.played_clips = list()
+
+    def play(self, clip : Clip):
+        self.played_clips.append(clip)
+        self.playing_clip = clip
+
+    def stop(self):
+        self.playing_clip = None
+
+class SoundDeviceBackend:
+    """Plays clips with the sounddevice library."""
+    sounddevice = None # the sounddevice module
+
+    def __init__(self, sounddevice):
+        self.sounddevice = sounddevice
+
+    def play(self, clip : Clip):
+        self.sounddevice.play(clip.pcm, SAMPLE_RATE_HZ)
+
+    def stop(self):
+        self.sounddevice.stop()
+
+class FFplayBackend:
+    """Plays clips by starting ffplay with no window and writing the clip to its input."""
+    ffplay_path = None
+    process = None
+
+    def __init__(self, ffplay_path : str):
+        self.ffplay_path = ffplay_path
+
+    def play(self, clip : Clip):
+        self.stop()
+        process = HELPER_PROCESSES.start([self.ffplay_path, "-nodisp", "-autoexit", "-loglevel", "error", "-f", "s16le", "-i", "-"],
+                                         stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.process = process
+        def write_clip():
+            try:
+                process.stdin.write(clip.pcm.tobytes())
+                process.stdin.close()
+            except (OSError, ValueError):
+                pass # Stopped before the whole clip was written
+        threading.Thread(target=write_clip, daemon=True).start()
+
+    def stop(self):
+        if self.process is not None:
+            HELPER_PROCESSES.stop(self.process)
+            self.process = None
+
+def make_player_backend(is_playback_enabled=True):
+    """Returns the best available backend, or a NullBackend if playback is disabled or impossible."""
+    if not is_playback_enabled:
+        return NullBackend()
+    try:
+        import sounddevice
+        sounddevice.query_devices(kind='output')
+        return SoundDeviceBackend(sounddevice)
+    except Exception:
+        pass # Not installed, or no output device
+    ffplay_path = find_helper_program(FFPLAY_PATH_CANDIDATES)
+    if ffplay_path is not None:
+        return FFplayBackend(ffplay_path)
+    print("Helper program not found, please install ffmpeg, or be sure you placed a copy of the folder \"ffmpeg\" (containing bin/ff*.exe) in this program folder. ")
+    return NullBackend()
+
+class ClipPool:
+    """Decodes samples of songs that will be rated soon on worker threads, and holds them until they're played."""
+    stream_resolver = None # StreamResolver
+    sample_offset_s = None
+    volume_percent = None
+    ffmpeg_path = None
+    executor = None
+    fallback_executor = None # Decodes previews for songs that came up before their samples were ready
+    clips = None # dict of YouTube ID to Future of Clip
+    lock = None
+
+    def __init__(self, stream_resolver : StreamResolver, sample_offset_s : float, volume_percent : int, worker_count : int):
+        self.stream_resolver = stream_resolver
+        self.sample_offset_s = sample_offset_s
+        self.volume_percent = volume_percent
+        self.ffmpeg_path = find_helper_program(FFMPEG_PATH_CANDIDATES)
+        self.executor = ThreadPoolExecutor(max_workers=worker_count)
+        self.fallback_executor = ThreadPoolExecutor(max_workers=1)
+        self.clips = dict()
+        self.lock = threading.Lock()
+
+    def _make_clip(self, song, max_wait_s=None) -> Clip:
+        clip = Clip(song.yt_id)
+        if self.ffmpeg_path is None:
+            clip.messages.append("Helper program not found, please install ffmpeg, or be sure you placed a copy of the folder \"ffmpeg\" (containing bin/ff*.exe) in this program folder. ")
+            return clip
+        stream = self.stream_resolver.get_stream(song, max_wait_s=max_wait_s, report=clip.messages.append)
+        if stream is None:
+            return clip
+        clip.stream_kind = stream.kind
+        # Preview is short so ignore offset
+        offset_s = self.sample_offset_s if stream.kind == STREAM_YOUTUBE else 0
+        try:
+            clip.pcm = decode_sample(stream.url, offset_s, SAMPLE_LENGTH_S, self.volume_percent, self.ffmpeg_path)
+        except RuntimeError as error:
+            clip.messages.append("Failed to play stream for song sample (ID " + song.yt_id + "): " + str(error))
+        return clip
+
+    def prepare(self, songs : list):
+        """Starts decoding the samples of songs that will be rated soon, in order."""
+        self.stream_resolver.prefetch(songs)
+        with self.lock:
+            for song in songs:
+                if song.yt_id not in self.clips:
+                    self.clips[song.yt_id] = self.executor.submit(self._make_clip, song)
+
+    def get_clip(self, song) -> Future:
+        """Returns the Future of a song's clip, starting to decode it if it wasn't already.  If the
+           song has a Spotify preview and its clip isn't ready within MAX_RESOLVE_WAIT_S, returns a
+           clip of whichever stream is found by then (usually the preview) instead."""
+        self.prepare([song])
+        with self.lock:
+            clip_future = self.clips[song.yt_id]
+        if song.spotify_preview_url is None or len(wait([clip_future], timeout=MAX_RESOLVE_WAIT_S).done) > 0:
+            return clip_future
+        clip_future.cancel() # Only stops it if it hasn't started
+        fallback_clip_future = self.fallback_executor.submit(self._make_clip, song, 0)
+        with self.lock:
+            self.clips[song.yt_id] = fallback_clip_future
+        return fallback_clip_future
+
+    def forget(self, yt_id : str):
+        """Drops a song's clip once it won't be played again."""
+        with self.lock:
+            self.clips.pop(yt_id, None)
+        self.stream_resolver.forget(yt_id)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.fallback_executor.shutdown(wait=False, cancel_futures=True)
+        self.stream_resolver.close()
+        HELPER_PROCESSES.stop_all()
+
+class SamplePlayer:
+    """
+    Plays one clip at a time, starting each as soon as it's decoded unless it was stopped first.
+    Clips can finish decoding while the user is typing, so notes about them are held until
+    print_messages() is called from the main thread instead of being printed over the prompt.
+    """
+    backend = None
+    play_number = 0 # Counts play requests, so a clip that's decoded after being stopped isn't played
+    messages = None # list of notes about played clips, not printed yet
+    lock = None
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.messages = list()
+        self.lock = threading.Lock()
+
+    def play_when_ready(self, clip_future : Future):
+        """Plays a clip right away if it's decoded, or else as soon as it is.  Holds any notes about it for print_messages()."""
+        with self.lock:
+            self.backend.stop()
+            self.play_number = self.play_number + 1
+            play_number = self.play_number
+        if not clip_future.done():
+            print("Sample is still loading, it will play when ready. ")
+        def play_clip(clip_future : Future):
+            if clip_future.cancelled():
+                return
+            error = clip_future.exception()
+            with self.lock:
+                if play_number != self.play_number:
+                    return
+                if error is not None:
+                    self.messages.append("Failed to play song sample: " + str(error))
+                    return
+                clip = clip_future.result()
+                self.messages.extend(clip.messages)
+                if clip.pcm is not None:
+                    self.backend.play(clip)
+        clip_future.add_done_callback(play_clip)
+
+    def print_messages(self):
+        """Prints the notes about played clips that haven't been printed yet."""
+        with self.lock:
+            messages = self.messages
+            self.messages = list()
+        for message in messages:
+            print(message)
+
+    def stop(self):
+        with self.lock:
+            self.play_number = self.play_number + 1
+            self.backend.stop()
+        self.print_messages()
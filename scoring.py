@@ -0,0 +1,254 @@
+"""
+Song similarity scoring.  Scores go from 1.0 (as similar as possible) down to 0.0.
+
+get_similarity_score_v1() scores one pair of songs at a time.  For sorting, songs are packed
+into a SongFeatures object once so that whole blocks of the similarity matrix can be scored
+with NumPy broadcasting, which gives the exact same results as calling the v1 function per pair.
+A SongTable holds the same columns for a whole library, so any playlist's features can be
+taken from it by row instead of from Song objects.  load_song_table() reads one straight from
+the song store's memory-mapped feature file.
+"""
+
+import math
+
+import numpy
+
+from song_model import CAMELOT_POSITIONS, MAX_BPM, MIN_BPM, USER_RATINGS, Song
+from song_records import NO_RATING
+from feature_file import FeatureFile
+
+# Version of the similarity scoring below.  Bump it whenever a change gives different scores,
+# so that distances cached on disk (see distance_cache.py) are scored again.
+SCORING_VERSION = 1
+
+def smoothstep(x, x_min=0, x_max=1, N=1):
+    """A sigmoid/s-curve/clamping function that modifies some score.  As the score drops from 1.0,
+       the smoothed result will gently slope away but begins to ramp up, then becomes more gentle
+       again as it approaches 0.  N is the number of smoothing passes.
+       Works on single numbers or on NumPy arrays (element-wise).  Powers are done by repeated
+       multiplication because NumPy rounds scalar and array powers differently.
+       Taken from https://stackoverflow.com/a/45166120 """
+    x = numpy.clip((x - x_min) / (x_max - x_min), 0, 1)
+    result = 0
+    negative_x_power = 1.0
+    for n in range(0, N + 1):
+         result += math.comb(N + n, n) * math.comb(2 * N + 1, N - n) * negative_x_power
+         negative_x_power = negative_x_power * -x
+    x_power = x
+    for _ in range(N):
+        x_power = x_power * x
+    result *= x_power
+    return result
+
+def get_similarity_score_v1(song1 : Song, song2 : Song) -> float:
+    """Computes the similarity of songs and returns a score between 1.0 and 0.0.
+       The similarity score is 35% key, 30% BPM, and 35% user ratings.
+       Score v1 does not consider the "momentum" of previous changes that would
+       allow changes to continue in a similar direction."""
+
+    # Key subscore is 1.0 if identical, 0.8 if changing one unit over, etc.
+    hops_between_keys = abs(song1.camelot_position - song2.camelot_position)
+    if hops_between_keys > (CAMELOT_POSITIONS / 2):
+        hops_between_keys = CAMELOT_POSITIONS - hops_between_keys
+    if song1.camelot_is_minor != song2.camelot_is_minor:
+        hops_between_keys = hops_between_keys + 1
+    key_subscore = 1.0 - (0.2 * hops_between_keys)
+    if key_subscore < 0.0:
+        key_subscore = 0.0
+
+    # BPM subscore is the difference between BPMs, smoothed
+    lower_bpm = min(song1.bpm, song2.bpm)
+    higher_bpm = max(song1.bpm, song2.bpm)
+    bpm_difference = higher_bpm - lower_bpm
+    # Since BPMs are normalized in a range, consider doubling the lower BPM to match the higher BPM
+    # Divide by 1.5 since we could have used higher_bpm/2 instead, so we'll average the difference between them
+    # TODO later: consider increasing the divisor to punish wrapping around
+    wraparound_bpm_difference = (lower_bpm * 2 - higher_bpm) / 1.5
+    bpm_difference = min([bpm_difference, wraparound_bpm_difference])
+    # Do smoothstep to keep give similar BPMs a higher score
+    # TODO later: consider a curve that doesn't smooth out towards 0, maybe by only using half of the smoothstep graph
+    max_bpm_difference = (MAX_BPM - MIN_BPM) / 2
+    bpm_subscore = (max_bpm_difference - smoothstep(bpm_difference, x_min=0, x_max=max_bpm_difference)) / max_bpm_difference
+
+    # Average all user ratings into a subscore.  Each is 1.0 if identical, 0.75 if one apart, etc.
+    # TODO later: consider ramping the score for point differences, e.g. 1 -> 0.9 -> 0.7 -> 0.4 -> 0
+    user_rating_scores = []
+    for rating_key in USER_RATINGS:
+        rating_difference = abs(song1.user_ratings[rating_key] - song2.user_ratings[rating_key])
+        rating_score = 1.0 - (0.25 * rating_difference)
+        if rating_score < 0.0:
+            rating_score = 0.0
+        user_rating_scores.append(rating_score)
+    user_rating_subscore = sum(user_rating_scores) / len(user_rating_scores)
+
+    return (key_subscore * 0.2) + (bpm_subscore * 0.3) + (user_rating_subscore * 0.5)
+
+class SongFeatures:
+    """The numeric features of a list of songs, packed into parallel NumPy arrays.
+       Row i of every array belongs to song_ids[i]."""
+    song_ids = None # list of strs
+    camelot_positions = None # int64 array
+    camelot_is_minor = None # bool array
+    bpms = None # float64 array
+    user_ratings = None # int64 array of shape (songs, len(USER_RATINGS)), columns in USER_RATINGS order
+
+    def __len__(self):
+        return len(self.song_ids)
+
+class SongTable:
+    """The numeric features of many songs in parallel NumPy arrays, like SongFeatures but kept
+       compact and with an index from song ID to row.  Songs can be missing features: missing
+       key positions are 0, missing BPMs are NaN and missing ratings are NO_RATING."""
+    song_ids = None # list of strs
+    row_for_id = None # dict of song ID to row
+    camelot_positions = None # int8 array
+    camelot_is_minor = None # bool array
+    bpms = None # float64 array, so scores match scoring Song objects exactly
+    user_ratings = None # int8 array of shape (songs, len(USER_RATINGS)), columns in USER_RATINGS order
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def get_missing_features(self, rows) -> numpy.ndarray:
+        """Returns whether each of the given rows is missing any feature needed for scoring."""
+        return (self.camelot_positions[rows] == 0) | numpy.isnan(self.bpms[rows]) | (self.user_ratings[rows] == NO_RATING).any(axis=1)
+
+    def get_features(self, song_ids : list) -> SongFeatures:
+        """Copies the given songs' rows into a SongFeatures object.  Raises ValueError if a song
+           isn't in the table or is missing any feature, since it can't be scored."""
+        missing_song_ids = [song_id for song_id in song_ids if song_id not in self.row_for_id]
+        rows = numpy.array([self.row_for_id.get(song_id, 0) for song_id in song_ids], dtype=numpy.int64)
+        missing_song_ids += [song_ids[index] for index in numpy.flatnonzero(self.get_missing_features(rows))]
+        if len(missing_song_ids) > 0:
+            raise ValueError(str(len(missing_song_ids)) + " songs can't be scored because they are missing features, such as song ID " + str(missing_song_ids[0]))
+        features = SongFeatures()
+        features.song_ids = list(song_ids)
+        features.camelot_positions = self.camelot_positions[rows].astype(numpy.int64)
+        features.camelot_is_minor = self.camelot_is_minor[rows]
+        features.bpms = self.bpms[rows]
+        features.user_ratings = self.user_ratings[rows].astype(numpy.int64)
+        return features
+
+def build_song_table(songs_cache : dict[str, Song], song_ids=None) -> SongTable:
+    """Packs the features of the given songs (default: every song in songs_cache) into a SongTable."""
+    song_ids = list(songs_cache.keys() if song_ids is None else song_ids)
+    song_count = len(song_ids)
+    table = SongTable()
+    table.song_ids = song_ids
+    table.row_for_id = {song_id : row for row, song_id in enumerate(song_ids)}
+    table.camelot_positions = numpy.zeros(song_count, dtype=numpy.int8)
+    table.camelot_is_minor = numpy.zeros(song_count, dtype=bool)
+    table.bpms = numpy.full(song_count, numpy.nan, dtype=numpy.float64)
+    table.user_ratings = numpy.full((song_count, len(USER_RATINGS)), NO_RATING, dtype=numpy.int8)
+    for row, song_id in enumerate(song_ids):
+        song = songs_cache[song_id]
+        if song.camelot_position is not None and song.camelot_is_minor is not None:
+            table.camelot_positions[row] = song.camelot_position
+            table.camelot_is_minor[row] = song.camelot_is_minor
+        if song.bpm is not None:
+            table.bpms[row] = song.bpm
+        if song.user_ratings is not None:
+            table.user_ratings[row] = song.user_ratings.rating_numbers
+    return table
+
+def load_song_table(feature_file : FeatureFile, song_ids : list) -> SongTable:
+    """Reads the given songs' rows from a feature file into a SongTable, without loading the songs.
+       Songs without a row are treated as missing every feature."""
+    song_ids = list(song_ids)
+    rows = feature_file.get_rows(song_ids)
+    feature_rows = feature_file.open_memmap()
+    table_rows = numpy.zeros(len(song_ids), dtype=feature_file.dtype)
+    table_rows[rows >= 0] = feature_rows[rows[rows >= 0]]
+    del feature_rows
+    is_set = table_rows['is_set']
+    table = SongTable()
+    table.song_ids = song_ids
+    table.row_for_id = {song_id : row for row, song_id in enumerate(song_ids)}
+    table.camelot_positions = numpy.where(is_set, table_rows['camelot_position'], 0).astype(numpy.int8)
+    table.camelot_is_minor = table_rows['camelot_is_minor'].copy()
+    table.bpms = numpy.where(is_set, table_rows['bpm'], numpy.nan)
+    table.user_ratings = numpy.where(is_set[:, numpy.newaxis], table_rows['user_ratings'], NO_RATING).astype(numpy.int8)
+    return table
+
+def pack_song_features(song_ids : list, songs_cache : dict[str, Song]) -> SongFeatures:
+    """Copies the scoring features of the given songs into a SongFeatures object.  songs_cache
+       can also be a SongTable, which is much faster for large playlists.
+       Raises ValueError if a song is missing any feature, since it can't be scored."""
+    if isinstance(songs_cache, SongTable):
+        return songs_cache.get_features(song_ids)
+    song_count = len(song_ids)
+    features = SongFeatures()
+    features.song_ids = list(song_ids)
+    features.camelot_positions = numpy.empty(song_count, dtype=numpy.int64)
+    features.camelot_is_minor = numpy.empty(song_count, dtype=bool)
+    features.bpms = numpy.empty(song_count, dtype=numpy.float64)
+    features.user_ratings = numpy.empty((song_count, len(USER_RATINGS)), dtype=numpy.int64)
+
+    for row, song_id in enumerate(features.song_ids):
+        song = songs_cache[song_id]
+        ratings = song.user_ratings if song.user_ratings is not None else {}
+        missing_fields = [field_name for field_name in ['camelot_position', 'camelot_is_minor', 'bpm'] if getattr(song, field_name) is None]
+        missing_fields += [rating_name + " rating" for rating_name in USER_RATINGS if ratings.get(rating_name) is None]
+        if len(missing_fields) > 0:
+            raise ValueError("Song \"" + str(song.name) + "\" (ID " + str(song_id) + ") can't be scored because it is missing: " + ", ".join(missing_fields))
+        features.camelot_positions[row] = song.camelot_position
+        features.camelot_is_minor[row] = song.camelot_is_minor
+        features.bpms[row] = song.bpm
+        features.user_ratings[row] = ratings.rating_numbers
+    return features
+
+def get_similarity_matrix(features : SongFeatures, row_indices=None, column_indices=None) -> numpy.ndarray:
+    """Scores every pair of songs between the given rows and columns (defaults to all songs),
+       returning a float64 matrix of shape (rows, columns).  Each element equals the result of
+       get_similarity_score_v1() for that pair."""
+    all_indices = numpy.arange(len(features))
+    row_indices = all_indices if row_indices is None else all_indices[row_indices]
+    column_indices = all_indices if column_indices is None else all_indices[column_indices]
+    return _get_broadcast_similarity_scores(features, row_indices[:, numpy.newaxis], column_indices[numpy.newaxis, :])
+
+def get_pair_similarity_scores(features : SongFeatures, row_indices, column_indices) -> numpy.ndarray:
+    """Scores each song in row_indices against the song at the same position in column_indices,
+       returning a float64 array.  Each element equals the result of get_similarity_score_v1()."""
+    return _get_broadcast_similarity_scores(features, numpy.asarray(row_indices), numpy.asarray(column_indices))
+
+def _get_broadcast_similarity_scores(features : SongFeatures, row_indices : numpy.ndarray, column_indices : numpy.ndarray) -> numpy.ndarray:
+    """Scores songs row_indices against songs column_indices, broadcasting the two index arrays
+       against each other.  The operations below mirror get_similarity_score_v1() step by step."""
+    # Key subscore
+    hops_between_keys = numpy.abs(features.camelot_positions[row_indices] - features.camelot_positions[column_indices])
+    hops_between_keys = numpy.where(hops_between_keys > (CAMELOT_POSITIONS / 2), CAMELOT_POSITIONS - hops_between_keys, hops_between_keys)
+    hops_between_keys = hops_between_keys + (features.camelot_is_minor[row_indices] != features.camelot_is_minor[column_indices])
+    key_subscore = numpy.maximum(1.0 - (0.2 * hops_between_keys), 0.0)
+
+    # BPM subscore
+    row_bpms = features.bpms[row_indices]
+    column_bpms = features.bpms[column_indices]
+    lower_bpm = numpy.minimum(row_bpms, column_bpms)
+    higher_bpm = numpy.maximum(row_bpms, column_bpms)
+    bpm_difference = higher_bpm - lower_bpm
+    wraparound_bpm_difference = (lower_bpm * 2 - higher_bpm) / 1.5
+    bpm_difference = numpy.minimum(bpm_difference, wraparound_bpm_difference)
+    max_bpm_difference = (MAX_BPM - MIN_BPM) / 2
+    bpm_subscore = (max_bpm_difference - smoothstep(bpm_difference, x_min=0, x_max=max_bpm_difference)) / max_bpm_difference
+
+    # User ratings subscore, summed in the same order as the v1 score
+    user_rating_subscore = 0
+    for rating_column in range(len(USER_RATINGS)):
+        rating_difference = numpy.abs(features.user_ratings[row_indices, rating_column] - features.user_ratings[column_indices, rating_column])
+        rating_score = numpy.maximum(1.0 - (0.25 * rating_difference), 0.0)
+        user_rating_subscore = user_rating_subscore + rating_score
+    user_rating_subscore = user_rating_subscore / len(USER_RATINGS)
+
+    return (key_subscore * 0.2) + (bpm_subscore * 0.3) + (user_rating_subscore * 0.5)
+
+def get_current_similarity_score(song_ids : list, songs_cache : dict[str, Song]) -> float:
+    """Averages the similarity of each song to the next one, wrapping around from the last song
+       to the first.  Ranges from 0.0 to 1.0, higher is better.  songs_cache can also be a SongTable."""
+    num_songs = len(song_ids)
+    if num_songs == 0:
+        return 0.0
+    features = pack_song_features(song_ids, songs_cache)
+    rows = numpy.arange(num_songs)
+    score = get_pair_similarity_scores(features, rows - 1, rows).sum()
+    # Normalize score so it ranges between 0.0 and 1.0
+    return float(score / num_songs)
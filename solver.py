@@ -0,0 +1,185 @@
+"""
+Playlist ordering as a traveling salesperson problem, solved with OR-Tools.
+
+Each song is a routing node, plus a dummy start node 0 that costs nothing to travel to or
+from, so the solver's round trip becomes an open playlist.  Song i of the input is node i + 1.
+OR-Tools is slow to import, so it is only imported once a solve starts.
+"""
+
+import time
+
+from scoring import pack_song_features
+from distance import DEFAULT_MEMORY_BUDGET_BYTES, DISTANCE_COST_SCALE, FeatureDistances, build_distance_matrix, check_memory_budget
+from candidates import CANDIDATE_NEIGHBOR_COUNT, build_candidate_lists, build_candidate_nearest_neighbor_order, get_symmetric_candidate_lists
+
+# Routing node of the dummy start (and end) of the playlist
+START_NODE = 0
+
+# Names of the local search metaheuristics that can be selected, and their OR-Tools enum names.
+# Metaheuristics other than greedy descent keep searching until they hit a time or solution limit.
+METAHEURISTICS = {'greedy-descent' : 'GREEDY_DESCENT',
+                  'guided-local-search' : 'GUIDED_LOCAL_SEARCH',
+                  'simulated-annealing' : 'SIMULATED_ANNEALING',
+                  'tabu-search' : 'TABU_SEARCH'}
+# Names of OR-Tools FirstSolutionStrategy values that work well for building a first playlist order
+FIRST_SOLUTION_STRATEGIES = ['PATH_CHEAPEST_ARC', 'SAVINGS', 'CHRISTOFIDES', 'GLOBAL_CHEAPEST_ARC', 'LOCAL_CHEAPEST_INSERTION']
+# Time limit used when a metaheuristic is selected without any limit, so the solve still ends
+DEFAULT_METAHEURISTIC_TIME_LIMIT_S = 60
+# Only report progress this often, since the solver can find many solutions per second
+PROGRESS_REPORT_INTERVAL_S = 1.0
+
+def get_node_for_song_index(song_index : int) -> int:
+    """Converts a position in the input song list to its routing node."""
+    return song_index + 1
+
+def get_song_index_for_node(node : int) -> int:
+    """Converts a routing node (other than the start node) to its position in the input song list."""
+    assert node != START_NODE, "The start node is not a song"
+    return node - 1
+
+def get_average_similarity_for_cost(total_cost : int, song_count : int, cost_scale=DISTANCE_COST_SCALE) -> float:
+    """Converts the solver's total cost for a playlist back into the average similarity between neighboring songs."""
+    if song_count < 2:
+        return 1.0
+    return 1.0 - (total_cost / cost_scale) / (song_count - 1)
+
+def print_solver_progress(elapsed_s : float, average_similarity : float):
+    """Default progress callback; prints the best playlist found so far."""
+    print("Best similarity so far: " + str(round(average_similarity, 4)) + " after " + str(round(elapsed_s, 1)) + " seconds. ")
+
+def solve_routing_problem(song_count : int, cost_scale=DISTANCE_COST_SCALE, distance_matrix=None, distance_callback=None,
+                          first_solution_strategy='PATH_CHEAPEST_ARC', time_limit_s=None, solution_limit=None,
+                          metaheuristic=None, progress_callback=print_solver_progress, candidate_lists=None, initial_song_order=None) -> tuple[list, int]:
+    """
+    Do a traveling salesperson solve over songs 0 to song_count - 1, with costs from either a
+    DistanceMatrix or a distance_callback(from_song_index, to_song_index) that returns an integer.
+    first_solution_strategy is the name of an OR-Tools FirstSolutionStrategy (see FIRST_SOLUTION_STRATEGIES).
+    If candidate_lists is given (see candidates.build_candidate_lists()), songs can only be followed
+    by their candidates, songs that have them as a candidate, or the end of the playlist.  OR-Tools
+    rarely finds a first playlist within those restrictions on its own, so the search starts from
+    initial_song_order instead of using first_solution_strategy, and the jumps it makes are allowed too.
+    Returns the song indices in sorted order and the total cost of that order.
+    """
+    assert (distance_matrix is None) != (distance_callback is None), "Give either a distance matrix or a distance callback"
+    assert metaheuristic is None or metaheuristic in METAHEURISTICS, "Unknown metaheuristic " + str(metaheuristic)
+    assert (candidate_lists is None) == (initial_song_order is None), "Candidate lists need an initial song order"
+    if song_count < 2:
+        return list(range(song_count)), 0
+
+    from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+    manager = pywrapcp.RoutingIndexManager(song_count + 1, 1, START_NODE) # 1 "vehicle" (1 result playlist), start at dummy node
+    routing = pywrapcp.RoutingModel(manager)
+
+    if distance_matrix is not None:
+        vertex_traversal_cost = routing.RegisterTransitMatrix(distance_matrix.get_routing_rows())
+    else:
+        def routing_distance_callback(from_index, to_index):
+            # Convert from routing variable Index to routing node, which is the song's position in the input plus one
+            from_node = manager.IndexToNode(from_index)
+            to_node = manager.IndexToNode(to_index)
+            # Dummy start node is perfectly connected, so that it is transparent.
+            if from_node == START_NODE or to_node == START_NODE or from_node == to_node:
+                return 0
+            return distance_callback(get_song_index_for_node(from_node), get_song_index_for_node(to_node))
+        vertex_traversal_cost = routing.RegisterTransitCallback(routing_distance_callback)
+
+    routing.SetArcCostEvaluatorOfAllVehicles(vertex_traversal_cost)
+    if candidate_lists is not None:
+        # Only allow jumps between candidates and the jumps of the initial order; the playlist can still start or end on any song
+        allowed_next_songs = [set(song_candidates.tolist()) for song_candidates in get_symmetric_candidate_lists(candidate_lists)]
+        for from_song_index, to_song_index in zip(initial_song_order[:-1], initial_song_order[1:]):
+            allowed_next_songs[from_song_index].add(to_song_index)
+            allowed_next_songs[to_song_index].add(from_song_index)
+        end_index = routing.End(0)
+        for song_index, next_songs in enumerate(allowed_next_songs):
+            allowed_next_indices = [manager.NodeToIndex(get_node_for_song_index(next_song)) for next_song in sorted(next_songs)]
+            routing.NextVar(manager.NodeToIndex(get_node_for_song_index(song_index))).SetValues(allowed_next_indices + [end_index])
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution_strategy)
+    if metaheuristic is not None:
+        search_parameters.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, METAHEURISTICS[metaheuristic])
+        if metaheuristic != 'greedy-descent' and time_limit_s is None and solution_limit is None:
+            print("No time or solution limit was given for the metaheuristic, so stopping after " + str(DEFAULT_METAHEURISTIC_TIME_LIMIT_S) + " seconds. ")
+            time_limit_s = DEFAULT_METAHEURISTIC_TIME_LIMIT_S
+    if time_limit_s is not None:
+        search_parameters.time_limit.FromMilliseconds(int(time_limit_s * 1000))
+    if solution_limit is not None:
+        search_parameters.solution_limit = solution_limit
+
+    start_time = time.time()
+    if progress_callback is not None:
+        # Solutions are reported in order of improvement, so the latest cost is the best so far
+        last_report_time = [None]
+        def report_progress():
+            current_time = time.time()
+            if last_report_time[0] is None or current_time - last_report_time[0] >= PROGRESS_REPORT_INTERVAL_S:
+                last_report_time[0] = current_time
+                progress_callback(current_time - start_time, get_average_similarity_for_cost(routing.CostVar().Max(), song_count, cost_scale))
+        routing.AddAtSolutionCallback(report_progress)
+
+    if initial_song_order is not None:
+        initial_route = [manager.NodeToIndex(get_node_for_song_index(song_index)) for song_index in initial_song_order]
+        solution = routing.SolveFromAssignmentWithParameters(routing.ReadAssignmentFromRoutes([initial_route], True), search_parameters)
+    else:
+        solution = routing.SolveWithParameters(search_parameters)
+    if not solution:
+        raise Exception("Could not sort playlist, aborting. ")
+    if progress_callback is not None:
+        progress_callback(time.time() - start_time, get_average_similarity_for_cost(solution.ObjectiveValue(), song_count, cost_scale))
+
+    # Follow the route from the start node, skipping the start and end (which are both the dummy node)
+    song_order = []
+    index = solution.Value(routing.NextVar(routing.Start(0)))
+    while not routing.IsEnd(index):
+        song_order.append(get_song_index_for_node(manager.IndexToNode(index)))
+        index = solution.Value(routing.NextVar(index))
+    return song_order, solution.ObjectiveValue()
+
+def solve_for_playlist_order(song_ids : list, songs_cache, costs='matrix', cost_scale=DISTANCE_COST_SCALE,
+                             memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES, time_limit_s=None, solution_limit=None,
+                             metaheuristic=None, progress_callback=print_solver_progress, candidates='all',
+                             neighbor_count=CANDIDATE_NEIGHBOR_COUNT, distance_cache=None) -> list:
+    """
+    Do a traveling salesperson solve and return the song IDs in sorted order.
+    Song IDs should be unique.  costs is 'matrix' to precompute every distance for the solver,
+    or 'callback' to score songs on the fly (also used if the matrix would exceed the memory budget).
+    time_limit_s and solution_limit stop the search early, and metaheuristic is a key of METAHEURISTICS
+    that keeps improving the playlist until a limit is hit.  progress_callback is called with the
+    elapsed seconds and average similarity between neighboring songs whenever a better order is
+    found (at most once every PROGRESS_REPORT_INTERVAL_S), or pass None to disable it.
+    candidates is 'all' to let the solver try every jump between songs, or 'knn' to only allow
+    jumps between each song and its neighbor_count closest songs, which is much quicker for large playlists.
+    songs_cache can be a dict of Songs or a SongTable.  A DistanceCache (see distance_cache.py)
+    saves the distance matrix's scores, so only new pairs of songs are scored next time.
+    """
+    assert costs in ['matrix', 'callback'], "Unknown cost mode " + str(costs)
+    assert candidates in ['all', 'knn'], "Unknown candidate mode " + str(candidates)
+    if len(song_ids) < 2:
+        return list(song_ids)
+
+    # Precompute every distance so the solver can look them up without calling back into Python,
+    # unless the matrix would be too big, then calculate on the fly to avoid n^2 memory usage
+    use_matrix = costs == 'matrix'
+    if use_matrix and not check_memory_budget(len(song_ids), memory_budget_bytes, cost_scale):
+        print("Playlist is too large for a distance matrix within the memory budget; scoring songs on the fly instead. ")
+        use_matrix = False
+
+    distance_matrix = None
+    distance_callback = None
+    candidate_lists = None
+    initial_song_order = None
+    print("Scoring songs...")
+    features = pack_song_features(song_ids, songs_cache)
+    if candidates == 'knn':
+        candidate_lists = build_candidate_lists(features, neighbor_count, cost_scale)
+        initial_song_order = build_candidate_nearest_neighbor_order(FeatureDistances(features, cost_scale), candidate_lists).tolist()
+    if use_matrix:
+        distance_matrix = build_distance_matrix(features, cost_scale, memory_budget_bytes, distance_cache=distance_cache)
+    else:
+        distance_callback = FeatureDistances(features, cost_scale).get
+
+    print("Sorting playlist...")
+    song_order, _ = solve_routing_problem(len(song_ids), cost_scale, distance_matrix, distance_callback, time_limit_s=time_limit_s,
+                                          solution_limit=solution_limit, metaheuristic=metaheuristic, progress_callback=progress_callback,
+                                          candidate_lists=candidate_lists, initial_song_order=initial_song_order)
+    return [song_ids[song_index] for song_index in song_order]
@@ -0,0 +1,234 @@
+"""
+Songs, playlists and their user ratings, with no network access.
+
+These are split from foundation.py so that code which only works with saved songs (the song
+store, scoring and the solvers) can import them without importing the music service
+libraries.  foundation.py re-exports everything here.
+"""
+
+import array
+from collections.abc import MutableMapping
+from functools import total_ordering
+
+from song_records import NO_RATING
+
+# A dictionary of user-ratable traits for each song, where each key is a trait/category
+# and each value is an explanation.  Capitalize strings correctly for UI display.  
+# Can be updated by adding new rating fields and/or moving out deprecated fields.  
+# Ratings are presumed to go from +2 (strongly matches category) to -2 (extreme opposite of category)
+# TODO: Ideas: Frission?  Boppable (but that's basicaly drive)?
+USER_RATINGS = {'Positivity' : 'Hopeful and optimistic, or regretful and pessimistic.',
+                'Drive' : 'Driving and forceful, or unhurried and gentle.',
+                'Presence' : 'Captivating and focused, or detached and distant.',
+                'Complexity' : 'Crowded and busy, or simple and manageable.'}
+
+# Deprecated ratings can be moved here so program will prompt users to re-rate accordingly
+DEPRECATED_RATINGS = {}
+
+# Constants for logic
+CAMELOT_POSITIONS = 12
+MIN_BPM = 90 # Inclusive
+MAX_BPM = 180 # Exclusive
+assert MIN_BPM * 2 == MAX_BPM, "BPM range is invalid"
+
+def set_slots_from_state(target_object, state) -> dict:
+    """Sets an object's slots from pickled state, which is a dict of member names and values.
+       Pickles from before the classes had slots hold a plain dict too.  Unknown members are
+       ignored.  Returns the state as a dict."""
+    if isinstance(state, tuple): # (instance dict, slots dict), as pickled by default for slotted classes
+        state = {**(state[0] or {}), **(state[1] or {})}
+    slot_names = type(target_object).__slots__
+    for member_name, value in state.items():
+        if member_name in slot_names:
+            setattr(target_object, member_name, value)
+    return state
+
+class Playlist:
+    """A YouTube Music playlist containing songs"""
+    __slots__ = ('name', 'song_ids', 'yt_id', 'order_ids')
+
+    def __init__(self):
+        self.name = None
+        self.song_ids = None # list of strs
+        self.yt_id = None
+        self.order_ids = None # list of strs
+
+    def __getstate__(self) -> dict:
+        return {member_name : getattr(self, member_name) for member_name in self.__slots__}
+
+    def __setstate__(self, state):
+        self.__init__()
+        set_slots_from_state(self, state)
+
+# Ratings are stored as one signed byte per rating in USER_RATINGS order, with NO_RATING for ratings not given yet
+RATING_COLUMNS = {rating_name : column for column, rating_name in enumerate(USER_RATINGS)}
+
+class SongRatings(MutableMapping):
+    """A song's user ratings as a dict of rating name to rating number, holding only the ratings
+       that have been given.  Stored as a fixed-width array of small ints in USER_RATINGS order."""
+    __slots__ = ('rating_numbers',)
+
+    def __init__(self, ratings=None):
+        """Takes a dict of rating name to rating number, or the bytes of a ratings array."""
+        self.rating_numbers = array.array('b')
+        if isinstance(ratings, (bytes, bytearray)):
+            assert len(ratings) == len(USER_RATINGS), "Ratings array has the wrong number of ratings"
+            self.rating_numbers.frombytes(ratings)
+        else:
+            self.rating_numbers.extend([NO_RATING] * len(USER_RATINGS))
+            if ratings is not None:
+                for rating_name, rating_number in ratings.items():
+                    # Deprecated ratings aren't kept
+                    if rating_name in RATING_COLUMNS:
+                        self[rating_name] = rating_number
+
+    def __getitem__(self, rating_name : str) -> int:
+        rating_number = self.rating_numbers[RATING_COLUMNS[rating_name]]
+        if rating_number == NO_RATING:
+            raise KeyError(rating_name)
+        return rating_number
+
+    def __setitem__(self, rating_name : str, rating_number : int):
+        self.rating_numbers[RATING_COLUMNS[rating_name]] = NO_RATING if rating_number is None else rating_number
+
+    def __delitem__(self, rating_name : str):
+        if rating_name not in self:
+            raise KeyError(rating_name)
+        self.rating_numbers[RATING_COLUMNS[rating_name]] = NO_RATING
+
+    def __contains__(self, rating_name) -> bool:
+        return rating_name in RATING_COLUMNS and self.rating_numbers[RATING_COLUMNS[rating_name]] != NO_RATING
+
+    def __iter__(self):
+        return (rating_name for rating_name, column in RATING_COLUMNS.items() if self.rating_numbers[column] != NO_RATING)
+
+    def __len__(self) -> int:
+        return sum(1 for rating_number in self.rating_numbers if rating_number != NO_RATING)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+@total_ordering
+class Song:
+    """A song (presumably shared between YouTube Music and Spotify)"""
+    # Members are referenced by strings in dict metadata_fields in download_song_features(), 
+    # so update that dict when changing member names here. 
+    __slots__ = ('album', 'artist', 'name', 'duration_s', 'yt_id', 'spotify_id', 'spotify_preview_url', 'metadata_needs_review', 'is_private',
+                 'camelot_position', 'camelot_is_minor', 'bpm', '_user_ratings')
+
+    def __init__(self):
+        self.album = None
+        self.artist = None
+        self.name = None
+        self.duration_s = None # integer
+
+        self.yt_id = None
+        self.spotify_id = None
+        self.spotify_preview_url = None
+        self.metadata_needs_review = None # None if not downloaded, false if all downloaded, true if downloaded with error
+        self.is_private = None
+
+        self.camelot_position = None
+        self.camelot_is_minor = None
+        self.bpm = None
+
+        self._user_ratings = None # SongRatings, or None if never rated
+
+    @property
+    def user_ratings(self) -> SongRatings:
+        return self._user_ratings
+
+    @user_ratings.setter
+    def user_ratings(self, ratings):
+        """Takes a dict of rating name to rating number (copying it), the bytes of a ratings array, or None."""
+        self._user_ratings = None if ratings is None else SongRatings(ratings)
+
+    def __getstate__(self) -> dict:
+        state = {member_name : getattr(self, member_name) for member_name in self.__slots__ if member_name != '_user_ratings'}
+        # Ratings are saved by name, so changes to USER_RATINGS don't shuffle them
+        state['user_ratings'] = None if self._user_ratings is None else dict(self._user_ratings)
+        return state
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.user_ratings = set_slots_from_state(self, state).get('user_ratings')
+
+    def has_latest_ratings(self):
+        # Ratings only have columns for current traits, so every column must be set
+        return self._user_ratings is not None and NO_RATING not in self._user_ratings.rating_numbers
+
+    def set_bpm(self, bpm : float):
+        if bpm is not None:
+            assert bpm is None or bpm > 0, "BPM must be a positive value"
+            # Keep BPM in the same range/scale
+            while bpm < MIN_BPM:
+                bpm = bpm * 2
+            while bpm >= MAX_BPM:
+                bpm = bpm / 2
+        self.bpm = bpm
+
+    def set_camelot_position(self, camelot_position : int):
+        assert camelot_position is None or 1 <= camelot_position <= CAMELOT_POSITIONS, "Camelot wheel position is invalid"
+        self.camelot_position = camelot_position
+
+    def set_user_rating(self, rating_name : str, rating_number : int):
+        assert rating_number is None or -2 <= rating_number <= 2, "Rating is not between -2 and +2"
+        if self._user_ratings is None:
+            self._user_ratings = SongRatings()
+        self._user_ratings[rating_name] = rating_number
+
+    def __lt__(self, other) -> bool:
+        # Ensure other object is a Song
+        if not isinstance(other, Song):
+            return False
+
+        # Priority one: YT ID known
+        if self.yt_id is None and other.yt_id is not None:
+            return True
+
+        # Priority two: Metadata doesn't need review
+        # or we at least know if it needs review (i.e. is set)
+        if self.metadata_needs_review == True and other.metadata_needs_review == False or\
+           self.metadata_needs_review is None and other.metadata_needs_review is not None:
+            return True
+
+        # Priority three: Basic metadata known (including Spotify ID)
+        def get_missing_metadata_count(target_song_obj, field_names):
+            missing_field_count = 0
+            for field_name in field_names:
+                if getattr(target_song_obj, field_name) is None:
+                    missing_field_count = missing_field_count + 1
+            return missing_field_count
+
+        basic_fields = ['album', 'artist', 'name', 'duration_s', 'spotify_id']
+        if get_missing_metadata_count(self, basic_fields) > get_missing_metadata_count(other, basic_fields):
+            return True
+
+        # Priority four: Advanced "feature" metadata known
+        advanced_fields = ['camelot_position', 'camelot_is_minor', 'bpm']
+        if get_missing_metadata_count(self, advanced_fields) > get_missing_metadata_count(other, advanced_fields):
+            return True
+
+        # Priority five: Rated with as many current keys as possible
+        def get_ratings_count(target_ratings_dict):
+            ratings_count = 0
+            for rating_name in USER_RATINGS:
+                if rating_name in target_ratings_dict and target_ratings_dict[rating_name] is not None:
+                    ratings_count = ratings_count + 1
+            return ratings_count
+        return get_ratings_count(self.user_ratings) < get_ratings_count(other.user_ratings)
+
+    def __eq__(self, other) -> bool:
+        # Ensure other object is a Song
+        if not isinstance(other, Song):
+            return False
+
+        # Check all basic fields (i.e. all fields with a few exceptions)
+        basic_fields = list(Song.__slots__)
+        basic_fields.remove('_user_ratings')
+        for member_name in basic_fields:
+            if getattr(self, member_name) != getattr(other, member_name):
+                return False
+    
+        # Check user ratings (deprecated ratings aren't kept)
+        return dict(self.user_ratings or {}) == dict(other.user_ratings or {})
@@ -0,0 +1,159 @@
+"""
+Looks up metadata for many new songs at once, as a pipeline of stages connected by queues.
+
+Looking songs up one at a time waits on every request in turn.  Here each stage has its own
+worker threads, so while one song is being searched for on Spotify, the next one's details
+can be looked up on YouTube Music, and earlier ones' features are fetched in batches:
+
+    details:  look up the song on YouTube Music, if the playlist didn't give its duration
+    search:   find the song on Spotify by name, artist and duration
+    features: look up Spotify musical features for batches of found songs
+
+Every request still goes through the API scheduler, so each service's rate limit is kept.
+Queues between stages are bounded, so a slow stage holds up the ones before it instead of
+piling up songs.  Finished songs are handed back on the calling thread, which can save them.
+Songs that can't be found on Spotify without the user's help, or whose lookups fail with an
+error, are flagged for review and passed through, so they don't hold up the rest; the caller
+can ask the user about them later.
+"""
+
+import queue, threading, time
+from typing import Callable
+
+from foundation import SPOTIFY_FEATURES_BATCH_SIZE, Song, apply_spotify_match, download_metadata_from_YT_id, \
+                       download_spotify_features, find_spotify_match
+
+# Worker threads for each stage
+DETAIL_LOOKUP_WORKERS = 2
+SPOTIFY_SEARCH_WORKERS = 4
+# Most songs waiting between two stages
+STAGE_QUEUE_SIZE = 64
+# How long the features stage waits for more songs before looking up a partial batch
+FEATURES_BATCH_WAIT_S = 2.0
+# Print progress every this many finished songs
+PROGRESS_REPORT_INTERVAL_SONGS = 10
+
+# Put in a stage's input queue once for each of its workers, after the last song
+STAGE_DONE = None
+
+class PipelineSong:
+    """A song moving through the pipeline."""
+    song = None # Song
+    needs_review = False # Whether the user has to help find it on Spotify
+    error = None # Exception raised by a stage, which skips the rest
+
+    def __init__(self, song : Song):
+        self.song = song
+
+def _start_stage(work : Callable, input_queue : queue.Queue, output_queue : queue.Queue, worker_count : int, next_worker_count : int):
+    """Starts worker threads that call work() on each PipelineSong from input_queue and pass it on
+       to output_queue, then marks the output done for each of the next stage's workers."""
+    def run_worker():
+        while True:
+            pipeline_song = input_queue.get()
+            if pipeline_song is STAGE_DONE:
+                return
+            if pipeline_song.error is None:
+                try:
+                    work(pipeline_song)
+                except Exception as error:
+                    pipeline_song.error = error
+            output_queue.put(pipeline_song)
+
+    workers = [threading.Thread(target=run_worker, daemon=True) for _ in range(worker_count)]
+    def finish_stage():
+        for worker in workers:
+            worker.join()
+        for _ in range(next_worker_count):
+            output_queue.put(STAGE_DONE)
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=finish_stage, daemon=True).start()
+
+def _look_up_details(pipeline_song : PipelineSong):
+    song = pipeline_song.song
+    if song.duration_s is None:
+        # Some YTM songs don't include duration in the playlist response
+        song.duration_s = download_metadata_from_YT_id(song.yt_id).duration_s
+
+def _search_spotify(pipeline_song : PipelineSong):
+    song = pipeline_song.song
+    matching_spotify_song = find_spotify_match(song)
+    if matching_spotify_song is None:
+        pipeline_song.needs_review = True
+        song.metadata_needs_review = True
+    else:
+        apply_spotify_match(song, matching_spotify_song)
+        song.metadata_needs_review = False
+
+def _run_features_stage(input_queue : queue.Queue, output_queue : queue.Queue):
+    """Collects found songs into batches (until a batch is full, no song arrives for a while or
+       the songs run out) and looks up their features together."""
+    is_input_done = False
+    batch = []
+    while not is_input_done:
+        try:
+            pipeline_song = input_queue.get(timeout=FEATURES_BATCH_WAIT_S)
+        except queue.Empty:
+            pipeline_song = None
+            timed_out = True
+        else:
+            timed_out = False
+        if not timed_out:
+            if pipeline_song is STAGE_DONE:
+                is_input_done = True
+            elif pipeline_song.error is not None or pipeline_song.needs_review:
+                output_queue.put(pipeline_song)
+            else:
+                batch.append(pipeline_song)
+        if len(batch) > 0 and (timed_out or len(batch) >= SPOTIFY_FEATURES_BATCH_SIZE or is_input_done):
+            try:
+                download_spotify_features([batch_song.song for batch_song in batch])
+            except Exception as error:
+                for batch_song in batch:
+                    batch_song.error = error
+            for batch_song in batch:
+                output_queue.put(batch_song)
+            batch = []
+    output_queue.put(STAGE_DONE)
+
+def resolve_songs(songs : list[Song], on_song_done : Callable) -> list[Song]:
+    """Looks up YouTube Music details (if needed), the Spotify match and Spotify features of new
+       songs.  Calls on_song_done(song) on this thread for each song as soon as it's done, in any
+       order.  Returns the songs that need the user to help find them on Spotify; they are also
+       passed to on_song_done(), flagged for review.  Songs whose lookup failed with an error are
+       printed with the error and handled the same way, so one failure doesn't stop the rest."""
+    details_queue = queue.Queue(STAGE_QUEUE_SIZE)
+    search_queue = queue.Queue(STAGE_QUEUE_SIZE)
+    features_queue = queue.Queue(STAGE_QUEUE_SIZE)
+    done_queue = queue.Queue(STAGE_QUEUE_SIZE)
+
+    def feed_songs():
+        for song in songs:
+            details_queue.put(PipelineSong(song))
+        for _ in range(DETAIL_LOOKUP_WORKERS):
+            details_queue.put(STAGE_DONE)
+    threading.Thread(target=feed_songs, daemon=True).start()
+    _start_stage(_look_up_details, details_queue, search_queue, DETAIL_LOOKUP_WORKERS, SPOTIFY_SEARCH_WORKERS)
+    _start_stage(_search_spotify, search_queue, features_queue, SPOTIFY_SEARCH_WORKERS, 1)
+    threading.Thread(target=_run_features_stage, args=(features_queue, done_queue), daemon=True).start()
+
+    start_time = time.time()
+    songs_needing_review = []
+    done_count = 0
+    while True:
+        pipeline_song = done_queue.get()
+        if pipeline_song is STAGE_DONE:
+            break
+        if pipeline_song.error is not None:
+            print("Failed to look up song \"" + str(pipeline_song.song.name) + "\" (ID " + pipeline_song.song.yt_id + "): " + str(pipeline_song.error) + \
+                  ". It will be flagged for review. ")
+            pipeline_song.needs_review = True
+            pipeline_song.song.metadata_needs_review = True
+        if pipeline_song.needs_review:
+            songs_needing_review.append(pipeline_song.song)
+        on_song_done(pipeline_song.song)
+        done_count = done_count + 1
+        if done_count % PROGRESS_REPORT_INTERVAL_SONGS == 0:
+            print("Looked up " + str(done_count) + " of " + str(len(songs)) + " songs in " + str(round(time.time() - start_time)) + " seconds... ")
+    return songs_needing_review
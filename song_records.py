@@ -0,0 +1,114 @@
+"""
+Compact binary records for songs in the song store, replacing pickles.
+
+A pickle names the class and every member of every song, takes a while to load, and breaks
+when the class changes.  A record here is a fixed layout of plain values with a header:
+
+    header:  format version (uint8), then a bit per member that is set (uint16)
+    numbers: every number member, at fixed offsets (set to 0 when missing)
+    ratings: count (uint8), then one signed byte per rating, in the store's rating order
+    strings: the string members that are set, in UTF-8, separated by NUL characters
+
+Ratings are stored by position, and the store keeps the rating names those positions mean,
+so ratings can be moved to their new positions if USER_RATINGS changes.  Records are written
+from the member dict of Song.__getstate__(), and read straight into a new Song.
+"""
+
+import struct
+
+RECORD_FORMAT_VERSION = 1
+# Ratings that haven't been given yet
+NO_RATING = -128
+
+# Members in record order, with struct formats for the number members.
+# Update these (and RECORD_FORMAT_VERSION) when changing Song's members.
+NUMBER_MEMBERS = [('duration_s', 'i'), ('camelot_position', 'b'), ('camelot_is_minor', '?'),
+                  ('bpm', 'd'), ('metadata_needs_review', '?'), ('is_private', '?')]
+STRING_MEMBERS = ['yt_id', 'name', 'artist', 'album', 'spotify_id', 'spotify_preview_url']
+RATINGS_MEMBER = 'user_ratings'
+STRING_SEPARATOR = '\x00'
+
+# The header, numbers and rating count, which always start a record
+PREFIX_STRUCT = struct.Struct('<BH' + ''.join(member_format for _, member_format in NUMBER_MEMBERS) + 'B')
+# Bits in the header for each member
+NUMBER_BITS = [(member_name, 1 << bit) for bit, (member_name, _) in enumerate(NUMBER_MEMBERS)]
+RATINGS_BIT = 1 << len(NUMBER_MEMBERS)
+STRING_BITS = [(member_name, 1 << (bit + len(NUMBER_MEMBERS) + 1)) for bit, member_name in enumerate(STRING_MEMBERS)]
+KNOWN_MEMBERS = {member_name for member_name, _ in NUMBER_MEMBERS} | set(STRING_MEMBERS) | {RATINGS_MEMBER}
+
+def get_record_format_version(record : bytes):
+    """Returns the format version a record was written in, or None if it is an old pickled song."""
+    # Pickles start with the PROTO opcode (0x80), which no record format version uses
+    if record[:1] == b'\x80':
+        return None
+    return record[0]
+
+def encode_song_state(state : dict, rating_names : list) -> bytes:
+    """Packs a song's members (as from Song.__getstate__()) into a record.  Ratings are
+       written in rating_names order.  NUL characters are removed from strings.
+       Raises ValueError for members the format doesn't have."""
+    unknown_members = [member_name for member_name, value in state.items() if value is not None and member_name not in KNOWN_MEMBERS]
+    if len(unknown_members) > 0:
+        raise ValueError("Song records can't store members " + ", ".join(unknown_members) + ". Update song_records.py. ")
+
+    present_bits = 0
+    numbers = []
+    for member_name, bit in NUMBER_BITS:
+        value = state.get(member_name)
+        if value is None:
+            numbers.append(0)
+        else:
+            numbers.append(value)
+            present_bits |= bit
+
+    ratings = state.get(RATINGS_MEMBER)
+    rating_bytes = b''
+    if ratings is not None:
+        present_bits |= RATINGS_BIT
+        rating_numbers = [ratings.get(rating_name) for rating_name in rating_names]
+        rating_bytes = struct.pack('<' + str(len(rating_numbers)) + 'b', *[NO_RATING if rating_number is None else rating_number for rating_number in rating_numbers])
+
+    strings = []
+    for member_name, bit in STRING_BITS:
+        value = state.get(member_name)
+        if value is not None:
+            strings.append(str(value).replace(STRING_SEPARATOR, ''))
+            present_bits |= bit
+
+    return PREFIX_STRUCT.pack(RECORD_FORMAT_VERSION, present_bits, *numbers, len(rating_bytes)) + rating_bytes + \
+           STRING_SEPARATOR.join(strings).encode('utf-8')
+
+def decode_song(record : bytes, song, rating_names=None):
+    """Sets the members of a new Song (all None) from a record, and returns it.  rating_names are
+       the names of the record's ratings, in order; if None, they must already be in USER_RATINGS
+       order, which is quicker.  Raises ValueError for unknown formats."""
+    prefix = PREFIX_STRUCT.unpack_from(record, 0)
+    format_version, present_bits, rating_count = prefix[0], prefix[1], prefix[-1]
+    if format_version != RECORD_FORMAT_VERSION:
+        raise ValueError("Song record format " + str(format_version) + " is unknown. ")
+    for (member_name, bit), value in zip(NUMBER_BITS, prefix[2:-1]):
+        if present_bits & bit:
+            setattr(song, member_name, value)
+    offset = PREFIX_STRUCT.size
+
+    if present_bits & RATINGS_BIT:
+        if rating_names is None:
+            song.user_ratings = record[offset:offset + rating_count]
+        else:
+            song.user_ratings = {rating_name : rating_number for rating_name, rating_number in zip(rating_names, struct.unpack_from('<' + str(rating_count) + 'b', record, offset))
+                                 if rating_number != NO_RATING}
+    offset += rating_count
+
+    strings = iter(record[offset:].decode('utf-8').split(STRING_SEPARATOR))
+    for member_name, bit in STRING_BITS:
+        if present_bits & bit:
+            setattr(song, member_name, next(strings))
+    return song
+
+def count_missing_ratings(record : bytes, rating_count : int) -> int:
+    """Returns how many of a record's rating_count ratings haven't been given, without decoding it."""
+    prefix = PREFIX_STRUCT.unpack_from(record, 0)
+    if not prefix[1] & RATINGS_BIT:
+        return rating_count
+    return record[PREFIX_STRUCT.size:PREFIX_STRUCT.size + prefix[-1]].count(NO_RATING.to_bytes(1, 'little', signed=True)) + \
+           max(0, rating_count - prefix[-1])
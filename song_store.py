@@ -0,0 +1,383 @@
+"""
+Song metadata store, saved one song at a time in an SQLite database.
+
+The old cache was one pickle of every song, rewritten in full on every save, so a save cost as
+much as the whole library and a crash lost everything since the last save.  Here each song is
+its own row (a compact record, see song_records.py): saving writes only the songs that changed since they were loaded or last saved,
+and each save is committed right away, so progress survives a crash after every song.
+Updated rows leave free pages behind, so the file is compacted now and then.
+
+Playlists are stored as an index (ID, name, song count) plus one row per playlist entry, so
+playlists can be listed, and songs missing from the store found, without loading any of them.
+Scripts get the songs and playlists as mappings that only load each record when it's first used.
+The store can also keep a memory-mapped file of every song's numeric features up to date
+(see feature_file.py), for sorting without loading songs at all.
+
+Songs missing any current rating are listed in an index that every save updates, read from
+the records' rating bytes, so the rater can find the songs left to rate (and count them)
+without loading every song.  The index is rebuilt if the ratings in USER_RATINGS change.
+"""
+
+import json, os, pickle, sqlite3
+from collections.abc import Mapping, MutableMapping
+
+from song_records import NO_RATING, RECORD_FORMAT_VERSION, count_missing_ratings, decode_song, encode_song_state, get_record_format_version
+from feature_file import FeatureFile
+
+SONG_STORE_FILE = 'song_metadata.db'
+# Compact the file when at least this share of its pages are free, and at least this many
+COMPACTION_FREE_PAGE_SHARE = 0.25
+COMPACTION_MIN_FREE_PAGES = 256
+# Orders to list unrated songs in: playlist order (or the order songs first needed ratings),
+# songs in the most playlists first, or songs missing the fewest ratings first
+RATING_ORDER_PLAYLIST = 'playlist'
+RATING_ORDER_MOST_USED = 'most_used'
+RATING_ORDER_FEWEST_MISSING = 'fewest_missing'
+
+class SongStore:
+    """Songs keyed by YouTube ID, each stored as its own record, and playlists of song IDs.
+       Songs are made with song_class, whose __getstate__() returns a dict of its members, and
+       rating_names must be the order that song_class keeps ratings in (USER_RATINGS).
+       Records from older formats, or with ratings in a different order than rating_names,
+       are upgraded when the store is opened.  If feature_file_path is given, a FeatureFile
+       there is updated with every save, and rebuilt when opening the store if it is out of date."""
+    path = None
+    connection = None
+    song_class = None
+    rating_names = None # list of rating names, in the order records store them
+    saved_record_hashes = None # dict of song ID to hash of the record last loaded or saved, to skip unchanged songs
+    feature_file = None # FeatureFile, or None
+
+    def __init__(self, song_class, rating_names : list, path=SONG_STORE_FILE, feature_file_path=None):
+        self.path = path
+        self.song_class = song_class
+        self.rating_names = list(rating_names)
+        self.saved_record_hashes = dict()
+        self.connection = sqlite3.connect(path)
+        # A write-ahead log makes each small commit an append instead of a page rewrite
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS songs (yt_id TEXT PRIMARY KEY, record BLOB NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS store_info (name TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS playlists (yt_id TEXT PRIMARY KEY, name TEXT, song_count INTEGER NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS playlist_songs (playlist_id TEXT NOT NULL, position INTEGER NOT NULL, " + \
+                                    "song_id TEXT NOT NULL, order_id TEXT, PRIMARY KEY (playlist_id, position)) WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS playlist_songs_by_song ON playlist_songs (song_id)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sorted_playlist_songs (playlist_id TEXT NOT NULL, position INTEGER NOT NULL, " + \
+                                    "song_id TEXT NOT NULL, PRIMARY KEY (playlist_id, position)) WITHOUT ROWID")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS unrated_songs (yt_id TEXT PRIMARY KEY, missing_rating_count INTEGER NOT NULL)")
+        if feature_file_path is not None:
+            self.feature_file = FeatureFile(self.connection, len(self.rating_names), NO_RATING, feature_file_path)
+        self._upgrade_records()
+        self._update_unrated_index()
+        if self.feature_file is not None and not self.feature_file.is_up_to_date():
+            if len(self) > 0:
+                print("Updating the song feature file... ")
+            self.feature_file.rebuild({song_id : self._decode_song(record) for song_id, record in self.connection.execute("SELECT yt_id, record FROM songs")})
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+
+    def get_info(self, name : str):
+        row = self.connection.execute("SELECT value FROM store_info WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_info(self, name : str, value : str):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO store_info (name, value) VALUES (?, ?)", (name, value))
+
+    def _encode_song(self, song) -> bytes:
+        return encode_song_state(song.__getstate__(), self.rating_names)
+
+    def _decode_song(self, record : bytes, rating_names=None):
+        """Makes a song from a record.  rating_names, if given, are the names of the record's
+           ratings; otherwise they must be in self.rating_names order already."""
+        if get_record_format_version(record) is None:
+            return pickle.loads(record)
+        return decode_song(record, self.song_class(), rating_names)
+
+    def _upgrade_records(self):
+        """Rewrites every record in the current format and rating order, if the store was written
+           with an older format or different ratings, all in one commit."""
+        stored_format_version = self.get_info('record_format_version')
+        stored_rating_names = self.get_info('rating_names')
+        stored_rating_names = self.rating_names if stored_rating_names is None else json.loads(stored_rating_names)
+        if stored_format_version == str(RECORD_FORMAT_VERSION) and stored_rating_names == self.rating_names:
+            return
+        rows = self.connection.execute("SELECT yt_id, record FROM songs").fetchall()
+        if len(rows) > 0:
+            print("Upgrading " + str(len(rows)) + " songs in the song store to the latest format... ")
+        with self.connection:
+            self.connection.executemany("UPDATE songs SET record = ? WHERE yt_id = ?",
+                                        [(self._encode_song(self._decode_song(record, stored_rating_names)), song_id) for song_id, record in rows])
+            self.connection.execute("INSERT OR REPLACE INTO store_info (name, value) VALUES ('record_format_version', ?)", (str(RECORD_FORMAT_VERSION),))
+            self.connection.execute("INSERT OR REPLACE INTO store_info (name, value) VALUES ('rating_names', ?)", (json.dumps(self.rating_names),))
+            if self.feature_file is not None:
+                self.feature_file.mark_out_of_date()
+
+    def _update_unrated_index(self):
+        """Rebuilds the index of unrated songs if it was made for different ratings, or never made."""
+        if self.get_info('unrated_index_rating_names') == json.dumps(self.rating_names):
+            return
+        with self.connection:
+            self.connection.execute("DELETE FROM unrated_songs")
+            self._index_unrated_songs(self.connection.execute("SELECT yt_id, record FROM songs").fetchall())
+            self.connection.execute("INSERT OR REPLACE INTO store_info (name, value) VALUES ('unrated_index_rating_names', ?)", (json.dumps(self.rating_names),))
+
+    def _index_unrated_songs(self, rows : list[tuple]):
+        """Adds songs missing ratings to the unrated index and removes the others, given their
+           (song ID, record) rows.  Songs keep their place if they were already in the index."""
+        missing_rating_counts = [(song_id, count_missing_ratings(record, len(self.rating_names))) for song_id, record in rows]
+        self.connection.executemany("INSERT INTO unrated_songs (yt_id, missing_rating_count) VALUES (?, ?) " + \
+                                    "ON CONFLICT (yt_id) DO UPDATE SET missing_rating_count = excluded.missing_rating_count",
+                                    [(song_id, missing_rating_count) for song_id, missing_rating_count in missing_rating_counts if missing_rating_count > 0])
+        self.connection.executemany("DELETE FROM unrated_songs WHERE yt_id = ?",
+                                    [(song_id,) for song_id, missing_rating_count in missing_rating_counts if missing_rating_count == 0])
+
+    def load_song(self, song_id : str):
+        """Returns one stored song, or None if it isn't stored."""
+        row = self.connection.execute("SELECT record FROM songs WHERE yt_id = ?", (song_id,)).fetchone()
+        if row is None:
+            return None
+        self.saved_record_hashes[song_id] = hash(row[0])
+        return self._decode_song(row[0])
+
+    def has_song(self, song_id : str) -> bool:
+        return self.connection.execute("SELECT 1 FROM songs WHERE yt_id = ?", (song_id,)).fetchone() is not None
+
+    def _get_changed_rows(self, songs_by_id : dict) -> list[tuple]:
+        rows = []
+        for song_id, song in songs_by_id.items():
+            record = self._encode_song(song)
+            record_hash = hash(record)
+            if self.saved_record_hashes.get(song_id) != record_hash:
+                rows.append((song_id, record, record_hash))
+        return rows
+
+    def save_songs(self, songs_by_id : dict) -> int:
+        """Saves the songs in the given dict that changed since they were loaded or last saved,
+           in one commit, and returns how many were written."""
+        rows = self._get_changed_rows(songs_by_id)
+        if len(rows) > 0:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO songs (yt_id, record) VALUES (?, ?)",
+                                            [(song_id, record) for song_id, record, _ in rows])
+                self._index_unrated_songs([(song_id, record) for song_id, record, _ in rows])
+                if self.feature_file is not None:
+                    self.feature_file.mark_out_of_date()
+            for song_id, _, record_hash in rows:
+                self.saved_record_hashes[song_id] = record_hash
+            if self.feature_file is not None:
+                self.feature_file.write_songs({song_id : songs_by_id[song_id] for song_id, _, _ in rows})
+        return len(rows)
+
+    def save_song(self, song_id : str, song) -> bool:
+        """Saves one song if it changed, and returns whether it was written."""
+        return self.save_songs({song_id : song}) > 0
+
+    def delete_songs(self, song_ids) -> int:
+        """Removes songs from the store and returns how many there were."""
+        song_ids = [song_id for song_id in song_ids]
+        with self.connection:
+            deleted_count = self.connection.executemany("DELETE FROM songs WHERE yt_id = ?", [(song_id,) for song_id in song_ids]).rowcount
+            self.connection.executemany("DELETE FROM unrated_songs WHERE yt_id = ?", [(song_id,) for song_id in song_ids])
+        for song_id in song_ids:
+            self.saved_record_hashes.pop(song_id, None)
+        if self.feature_file is not None:
+            self.feature_file.remove_songs(song_ids)
+        return deleted_count
+
+    def get_stored_ids(self) -> set:
+        return {row[0] for row in self.connection.execute("SELECT yt_id FROM songs")}
+
+    def get_unrated_song_ids(self, playlist_id=None, order=RATING_ORDER_PLAYLIST) -> list:
+        """Returns the IDs of stored songs missing any current rating, in one of the RATING_ORDER
+           orders, from one playlist or else from every song."""
+        query = "SELECT unrated_songs.yt_id FROM unrated_songs"
+        parameters = ()
+        if playlist_id is not None:
+            query = query + " JOIN (SELECT song_id, MIN(position) AS position FROM playlist_songs WHERE playlist_id = ? GROUP BY song_id) AS entries " + \
+                            "ON entries.song_id = unrated_songs.yt_id"
+            parameters = (playlist_id,)
+        stored_order = "entries.position" if playlist_id is not None else "unrated_songs.rowid"
+        if order == RATING_ORDER_MOST_USED:
+            order_by = "(SELECT COUNT(DISTINCT playlist_id) FROM playlist_songs WHERE song_id = unrated_songs.yt_id) DESC, " + stored_order
+        elif order == RATING_ORDER_FEWEST_MISSING:
+            order_by = "unrated_songs.missing_rating_count, " + stored_order
+        elif order == RATING_ORDER_PLAYLIST:
+            order_by = stored_order
+        else:
+            raise ValueError("Unknown rating order " + str(order))
+        return [song_id for song_id, in self.connection.execute(query + " ORDER BY " + order_by, parameters)]
+
+    def count_unrated_songs(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM unrated_songs").fetchone()[0]
+
+    def get_playlist_index(self) -> list[tuple]:
+        """Returns (YouTube ID, name, song count) for every stored playlist, in the order they were first saved."""
+        return self.connection.execute("SELECT yt_id, name, song_count FROM playlists ORDER BY rowid").fetchall()
+
+    def load_playlist_entries(self, playlist_id : str) -> tuple[list, list]:
+        """Returns a stored playlist's (song IDs, order IDs), in playlist order."""
+        rows = self.connection.execute("SELECT song_id, order_id FROM playlist_songs WHERE playlist_id = ? ORDER BY position", (playlist_id,)).fetchall()
+        return [song_id for song_id, _ in rows], [order_id for _, order_id in rows]
+
+    def save_playlist(self, playlist_id : str, name : str, song_ids : list, order_ids : list):
+        """Saves or replaces a playlist and its entries in one commit."""
+        if order_ids is None:
+            order_ids = [None] * len(song_ids)
+        with self.connection:
+            self.connection.execute("INSERT INTO playlists (yt_id, name, song_count) VALUES (?, ?, ?) " + \
+                                    "ON CONFLICT (yt_id) DO UPDATE SET name = excluded.name, song_count = excluded.song_count",
+                                    (playlist_id, name, len(song_ids)))
+            self.connection.execute("DELETE FROM playlist_songs WHERE playlist_id = ?", (playlist_id,))
+            self.connection.executemany("INSERT INTO playlist_songs (playlist_id, position, song_id, order_id) VALUES (?, ?, ?, ?)",
+                                        [(playlist_id, position, song_id, order_id) for position, (song_id, order_id) in enumerate(zip(song_ids, order_ids))])
+
+    def load_sorted_order(self, playlist_id : str) -> list:
+        """Returns the song IDs of the last sorted order saved for a playlist, or None."""
+        rows = self.connection.execute("SELECT song_id FROM sorted_playlist_songs WHERE playlist_id = ? ORDER BY position", (playlist_id,)).fetchall()
+        if len(rows) == 0:
+            return None
+        return [song_id for song_id, in rows]
+
+    def save_sorted_order(self, playlist_id : str, song_ids : list):
+        """Saves or replaces the sorted order of a playlist, so the next sort can start from it."""
+        with self.connection:
+            self.connection.execute("DELETE FROM sorted_playlist_songs WHERE playlist_id = ?", (playlist_id,))
+            self.connection.executemany("INSERT INTO sorted_playlist_songs (playlist_id, position, song_id) VALUES (?, ?, ?)",
+                                        [(playlist_id, position, song_id) for position, song_id in enumerate(song_ids)])
+
+    def get_missing_playlist_songs(self) -> list[tuple]:
+        """Returns (playlist ID, song ID) for every playlist entry whose song isn't stored."""
+        return self.connection.execute("SELECT DISTINCT playlist_id, song_id FROM playlist_songs " + \
+                                       "WHERE song_id NOT IN (SELECT yt_id FROM songs)").fetchall()
+
+    def compact(self, force=False) -> bool:
+        """Folds the write-ahead log back into the database, and rebuilds the file if enough of it
+           is free space left by replaced songs (or if forced).  Returns whether it was rebuilt.
+           Also compacts the feature file, if there is one."""
+        if self.feature_file is not None:
+            self.feature_file.compact(force)
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        free_pages = self.connection.execute("PRAGMA freelist_count").fetchone()[0]
+        total_pages = self.connection.execute("PRAGMA page_count").fetchone()[0]
+        if force or (free_pages >= COMPACTION_MIN_FREE_PAGES and free_pages >= COMPACTION_FREE_PAGE_SHARE * total_pages):
+            self.connection.execute("VACUUM")
+            return True
+        return False
+
+    def import_legacy_cache(self, legacy_cache_path : str) -> int:
+        """Copies every song from an old whole-library pickle into the store in one commit, and
+           returns how many were imported.  The old file is left alone as a backup."""
+        legacy_file = open(legacy_cache_path, "rb")
+        legacy_songs = pickle.load(legacy_file)
+        legacy_file.close()
+        for song_id, song in legacy_songs.items():
+            # Some old versions stored the Song itself as the ID of songs downloaded while loading
+            if not isinstance(song.yt_id, str):
+                song.yt_id = song_id
+        imported_count = self.save_songs(legacy_songs)
+        self.set_info('imported_legacy_cache', os.path.abspath(legacy_cache_path))
+        return imported_count
+
+    def close(self):
+        self.compact()
+        self.connection.close()
+
+class LazySongCache(MutableMapping):
+    """A dict of songs by YouTube ID that loads each song from the store the first time it's used.
+       Changes stay in memory until save() (or write_song_cache()), like a plain dict of songs."""
+    song_store = None
+    loaded_songs = None # dict of song ID to Song, for songs used so far and songs added
+    removed_song_ids = None # set of stored song IDs removed since the last save
+
+    def __init__(self, song_store : SongStore):
+        self.song_store = song_store
+        self.loaded_songs = dict()
+        self.removed_song_ids = set()
+
+    def __getitem__(self, song_id : str):
+        if song_id in self.loaded_songs:
+            return self.loaded_songs[song_id]
+        song = None if song_id in self.removed_song_ids else self.song_store.load_song(song_id)
+        if song is None:
+            raise KeyError(song_id)
+        self.loaded_songs[song_id] = song
+        return song
+
+    def __contains__(self, song_id) -> bool:
+        return song_id in self.loaded_songs or (song_id not in self.removed_song_ids and self.song_store.has_song(song_id))
+
+    def __setitem__(self, song_id : str, song):
+        self.loaded_songs[song_id] = song
+        self.removed_song_ids.discard(song_id)
+
+    def __delitem__(self, song_id : str):
+        if song_id not in self:
+            raise KeyError(song_id)
+        self.loaded_songs.pop(song_id, None)
+        self.removed_song_ids.add(song_id)
+
+    def __iter__(self):
+        stored_ids = self.song_store.get_stored_ids()
+        for song_id in stored_ids:
+            if song_id not in self.removed_song_ids:
+                yield song_id
+        for song_id in list(self.loaded_songs):
+            if song_id not in stored_ids:
+                yield song_id
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def save(self):
+        """Saves the loaded songs that changed and removes the removed ones."""
+        self.song_store.save_songs(self.loaded_songs)
+        if len(self.removed_song_ids) > 0:
+            self.song_store.delete_songs(self.removed_song_ids)
+            self.removed_song_ids = set()
+
+class LazyPlaylists(Mapping):
+    """A dict of playlists by YouTube ID that loads each playlist's entries the first time it's used.
+       get_index() lists the playlists without loading any of them.  Adding a playlist only
+       updates this mapping; save it with SongStore.save_playlist()."""
+    song_store = None
+    playlist_class = None # Class to make playlists from, with name, yt_id, song_ids and order_ids members
+    index = None # dict of playlist ID to (name, song count)
+    loaded_playlists = None # dict of playlist ID to playlist
+
+    def __init__(self, song_store : SongStore, playlist_class):
+        self.song_store = song_store
+        self.playlist_class = playlist_class
+        self.index = {playlist_id : (name, song_count) for playlist_id, name, song_count in song_store.get_playlist_index()}
+        self.loaded_playlists = dict()
+
+    def get_index(self) -> list[tuple]:
+        """Returns (YouTube ID, name, song count) for every playlist."""
+        return [(playlist_id, name, song_count) for playlist_id, (name, song_count) in self.index.items()]
+
+    def __getitem__(self, playlist_id : str):
+        if playlist_id not in self.loaded_playlists:
+            if playlist_id not in self.index:
+                raise KeyError(playlist_id)
+            playlist = self.playlist_class()
+            playlist.yt_id = playlist_id
+            playlist.name = self.index[playlist_id][0]
+            playlist.song_ids, playlist.order_ids = self.song_store.load_playlist_entries(playlist_id)
+            self.loaded_playlists[playlist_id] = playlist
+        return self.loaded_playlists[playlist_id]
+
+    def __setitem__(self, playlist_id : str, playlist):
+        self.loaded_playlists[playlist_id] = playlist
+        self.index[playlist_id] = (playlist.name, len(playlist.song_ids))
+
+    def __contains__(self, playlist_id) -> bool:
+        return playlist_id in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self) -> int:
+        return len(self.index)
@@ -1,195 +1,185 @@
 from foundation import *
-
-import numpy, random, scipy.special
-
-from ortools.init import pywrapinit
-from ortools.constraint_solver import pywrapcp, routing_enums_pb2
-
-random.seed()
-playlists_db, songs_cache = load_data_files()
-
-selected_playlist = None
-while selected_playlist is None:
-    print("\nSelect a playlist to sort: ")
-    selected_playlist = prompt_for_playlist(playlists_db)
-original_songs = selected_playlist.song_ids.copy()
-dedupliated_songs = [*set(original_songs)]
-removed_song_count = len(original_songs) - len(dedupliated_songs)
-if removed_song_count > 0:
-    print(str(removed_song_count) + " songs will be removed from the sorted playlist for being duplicates")
-
-def smoothstep(x, x_min=0, x_max=1, N=1):
-    """A sigmoid/s-curve/clamping function that modifies some score.  As the score drops from 1.0, 
-       the smoothed result will gently slope away but begins to ramp up, then becomes more gentle 
-       again as it approaches 0.  N is the number of smoothing passes.  
-       Taken from https://stackoverflow.com/a/45166120 """
-    x = numpy.clip((x - x_min) / (x_max - x_min), 0, 1)
-    result = 0
-    for n in range(0, N + 1):
-         result += scipy.special.comb(N + n, n) * scipy.special.comb(2 * N + 1, N - n) * (-x) ** n
-    result *= x ** (N + 1)
-    return result
-
-def get_similarity_score_v1(song1 : Song, song2 : Song) -> float:
-    """Computes the similarity of songs and returns a score between 1.0 and 0.0.
-       The similarity score is 35% key, 30% BPM, and 35% user ratings.
-       Score v1 does not consider the "momentum" of previous changes that would
-       allow changes to continue in a similar direction."""
-
-    # Key subscore is 1.0 if identical, 0.8 if changing one unit over, etc.
-    hops_between_keys = abs(song1.camelot_position - song2.camelot_position)
-    if hops_between_keys > (CAMELOT_POSITIONS / 2):
-        hops_between_keys = CAMELOT_POSITIONS - hops_between_keys
-    if song1.camelot_is_minor != song2.camelot_is_minor:
-        hops_between_keys = hops_between_keys + 1
-    key_subscore = 1.0 - (0.2 * hops_between_keys)
-    if key_subscore < 0.0:
-        key_subscore = 0.0
-
-    # BPM subscore is the difference between BPMs, smoothed
-    lower_bpm = min(song1.bpm, song2.bpm)
-    higher_bpm = max(song1.bpm, song2.bpm)
-    bpm_difference = higher_bpm - lower_bpm
-    # Since BPMs are normalized in a range, consider doubling the lower BPM to match the higher BPM
-    # Divide by 1.5 since we could have used higher_bpm/2 instead, so we'll average the difference between them
-    # TODO later: consider increasing the divisor to punish wrapping around
-    wraparound_bpm_difference = (lower_bpm * 2 - higher_bpm) / 1.5
-    bpm_difference = min([bpm_difference, wraparound_bpm_difference])
-    # Do smoothstep to keep give similar BPMs a higher score
-    # TODO later: consider a curve that doesn't smooth out towards 0, maybe by only using half of the smoothstep graph
-    max_bpm_difference = (MAX_BPM - MIN_BPM) / 2
-    bpm_subscore = (max_bpm_difference - smoothstep(bpm_difference, x_min=0, x_max=max_bpm_difference)) / max_bpm_difference
-
-    # Average all user ratings into a subscore.  Each is 1.0 if identical, 0.75 if one apart, etc.
-    # TODO later: consider ramping the score for point differences, e.g. 1 -> 0.9 -> 0.7 -> 0.4 -> 0
-    user_rating_scores = []
-    for rating_key in USER_RATINGS:
-        rating_difference = abs(song1.user_ratings[rating_key] - song2.user_ratings[rating_key])
-        rating_score = 1.0 - (0.25 * rating_difference)
-        if rating_score < 0.0:
-            rating_score = 0.0
-        user_rating_scores.append(rating_score)
-    user_rating_subscore = sum(user_rating_scores) / len(user_rating_scores)
-    
-    return (key_subscore * 0.2) + (bpm_subscore * 0.3) + (user_rating_subscore * 0.5)
-
-def get_current_similarity_score(song_ids:list) -> float:
-    num_songs = len(song_ids)
-    total_score = 0.0
-    for current_song_index in range(-1, len(song_ids) - 1):
-        song_0 = songs_cache[song_ids[current_song_index]]
-        song_1 = songs_cache[song_ids[current_song_index + 1]]
-        score = score + get_similarity_score_v1(song_0, song_1)
-    # Normalize score so it ranges between 0.0 and 1.0
-    return score / num_songs
-
-def generate_distance_matrix(song_ids:list) -> list:
-    """
-    Generates an n*n matrix of "distances" between songs in the playlist
-    Invert of similarity score because farther is worse
-    """
-    song_list_length = len(song_ids)
-
-    # Distance matrix should be less than 1 GiB so it can be easily handled
-    ONE_GIBIBYTE = 1024 * 1024 * 1024
-    FLOAT_SIZE_BYTES = 64 / 8
-    if song_list_length * song_list_length > ONE_GIBIBYTE / FLOAT_SIZE_BYTES:
-        raise Exception("Playlist is too large to easily sort, aborting. ")
-
-    distance_list = []
-    for first_node_index in range(song_list_length):
-        distance_sublist = []
-        for second_node_index in range(song_list_length):
-            # Node already exists on the other side of the matrix; copy it
-            if second_node_index < first_node_index:
-                distance_sublist.append(distance_list[second_node_index][first_node_index])
-            # Distance to self is 0
-            elif second_node_index == first_node_index:
-                distance_sublist.append(0.0)
-            # Haven't calculated this distance yet
-            else:
-                first_song_id = song_ids[first_node_index]
-                second_song_id = song_ids[second_node_index]
-                # Similarity score needs to be inverted to become distance (since a distance of 0 is the most similar)
-                distance_sublist.append(1.0 - get_similarity_score_v1(songs_cache[first_song_id], songs_cache[second_song_id]))
-        distance_list.append(distance_sublist)
-    # Solver needs a starting location, so add a dummy node before returning
-    return [[0] * song_list_length] + distance_list
-
-def solve_for_playlist_order(original_songs):
-    """
-    Do a traveling salesperson solve
-    """
-    # Disable distance matrix and just calculate on the fly to avoid n^2 memory usage
-    """problem = {}
-    problem['distance_matrix'] = generate_distance_matrix(dedupliated_songs)
-    problem['num_vehicles'] = 1 # Only one playlist is being generated
-    problem['depot'] = 0 # Start at dummy node"""
-
-    manager = pywrapcp.RoutingIndexManager(len(dedupliated_songs) + 1, 1, 0) # 1 "vehicle" (1 result playlist), start at node 0
-
-    def distance_callback(from_index, to_index):
-        # Convert from routing variable Index to distance matrix NodeIndex.
-        # This is poorly documented but the NodeIndex seems to just be the input index in the array.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        # Dummy 0th node is perfectly connected, so that it is transparent.
-        if from_node == 0 or to_node == 0:
-            return 0.0
-        first_song_id = dedupliated_songs[from_node + 1]
-        second_song_id = dedupliated_songs[to_node + 1]
-        return 1.0 - get_similarity_score_v1(songs_cache[first_song_id], songs_cache[second_song_id])
-
-    routing = pywrapcp.RoutingModel(manager)
-    vertex_traversal_cost = routing.RegisterTransitCallback(distance_callback)
-    routing.SetArcCostEvaluatorOfAllVehicles(vertex_traversal_cost)
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
-
-    print("Sorting playlist...")
-    solution = routing.SolveWithParameters(search_parameters)
-    if not solution:
-        raise Exception("Could not sort playlist, aborting. ")
-
-
-    routes = [] # 2d array of (output playlist, index number)
-    for route_nbr in range(routing.vehicles()):
-        index = routing.Start(route_nbr)
-        route = [manager.IndexToNode(index)]
-        while not routing.IsEnd(index):
-            index = solution.Value(routing.NextVar(index))
-            route.append(manager.IndexToNode(index))
-        routes.append(route)
-
-    return routes[0] # Only one playlist is being generated
-
-sorted_indices = solve_for_playlist_order(dedupliated_songs)
-sorted_song_ids = []
-for song_number in sorted_indices:
-    sorted_song_ids.append(dedupliated_songs[song_number - 1])
-print("Playlist sorted. ")
-
-if prompt_user_for_bool("Reorder existing playlist on YTM? "):
+from distance import DEFAULT_MEMORY_BUDGET_BYTES, DISTANCE_COST_SCALE
+from scoring import get_current_similarity_score, load_song_table
+from solver import METAHEURISTICS, print_solver_progress, solve_for_playlist_order
+from local_search import solve_with_local_search
+from parallel_solver import solve_in_parallel
+from cluster_solver import TARGET_CLUSTER_SIZE, solve_with_clusters
+from candidates import CANDIDATE_NEIGHBOR_COUNT
+from distance_cache import DEFAULT_DISTANCE_CACHE_BYTES, DistanceCache
+from playlist_edits import PlaylistEditError, get_playlist_entries, load_plan, plan_new_playlist, plan_reorder, remove_plan, run_plan
+from incremental_solver import MAX_NEW_SONG_SHARE, MAX_SIMILARITY_LOSS, REPAIR_TIME_LIMIT_S, solve_incrementally
+
+import argparse, random
+
+parser = argparse.ArgumentParser(description="Sorts a saved playlist so that similar songs are next to each other.")
+parser.add_argument('--engine', choices=['ortools', 'local-search', 'clusters'], default='ortools',
+                    help="'ortools' uses the OR-Tools routing solver; 'local-search' uses the built-in 2-opt/Or-opt heuristics, " + \
+                         "which are quicker to start and need less memory; 'clusters' sorts groups of similar songs separately, " + \
+                         "for playlists too large for the other engines. Default: ortools")
+parser.add_argument('--cluster-size', type=int, default=TARGET_CLUSTER_SIZE,
+                    help="For the clusters engine: about how many songs to put in each cluster. Default: %(default)s")
+parser.add_argument('--costs', choices=['matrix', 'callback'], default='matrix',
+                    help="For the ortools engine: 'matrix' precomputes every song distance for the solver (fast, uses n^2 memory); " + \
+                         "'callback' scores songs on the fly while solving (slow, little memory). Default: matrix")
+parser.add_argument('--candidates', choices=['all', 'knn'], default='all',
+                    help="For the ortools and local-search engines: 'all' lets the solver try every jump between songs; 'knn' only tries jumps " + \
+                         "between each song and its closest songs, which needs far less time and memory for large playlists. Default: all")
+parser.add_argument('--neighbors', type=int, default=CANDIDATE_NEIGHBOR_COUNT,
+                    help="How many of each song's closest songs to try as its neighbors, for --candidates knn, the local-search engine and the clusters engine's final pass. Default: %(default)s")
+parser.add_argument('--memory-budget-mib', type=int, default=DEFAULT_MEMORY_BUDGET_BYTES // (1024 * 1024),
+                    help="Largest distance matrix to build, in MiB. Larger playlists fall back to the callback (ortools) or to knn candidates (local-search). Default: %(default)s")
+parser.add_argument('--cost-scale', type=int, default=DISTANCE_COST_SCALE,
+                    help="Fixed-point multiplier that turns song distances (0.0 to 1.0) into integer solver costs. Default: %(default)s")
+parser.add_argument('--distance-cache-mib', type=int, default=DEFAULT_DISTANCE_CACHE_BYTES // (1024 * 1024),
+                    help="Size cap of the on-disk cache of song distances, which lets sorting the same songs again skip scoring them. 0 disables the cache. Default: %(default)s")
+parser.add_argument('--full-sort', action='store_true',
+                    help="Sort the whole playlist, instead of fitting songs added since the last sort into its order. " + \
+                         "A full sort is also done when more than " + str(round(MAX_NEW_SONG_SHARE * 100)) + "%% of the songs are new, " + \
+                         "or when fitting them in would lower the similarity by more than " + str(MAX_SIMILARITY_LOSS) + ", " + \
+                         "or when any option that only applies to a full sort (such as --engine or --restarts) is given.")
+parser.add_argument('--time-limit', type=float, default=None,
+                    help="Stop searching for a better order after this many seconds. " + \
+                         "Default: no limit for a full sort, " + str(REPAIR_TIME_LIMIT_S) + " seconds when fitting new songs into the last sorted order")
+parser.add_argument('--solution-limit', type=int, default=None,
+                    help="Stop searching for a better order after finding this many solutions.")
+parser.add_argument('--metaheuristic', choices=list(METAHEURISTICS.keys()), default=None,
+                    help="For the ortools engine: keep improving the order with this local search method until a limit is hit. Default: stop at the first local optimum")
+parser.add_argument('--restarts', type=int, default=1,
+                    help="Run this many independent solves with different starting points in parallel and keep the best (ortools and local-search engines). " + \
+                         "Needs the default --candidates and --costs, since the solves share one distance matrix. Default: %(default)s")
+parser.add_argument('--processes', type=int, default=None,
+                    help="Processes to spread restarts over. Default: one per CPU")
+parser.add_argument('--target-similarity', type=float, default=None,
+                    help="With restarts, stop as soon as one finishes with this average similarity between neighboring songs (0.0 to 1.0). " + \
+                         "It is checked as each restart finishes, so it doesn't cut a restart short.")
+parser.add_argument('--quiet', action='store_true',
+                    help="Don't print the solver's progress.")
+parser.add_argument('--dry-run', action='store_true',
+                    help="Sort and plan the YouTube Music edits, printing how many calls they take and about how long, without making them.")
+# Options that only change how a full sort is done, so giving any of them skips fitting new songs into the last sorted order
+FULL_SORT_OPTIONS = ['engine', 'cluster_size', 'costs', 'candidates', 'memory_budget_mib', 'solution_limit', 'metaheuristic',
+                     'restarts', 'processes', 'target_similarity']
+
+def finish_edit_plan(edit_plan, playlists_db):
+    """Makes the calls of an edit plan that aren't done yet, then updates the saved playlist to match."""
+    try:
+        run_plan(edit_plan, YTM, run_API_request)
+    except PlaylistEditError as error:
+        sys.exit(str(error) + "The edits left are saved, so run the sorter again to finish them. \n")
+    if edit_plan.final_order_ids is not None:
+        edited_playlist = playlists_db[edit_plan.playlist_id]
+        edited_playlist.song_ids = edit_plan.final_song_ids
+        edited_playlist.order_ids = edit_plan.final_order_ids
+        save_playlist(edited_playlist)
+        print("Playlist reordered. ")
+    else:
+        print("Sorted playlist created at https://music.youtube.com/playlist?list=" + edit_plan.playlist_id)
+
+def main():
+    """Sorts a playlist the user picks, then reorders it or creates a sorted copy on YouTube Music."""
+    arguments = parser.parse_args()
+    # Restarts share one full distance matrix, so they can't score songs on the fly or only try some jumps
+    if arguments.restarts > 1 and arguments.engine != 'clusters' and (arguments.candidates != 'all' or arguments.costs != 'matrix'):
+        parser.error("--restarts can't be combined with --candidates knn or --costs callback")
+
+    random.seed()
+    playlists_db, songs_cache = load_data_files()
+
+    # Finish playlist edits that were interrupted last time
+    interrupted_edit_plan = load_plan()
+    if interrupted_edit_plan is not None and not arguments.dry_run:
+        print("Found unfinished edits from last time: " + interrupted_edit_plan.describe() + ". ")
+        if prompt_user_for_bool("Finish them now? Otherwise they are discarded. "):
+            finish_edit_plan(interrupted_edit_plan, playlists_db)
+        else:
+            remove_plan()
+
+    selected_playlist = None
+    while selected_playlist is None:
+        print("\nSelect a playlist to sort: ")
+        selected_playlist = prompt_for_playlist(playlists_db)
+    original_songs = selected_playlist.song_ids.copy()
+    dedupliated_songs = [*set(original_songs)]
+    removed_song_count = len(original_songs) - len(dedupliated_songs)
     if removed_song_count > 0:
-        print("Duplicate songs will be at top of playlist. ")
-    print("Beginning to reorder playlist...")
-    # Moves each song to bottom of playlist, putting them all in order
-    moved_song_count = 0
-    for current_song_id in sorted_song_ids:
-        # Print update every 10 changes since they take a while
-        if moved_song_count % 10 == 9:
-            print("Moving " + str(moved_song_count + 1) + "th song. ")
-        original_index = original_songs.index(current_song_id)
-        current_order_id = selected_playlist.order_ids[original_index]
-        run_API_request(lambda: YTM.edit_playlist(selected_playlist.yt_id, moveItem=(current_order_id, None)))
-        moved_song_count = moved_song_count + 1
-    print("Playlist reordered.")
-
-elif prompt_user_for_bool("Create new, sorted playlist on YTM? "):
-    sorted_playlist_name = selected_playlist.name + " (sorted on " + time.ctime() + ")"
-    playlist_id = run_API_request(lambda : YTM.create_playlist(title=sorted_playlist_name, video_ids=sorted_song_ids, description="Automatically created by sorter"), "to create a YouTube Music playlist with the sorted songs")
-    print("Sorted playlist created at https://music.youtube.com/playlist?list=" + playlist_id)
-
-# TODO: print results with song, key, and bpm.  print old and new lists with scores between each song
-
-print("Sorter done, exiting.")
+        print(str(removed_song_count) + " songs will be removed from the sorted playlist for being duplicates")
+    # Read the songs' features from the store's feature file instead of loading every song
+    song_table = load_song_table(get_song_store().feature_file, dedupliated_songs)
+
+    print("Similarity score before sorting: " + str(round(get_current_similarity_score(dedupliated_songs, song_table), 4)))
+    progress_callback = None if arguments.quiet else print_solver_progress
+    memory_budget_bytes = arguments.memory_budget_mib * 1024 * 1024
+    distance_cache = DistanceCache(max_bytes=arguments.distance_cache_mib * 1024 * 1024) if arguments.distance_cache_mib > 0 else None
+    sorted_song_ids = None
+    last_sorted_song_ids = None if arguments.full_sort else get_song_store().load_sorted_order(selected_playlist.yt_id)
+    given_full_sort_options = ["--" + option.replace('_', '-') for option in FULL_SORT_OPTIONS if getattr(arguments, option) != parser.get_default(option)]
+    if last_sorted_song_ids is not None and len(given_full_sort_options) > 0:
+        print("Sorting the whole playlist instead of fitting new songs into the last sorted order, since " + ", ".join(given_full_sort_options) + \
+              " only apply to a full sort. ")
+        last_sorted_song_ids = None
+    if last_sorted_song_ids is not None:
+        sorted_song_ids = solve_incrementally(dedupliated_songs, last_sorted_song_ids, song_table, cost_scale=arguments.cost_scale, neighbor_count=arguments.neighbors,
+                                              time_limit_s=arguments.time_limit if arguments.time_limit is not None else REPAIR_TIME_LIMIT_S)
+    if sorted_song_ids is None and arguments.restarts > 1 and arguments.engine != 'clusters':
+        try:
+            sorted_song_ids = solve_in_parallel(dedupliated_songs, song_table, engine=arguments.engine, restart_count=arguments.restarts,
+                                                process_count=arguments.processes, target_similarity=arguments.target_similarity,
+                                                time_limit_s=arguments.time_limit, metaheuristic=arguments.metaheuristic,
+                                                cost_scale=arguments.cost_scale, memory_budget_bytes=memory_budget_bytes, distance_cache=distance_cache,
+                                                neighbor_count=arguments.neighbors, solution_limit=arguments.solution_limit)
+        except MemoryError as error:
+            print(str(error) + "Sorting with a single solve instead. ")
+    if sorted_song_ids is not None:
+        pass # Fit into the last sorted order, or sorted with restarts
+    elif arguments.engine == 'clusters':
+        sorted_song_ids = solve_with_clusters(dedupliated_songs, song_table, cost_scale=arguments.cost_scale, target_cluster_size=arguments.cluster_size,
+                                              time_limit_s=arguments.time_limit, progress_callback=progress_callback, neighbor_count=arguments.neighbors)
+    elif arguments.engine == 'local-search':
+        sorted_song_ids = solve_with_local_search(dedupliated_songs, song_table, cost_scale=arguments.cost_scale, memory_budget_bytes=memory_budget_bytes,
+                                                  neighbor_count=arguments.neighbors, time_limit_s=arguments.time_limit, progress_callback=progress_callback,
+                                                  candidates=arguments.candidates, distance_cache=distance_cache)
+    else:
+        sorted_song_ids = solve_for_playlist_order(dedupliated_songs, song_table, costs=arguments.costs, cost_scale=arguments.cost_scale,
+                                                   memory_budget_bytes=memory_budget_bytes, time_limit_s=arguments.time_limit,
+                                                   solution_limit=arguments.solution_limit, metaheuristic=arguments.metaheuristic,
+                                                   progress_callback=progress_callback, candidates=arguments.candidates, neighbor_count=arguments.neighbors,
+                                                   distance_cache=distance_cache)
+    print("Similarity score after sorting: " + str(round(get_current_similarity_score(sorted_song_ids, song_table), 4)))
+    print("Playlist sorted. ")
+    if not arguments.dry_run:
+        get_song_store().save_sorted_order(selected_playlist.yt_id, sorted_song_ids)
+
+    edit_plan = None
+    if prompt_user_for_bool("Reorder existing playlist on YTM? "):
+        remove_duplicates = removed_song_count > 0 and \
+                            prompt_user_for_bool("Remove the " + str(removed_song_count) + " duplicate songs from the playlist? Otherwise they will be at the top of the playlist. ")
+        # Plan against the playlist as it is now, in case it was changed on YouTube Music since it was saved
+        current_entries = None
+        if not arguments.dry_run:
+            try:
+                current_entries = get_playlist_entries(YTM, run_API_request, selected_playlist.yt_id)
+            except PlaylistEditError as error:
+                sys.exit(str(error) + "The playlist wasn't edited. \n")
+            if current_entries[1] != list(selected_playlist.order_ids):
+                print("The playlist was changed on YouTube Music since it was saved; reordering its current songs. ")
+        edit_plan = plan_reorder(selected_playlist, sorted_song_ids, remove_duplicates, current_entries)
+    elif prompt_user_for_bool("Create new, sorted playlist on YTM? "):
+        sorted_playlist_name = selected_playlist.name + " (sorted on " + time.ctime() + ")"
+        edit_plan = plan_new_playlist(sorted_playlist_name, "Automatically created by sorter", sorted_song_ids)
+
+    if edit_plan is not None:
+        print("Planned " + edit_plan.describe() + ". ")
+        if arguments.dry_run:
+            print("Dry run, so the playlist wasn't edited. ")
+        else:
+            finish_edit_plan(edit_plan, playlists_db)
+
+    # TODO: print results with song, key, and bpm.  print old and new lists with scores between each song
+
+    print("Sorter done, exiting.")
+
+# Restarts run in worker processes, which import this file again when they're started with spawn
+# (the only option on Windows), so the sorter only runs when this file is the program
+if __name__ == '__main__':
+    main()
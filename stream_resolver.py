@@ -0,0 +1,227 @@
+"""
+Finds stream URLs for song samples in the background, so the next sample is ready before it's needed.
+
+Looking up a song's stream with yt-dlp takes several seconds.  While the user rates one song,
+a small pool of worker threads looks up the streams of the next few songs to rate.  Found
+URLs are kept with the time they expire (YouTube puts it in the URL's "expire" parameter), and
+looked up again if they would expire before the sample is done playing.  If a song's YouTube
+stream can't be found, or isn't found yet when it's needed, its Spotify preview is played
+instead (if it has one), so the user never waits long for a sample.
+
+Found URLs are also saved to STREAM_URL_CACHE_FILE until they expire, so rating an
+overlapping playlist again soon after doesn't run yt-dlp for songs that were just looked up.
+Helper programs are found on the PATH (or in the program folder) once, without running them.
+"""
+
+import json, os, re, shutil, subprocess, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+STREAM_URL_CACHE_FILE = 'stream_urls.json'
+# Helper program locations to try, in order
+YTDLP_PATH_CANDIDATES = ["yt-dlp", "./yt-dlp", "yt-dlp.exe", "./yt-dlp.exe"]
+FFPLAY_PATH_CANDIDATES = ["ffplay.exe", "ffmpeg/bin/ffplay.exe", "ffplay", "ffmpeg/bin/ffplay"]
+FFMPEG_PATH_CANDIDATES = ["ffmpeg.exe", "ffmpeg/bin/ffmpeg.exe", "ffmpeg", "ffmpeg/bin/ffmpeg"]
+# Preferred stream formats, best first:
+# 251 is higher quality OPUS audio (for all videos)
+# 140 and 141 are YouTube Music AAC formats
+# 18 is 360p MP4, a legacy non-DASH video+audio format
+PREFERRED_FORMAT_IDS = ["251", "140", "141", "18"]
+# Songs to look up ahead of the one being rated
+PREFETCH_SONG_COUNT = 3
+RESOLVER_WORKERS = 2
+# Look up a URL again if it expires within this long, so it doesn't expire mid-sample
+URL_EXPIRY_MARGIN_S = 5 * 60
+# How long to wait for a lookup that isn't done yet before playing the Spotify preview instead
+MAX_RESOLVE_WAIT_S = 0.5
+# Kinds of streams
+STREAM_YOUTUBE = 'youtube'
+STREAM_SPOTIFY_PREVIEW = 'spotify_preview'
+
+class ResolvedStream:
+    """A URL to play a song's sample from."""
+    url = None
+    format_id = None # YouTube format ID, or None for a Spotify preview
+    kind = None # STREAM_YOUTUBE or STREAM_SPOTIFY_PREVIEW
+    expire_time = None # Unix time the URL stops working, or None if unknown
+
+    def __init__(self, url : str, kind : str, format_id=None, expire_time=None):
+        self.url = url
+        self.kind = kind
+        self.format_id = format_id
+        self.expire_time = expire_time
+
+    def is_fresh(self, current_time=None) -> bool:
+        """Whether the URL will still work after a whole sample is played."""
+        if self.expire_time is None:
+            return True
+        return self.expire_time - URL_EXPIRY_MARGIN_S > (time.time() if current_time is None else current_time)
+
+class StreamLookupError(Exception):
+    """A song's YouTube stream couldn't be found."""
+    is_helper_missing = False # Whether yt-dlp itself wasn't found
+
+def extract_playback_url_from_json(json):
+    """
+    Parse the response JSON to find preferred audio formats, returning (URL, format ID) or (None, None)
+    """
+    # TODO: Warn user to refresh cookies.txt if lower quality detected, premium only song encountered, or private song encountered
+    for perferred_format in PREFERRED_FORMAT_IDS:
+        for format_json in json['formats']:
+            if format_json['format_id'] == perferred_format:
+                return format_json['url'], perferred_format
+    return None, None
+
+# Helper program locations already found, by their candidate paths
+_helper_program_paths = dict()
+
+def find_helper_program(path_candidates : list) -> str:
+    """Returns the first of path_candidates that is an executable program, or None if none are.
+       The result is remembered, so each program is only looked for once."""
+    key = tuple(path_candidates)
+    if key not in _helper_program_paths:
+        found_paths = [shutil.which(path) for path in path_candidates]
+        _helper_program_paths[key] = next((path for path in found_paths if path is not None), None)
+    return _helper_program_paths[key]
+
+def get_url_expire_time(url : str) -> int:
+    """Returns the Unix time a stream URL expires, from its "expire" parameter, or None if it has none."""
+    match = re.search(r"[?&/]expire[=/](\d+)", url)
+    return int(match.group(1)) if match is not None else None
+
+def look_up_youtube_stream(yt_id : str, cookies_file_path=None) -> ResolvedStream:
+    """Runs yt-dlp to find a song's preferred stream.  Raises StreamLookupError if there isn't one."""
+    ytdlp_path = find_helper_program(YTDLP_PATH_CANDIDATES)
+    if ytdlp_path is not None:
+        try:
+            yt_manifest_text = subprocess.check_output([ytdlp_path, "-j"] + \
+                                                       (["--cookies", cookies_file_path] if cookies_file_path is not None else []) + \
+                                                       ["--extractor-args", "player_client:web_music", "--", yt_id],
+                                                       stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+            play_url, play_format = extract_playback_url_from_json(json.loads(yt_manifest_text))
+            if play_url is not None:
+                return ResolvedStream(play_url, STREAM_YOUTUBE, play_format, get_url_expire_time(play_url))
+        except (subprocess.CalledProcessError, ValueError):
+            pass
+    error = StreamLookupError("Failed to acquire stream for song sample (ID " + yt_id + "). ")
+    error.is_helper_missing = ytdlp_path is None
+    raise error
+
+class StreamURLCache:
+    """
+    Found YouTube stream URLs and format IDs by YouTube ID, saved to a JSON file until they
+    expire.  URLs without an expiry time aren't saved, since there's no telling how long they
+    work.  Thread safe.
+    """
+    path = None
+    entries = None # dict of YouTube ID to dict of URL, format ID and expiry time
+    lock = None
+
+    def __init__(self, path=STREAM_URL_CACHE_FILE):
+        self.path = path
+        self.entries = dict()
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as cache_file:
+                    self.entries = json.load(cache_file)
+            except ValueError:
+                print("Stream URL cache " + path + " is unreadable, starting a new one. ")
+
+    def get(self, yt_id : str) -> ResolvedStream:
+        """Returns a song's saved stream, or None if there is none or it expires too soon."""
+        with self.lock:
+            entry = self.entries.get(yt_id)
+        if entry is None:
+            return None
+        stream = ResolvedStream(entry['url'], STREAM_YOUTUBE, entry['format_id'], entry['expire_time'])
+        return stream if stream.is_fresh() else None
+
+    def put(self, yt_id : str, stream : ResolvedStream):
+        """Saves a song's stream, dropping any expired ones."""
+        if stream.kind != STREAM_YOUTUBE or stream.expire_time is None:
+            return
+        with self.lock:
+            self.entries[yt_id] = {'url' : stream.url, 'format_id' : stream.format_id, 'expire_time' : stream.expire_time}
+            current_time = time.time()
+            self.entries = {entry_yt_id : entry for entry_yt_id, entry in self.entries.items() if entry['expire_time'] > current_time}
+            # Replace the file in one step so it is never left half written
+            new_path = self.path + '.new'
+            with open(new_path, "w") as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(new_path, self.path)
+
+class StreamResolver:
+    """Looks up song sample streams on a pool of worker threads, keeping found URLs until they expire."""
+    cookies_file_path = None
+    look_up_stream = None # function(yt_id, cookies_file_path) -> ResolvedStream
+    url_cache = None # StreamURLCache, or None to not save URLs
+    executor = None
+    lookups = None # dict of YouTube ID to Future of ResolvedStream
+    lock = None
+
+    def __init__(self, cookies_file_path=None, worker_count=RESOLVER_WORKERS, look_up_stream=look_up_youtube_stream, url_cache=None):
+        self.cookies_file_path = cookies_file_path
+        self.look_up_stream = look_up_stream
+        self.url_cache = url_cache
+        self.executor = ThreadPoolExecutor(max_workers=worker_count)
+        self.lookups = dict()
+        self.lock = threading.Lock()
+
+    def _get_lookup(self, yt_id : str) -> Future:
+        """Returns the lookup of a song's stream, starting one if there's none or its URL is too old."""
+        with self.lock:
+            lookup = self.lookups.get(yt_id)
+            if lookup is not None and lookup.done() and lookup.exception() is None and not lookup.result().is_fresh():
+                lookup = None
+            if lookup is None:
+                saved_stream = self.url_cache.get(yt_id) if self.url_cache is not None else None
+                if saved_stream is not None:
+                    lookup = Future()
+                    lookup.set_result(saved_stream)
+                else:
+                    lookup = self.executor.submit(self._look_up_and_save, yt_id)
+                self.lookups[yt_id] = lookup
+            return lookup
+
+    def _look_up_and_save(self, yt_id : str) -> ResolvedStream:
+        stream = self.look_up_stream(yt_id, self.cookies_file_path)
+        if self.url_cache is not None:
+            self.url_cache.put(yt_id, stream)
+        return stream
+
+    def prefetch(self, songs : list):
+        """Starts looking up the streams of songs that will be rated soon."""
+        for song in songs:
+            self._get_lookup(song.yt_id)
+
+    def get_stream(self, song, max_wait_s=MAX_RESOLVE_WAIT_S, report=print) -> ResolvedStream:
+        """
+        Returns the stream to play a song's sample from, or None if there is none.  Waits up to
+        max_wait_s (None for no limit) for a lookup that isn't done if the song has a Spotify
+        preview to play instead, or else until the lookup is done.  Passes messages about why the
+        YouTube stream isn't used, if it isn't, to report().
+        """
+        lookup = self._get_lookup(song.yt_id)
+        try:
+            return lookup.result(timeout=max_wait_s if song.spotify_preview_url is not None else None)
+        except StreamLookupError as error:
+            report(str(error))
+            if error.is_helper_missing:
+                report("Helper program not found, please install yt-dlp, or be sure you placed yt-dlp.exe in this program folder. ")
+        except TimeoutError:
+            report("Stream for song sample (ID " + song.yt_id + ") isn't ready yet. ")
+        except Exception as error:
+            report("Failed to acquire stream for song sample (ID " + song.yt_id + "): " + str(error))
+        if song.spotify_preview_url is None:
+            return None
+        report("Falling back to Spotify song preview")
+        return ResolvedStream(song.spotify_preview_url, STREAM_SPOTIFY_PREVIEW)
+
+    def forget(self, yt_id : str):
+        """Drops a song's lookup once it won't be played again."""
+        with self.lock:
+            self.lookups.pop(yt_id, None)
+
+    def close(self):
+        """Cancels lookups that haven't started, without waiting for running ones."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
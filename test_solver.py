@@ -0,0 +1,84 @@
+"""
+Tests for the playlist solver, run with pytest.  Songs are random but seeded, so every run
+solves the same playlists.
+"""
+
+import random
+
+import numpy
+import pytest
+
+from song_model import CAMELOT_POSITIONS, MAX_BPM, MIN_BPM, USER_RATINGS, Song
+from scoring import get_current_similarity_score, get_similarity_score_v1, pack_song_features
+from distance import DISTANCE_COST_SCALE, build_distance_matrix, get_scaled_distances
+from solver import START_NODE, get_average_similarity_for_cost, get_node_for_song_index, get_song_index_for_node, solve_for_playlist_order
+
+# Seconds each test solve gets, enough for the solver to improve on a random order
+TEST_TIME_LIMIT_S = 2
+
+def make_random_songs(song_count : int, seed=1) -> dict:
+    """Returns a dict of YouTube ID to Song, with every feature and rating filled in."""
+    random_numbers = random.Random(seed)
+    songs = dict()
+    for song_index in range(song_count):
+        song = Song()
+        song.yt_id = 'song' + str(song_index)
+        song.name = song.yt_id
+        song.set_camelot_position(random_numbers.randint(1, CAMELOT_POSITIONS))
+        song.camelot_is_minor = random_numbers.random() < 0.5
+        song.set_bpm(random_numbers.uniform(MIN_BPM, MAX_BPM))
+        song.user_ratings = {rating_name : random_numbers.randint(-2, 2) for rating_name in USER_RATINGS}
+        songs[song.yt_id] = song
+    return songs
+
+@pytest.mark.parametrize('candidates', ['all', 'knn'])
+def test_solve_improves_similarity(candidates):
+    songs = make_random_songs(200)
+    song_ids = list(songs)
+    sorted_song_ids = solve_for_playlist_order(song_ids, songs, time_limit_s=TEST_TIME_LIMIT_S, progress_callback=None, candidates=candidates)
+    assert get_current_similarity_score(sorted_song_ids, songs) > get_current_similarity_score(song_ids, songs)
+
+@pytest.mark.parametrize('costs', ['matrix', 'callback'])
+def test_solve_returns_permutation(costs):
+    songs = make_random_songs(50, seed=2)
+    song_ids = list(songs)
+    sorted_song_ids = solve_for_playlist_order(song_ids, songs, costs=costs, time_limit_s=TEST_TIME_LIMIT_S, progress_callback=None)
+    assert len(sorted_song_ids) == len(song_ids)
+    assert sorted(sorted_song_ids) == sorted(song_ids)
+
+@pytest.mark.parametrize('song_count', [0, 1])
+def test_solve_tiny_playlist(song_count):
+    songs = make_random_songs(song_count)
+    assert solve_for_playlist_order(list(songs), songs) == list(songs)
+
+def test_node_mapping():
+    for song_index in range(10):
+        node = get_node_for_song_index(song_index)
+        assert node != START_NODE
+        assert get_song_index_for_node(node) == song_index
+    with pytest.raises(AssertionError):
+        get_song_index_for_node(START_NODE)
+
+def test_scaled_distances():
+    scaled_distances = get_scaled_distances(numpy.array([1.0, 0.0, 0.5, 0.99994, 0.99996, 1.2, -0.2]))
+    assert scaled_distances.tolist() == [0, DISTANCE_COST_SCALE, DISTANCE_COST_SCALE // 2, 1, 0, 0, DISTANCE_COST_SCALE]
+
+def test_distance_matrix_matches_scores():
+    songs = make_random_songs(30, seed=3)
+    song_ids = list(songs)
+    distance_matrix = build_distance_matrix(pack_song_features(song_ids, songs), for_solver=False)
+    for from_index, from_song_id in enumerate(song_ids):
+        for to_index, to_song_id in enumerate(song_ids):
+            expected_cost = round((1.0 - get_similarity_score_v1(songs[from_song_id], songs[to_song_id])) * DISTANCE_COST_SCALE)
+            assert distance_matrix.get(from_index, to_index) == expected_cost
+
+def test_average_similarity_for_cost():
+    songs = make_random_songs(30, seed=4)
+    song_ids = list(songs)
+    distance_matrix = build_distance_matrix(pack_song_features(song_ids, songs), for_solver=False)
+    song_order = list(range(len(song_ids)))
+    total_similarity = sum(get_similarity_score_v1(songs[song_ids[song_index - 1]], songs[song_ids[song_index]]) for song_index in song_order[1:])
+    average_similarity = get_average_similarity_for_cost(distance_matrix.get_path_cost(song_order), len(song_order))
+    # Each distance is rounded by at most half a unit
+    assert average_similarity == pytest.approx(total_similarity / (len(song_order) - 1), abs=0.5 / DISTANCE_COST_SCALE)
+    assert get_average_similarity_for_cost(0, 1) == 1.0